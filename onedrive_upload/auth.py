@@ -0,0 +1,88 @@
+import os
+import time
+from threading import Lock
+
+import msal
+
+# -----------------------------
+# Configuration & Constants
+# -----------------------------
+# Tokens for the uploader scripts. Nothing here touches the network until the
+# first get_access_token(): building the MSAL app fetches the authority's
+# metadata, and the hashing process pool re-imports the scripts in every worker.
+# The MSAL cache (access and refresh tokens) is kept in TOKEN_CACHE_FILE, so
+# only the very first run has to open a browser.
+CLIENT_ID = None
+AUTHORITY = 'https://login.microsoftonline.com/consumers'
+SCOPES = ['Files.ReadWrite.All']
+TOKEN_CACHE_FILE = 'token_cache.bin'
+REFRESH_MARGIN = 300  # Refresh tokens this many seconds before they expire
+
+# Global variables
+result = None   # The current token response, with 'expires_at' added
+_app = None
+_cache = None
+_lock = Lock()
+
+def configure(client_id, authority=AUTHORITY, scopes=SCOPES, cache_file=TOKEN_CACHE_FILE):
+    global CLIENT_ID, AUTHORITY, SCOPES, TOKEN_CACHE_FILE
+    CLIENT_ID, AUTHORITY, SCOPES, TOKEN_CACHE_FILE = client_id, authority, scopes, cache_file
+
+# -----------------------------
+# Token Cache
+# -----------------------------
+def _load_cache():
+    cache = msal.SerializableTokenCache()
+    try:
+        with open(TOKEN_CACHE_FILE, 'r') as f:
+            cache.deserialize(f.read())
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"Ignoring unreadable token cache {TOKEN_CACHE_FILE}: {e}")
+    return cache
+
+def _save_cache():
+    """Writes the cache if MSAL changed it; readable only by this user, replaced atomically."""
+    if not _cache.has_state_changed:
+        return
+    temp_file = TOKEN_CACHE_FILE + '.tmp'
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(_cache.serialize())
+    os.replace(temp_file, TOKEN_CACHE_FILE)
+    _cache.has_state_changed = False
+
+# -----------------------------
+# Token Management
+# -----------------------------
+def _valid(token):
+    return token is not None and time.time() < token['expires_at'] - REFRESH_MARGIN
+
+def get_access_token():
+    """
+    Returns a current access token. Only one thread refreshes at a time; others
+    arriving meanwhile wait for it and reuse its token instead of refreshing too.
+    """
+    global result, _app, _cache
+    token = result
+    if _valid(token):
+        return token['access_token']
+    with _lock:
+        if _valid(result):
+            return result['access_token']
+        if _app is None:
+            _cache = _load_cache()
+            _app = msal.PublicClientApplication(CLIENT_ID, authority=AUTHORITY, token_cache=_cache)
+        accounts = _app.get_accounts()
+        token = _app.acquire_token_silent(SCOPES, account=accounts[0]) if accounts else None
+        if not token:
+            token = _app.acquire_token_interactive(SCOPES)
+            if 'access_token' in token:
+                print("Access token acquired successfully.")
+        _save_cache()
+        if 'access_token' not in token:
+            raise RuntimeError(f"Could not obtain access token: {token.get('error_description', token)}")
+        token['expires_at'] = time.time() + token['expires_in']
+        result = token
+        return token['access_token']
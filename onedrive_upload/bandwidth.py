@@ -0,0 +1,200 @@
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import datetime
+from threading import Lock, Thread
+
+# -----------------------------
+# Configuration & Constants
+# -----------------------------
+# One token bucket shared by every upload, whichever thread or event loop sends
+# it. Bodies are handed to the HTTP library a block at a time and each block
+# waits for its share of the rate, so the uplink sees an even stream instead of
+# full-speed bursts followed by sleeps.
+#
+# SCHEDULE entries are (days, start, end, bytes_per_sec); the first entry
+# matching the local time applies and None means unlimited. days is '*', a
+# range like 'mon-fri' or a list like 'sat,sun'; an end before the start wraps
+# past midnight. For example:
+#     [('mon-fri', '08:00', '18:00', 2 * 1024 * 1024)]
+SCHEDULE = []
+BURST_SECONDS = 0.25     # Unused allowance the bucket can save up, in seconds of the current rate
+PACING_BLOCK = 64 * 1024 # Largest block sent per token reservation
+RATE_WINDOW = 5.0        # Seconds of history behind the reported throughput
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Global variables
+_lock = Lock()
+_next_send = 0.0    # When the bucket is next empty, as a time.monotonic() value
+_bytes_sent = 0
+_recent = deque()   # (time.monotonic(), bytes) within the last RATE_WINDOW seconds
+_rate = None
+_rate_checked = 0.0
+
+# -----------------------------
+# Schedule
+# -----------------------------
+def _day_matches(days, weekday):
+    if days == '*':
+        return True
+    for part in days.lower().split(','):
+        first, _, last = part.strip().partition('-')
+        first_i = DAYS.index(first)
+        last_i = DAYS.index(last) if last else first_i
+        if (first_i <= weekday <= last_i) if first_i <= last_i else (weekday >= first_i or weekday <= last_i):
+            return True
+    return False
+
+def rate_at(moment):
+    """Bytes/sec allowed at a datetime according to SCHEDULE, or None for unlimited."""
+    clock = moment.strftime('%H:%M')
+    for days, start, end, rate in SCHEDULE:
+        in_window = start <= clock < end if start <= end else (clock >= start or clock < end)
+        # A window that wraps past midnight belongs to the day it started on
+        weekday = moment.weekday() if start <= end or clock >= start else (moment.weekday() - 1) % 7
+        if in_window and _day_matches(days, weekday):
+            return rate
+    return None
+
+def current_rate():
+    global _rate, _rate_checked
+    now = time.monotonic()
+    if now - _rate_checked >= 1.0:
+        _rate = rate_at(datetime.now())
+        _rate_checked = now
+    return _rate
+
+# -----------------------------
+# Token Bucket
+# -----------------------------
+def reserve(nbytes):
+    """
+    Takes nbytes from the bucket and returns how long to wait before sending
+    them. Callers sleep outside the lock, so threads and coroutines can share it.
+    """
+    global _next_send, _bytes_sent
+    now = time.monotonic()
+    with _lock:
+        _bytes_sent += nbytes
+        _recent.append((now, nbytes))
+        while _recent and _recent[0][0] < now - RATE_WINDOW:
+            _recent.popleft()
+        rate = current_rate()
+        if not rate:
+            return 0.0
+        # Virtual-clock bucket: each block pushes the next send time back by its
+        # own duration at the current rate, allowing up to BURST_SECONDS of slack
+        _next_send = max(_next_send, now - BURST_SECONDS)
+        delay = _next_send - now
+        _next_send += nbytes / rate
+    return max(0.0, delay)
+
+class PacedReader:
+    """
+    A buffer as a file-like request body: requests sends Content-Length from
+    len() and urllib3 then pulls it block by block through read(), each block
+    waiting for bandwidth. seek(0) rewinds it for a retry. waited is the time
+    the current attempt spent held back, which is not the server being slow.
+    """
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+        self.waited = 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+    def seek(self, pos):
+        self._pos = pos
+        self.waited = 0.0
+
+    def read(self, size=-1):
+        size = PACING_BLOCK if size is None or size < 0 else min(size, PACING_BLOCK)
+        block = self._data[self._pos:self._pos + size]
+        self._pos += len(block)
+        self.waited += _pace(len(block))
+        return block
+
+class PacedFile:
+    """PacedReader over an open file, so whole-file uploads are streamed instead of read into memory."""
+    def __init__(self, f):
+        self._f = f
+        self._size = os.fstat(f.fileno()).st_size
+        self.waited = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def seek(self, pos):
+        self._f.seek(pos)
+        self.waited = 0.0
+
+    def read(self, size=-1):
+        size = PACING_BLOCK if size is None or size < 0 else min(size, PACING_BLOCK)
+        block = self._f.read(size)
+        self.waited += _pace(len(block))
+        return block
+
+def _pace(nbytes):
+    """Sleeps until nbytes may be sent; returns how long that took."""
+    if not nbytes:
+        return 0.0  # The read at the end of the body sends nothing, so it mustn't wait for the last block
+    delay = reserve(nbytes)
+    if delay:
+        time.sleep(delay)
+    return delay
+
+class PacedBlocks:
+    """
+    The asyncio counterpart of PacedReader: an async iterator over the buffer's
+    blocks, slices rather than copies, each waiting for bandwidth. waited is as
+    for PacedReader; make a new one for each attempt.
+    """
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+        self.waited = 0.0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._pos >= len(self._data):
+            raise StopAsyncIteration
+        block = self._data[self._pos:self._pos + PACING_BLOCK]
+        self._pos += len(block)
+        delay = reserve(len(block))
+        if delay:
+            self.waited += delay
+            await asyncio.sleep(delay)
+        return block
+
+# -----------------------------
+# Live Counters
+# -----------------------------
+def stats():
+    """{'bytes_sent', 'bytes_per_sec' over the last RATE_WINDOW seconds, 'limit'}"""
+    now = time.monotonic()
+    with _lock:
+        while _recent and _recent[0][0] < now - RATE_WINDOW:
+            _recent.popleft()
+        recent = sum(nbytes for _, nbytes in _recent)
+        # Right after a start there is less than RATE_WINDOW of history to average over
+        span = min(RATE_WINDOW, max(1.0, now - _recent[0][0])) if _recent else RATE_WINDOW
+        return {'bytes_sent': _bytes_sent, 'bytes_per_sec': recent / span, 'limit': current_rate()}
+
+def start_reporter(interval):
+    """Prints throughput every interval seconds while bytes are being sent."""
+    def report():
+        last_sent = 0
+        while True:
+            time.sleep(interval)
+            s = stats()
+            if s['bytes_sent'] != last_sent:
+                limit = f"{s['limit'] / 1024 / 1024:.1f} MB/s" if s['limit'] else 'unlimited'
+                print(f"Upload throughput: {s['bytes_per_sec'] / 1024 / 1024:.2f} MB/s (limit {limit}), "
+                      f"{s['bytes_sent'] / 1024 / 1024:.1f} MB sent")
+                last_sent = s['bytes_sent']
+    Thread(target=report, daemon=True).start()
@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Lock, Thread
+
+import auth
+import graph_stub
+import sync_db
+
+# -----------------------------
+# SQLite Write Throughput
+# -----------------------------
+def _row(worker, i):
+    return (f'folder{worker}/file{i}.bin', time.time(), i, f'item-{worker}-{i}')
+
+def _run_threads(target, workers):
+    threads = [Thread(target=target, args=(w,)) for w in range(workers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def bench_per_row_commit(database_file, rows, workers):
+    """The old upload_worker pattern: execute + commit per file under a global lock."""
+    conn = sqlite3.connect(database_file, check_same_thread=False)
+    conn.execute('CREATE TABLE files (relative_path TEXT PRIMARY KEY, mtime REAL, size INTEGER, onedrive_id TEXT)')
+    conn.commit()
+    lock = Lock()
+
+    def worker(w):
+        for i in range(rows // workers):
+            with lock:
+                conn.execute('INSERT OR REPLACE INTO files (relative_path, mtime, size, onedrive_id) '
+                             'VALUES (?, ?, ?, ?)', _row(w, i))
+                conn.commit()
+
+    elapsed = _run_threads(worker, workers)
+    conn.close()
+    return elapsed
+
+def bench_batched_writer(database_file, rows, workers):
+    """Workers hand rows to the sync_db writer thread."""
+    sync_db.open_database(database_file).close()
+    sync_db.start_writer(database_file)
+
+    def worker(w):
+        for i in range(rows // workers):
+            sync_db.write('INSERT OR REPLACE INTO files (relative_path, mtime, size, onedrive_id) VALUES (?, ?, ?, ?)',
+                          _row(w, i))
+
+    start = time.perf_counter()
+    _run_threads(worker, workers)
+    sync_db.flush()
+    elapsed = time.perf_counter() - start
+    sync_db.stop_writer()
+    return elapsed
+
+def run_db_benchmark(rows, workers):
+    with tempfile.TemporaryDirectory() as tmp:
+        before = bench_per_row_commit(os.path.join(tmp, 'before.db'), rows, workers)
+        after = bench_batched_writer(os.path.join(tmp, 'after.db'), rows, workers)
+    print(f"files table writes, {rows} rows from {workers} threads:")
+    print(f"  per-row commit under lock: {rows / before:10.0f} rows/sec ({before:.2f}s)")
+    print(f"  batched WAL writer:        {rows / after:10.0f} rows/sec ({after:.2f}s)")
+
+# -----------------------------
+# Synthetic Trees
+# -----------------------------
+# Scenarios are (file count, size picker). Files get a random prefix so every
+# one has distinct content; anything larger is sparse, so a tree of 5 GB files
+# doesn't take 500 GB of disk writes to generate. --scale shrinks the count.
+RANDOM_PREFIX = 1024 * 1024
+FILES_PER_FOLDER = 100
+
+def mixed_size(rng):
+    """Mostly small documents, some photos, a few videos."""
+    roll = rng.random()
+    if roll < 0.85:
+        return rng.randint(0, 64 * 1024)
+    if roll < 0.99:
+        return rng.randint(64 * 1024, 4 * 1024 * 1024)
+    return rng.randint(4 * 1024 * 1024, 256 * 1024 * 1024)
+
+SCENARIOS = {
+    'small': (2000, lambda rng: 4096),
+    'tiny': (1_000_000, lambda rng: rng.randint(0, 1024)),
+    'huge': (100, lambda rng: 5 * 1024 ** 3),
+    'mixed': (20_000, mixed_size),
+}
+
+def make_tree(root, scenario, scale=1.0, files=None, seed=0):
+    """Writes the scenario's files under root, FILES_PER_FOLDER to a folder in two levels. Returns total bytes."""
+    count, pick_size = SCENARIOS[scenario]
+    count = files or max(1, int(count * scale))
+    rng = random.Random(seed)
+    total = 0
+    for i in range(count):
+        folder = os.path.join(root, f'd{i // (FILES_PER_FOLDER * 100):03}', f'd{i // FILES_PER_FOLDER % 100:02}')
+        if i % FILES_PER_FOLDER == 0:
+            os.makedirs(folder, exist_ok=True)
+        size = pick_size(rng)
+        with open(os.path.join(folder, f'file{i}.bin'), 'wb') as f:
+            f.write(os.urandom(min(size, RANDOM_PREFIX)))
+            if size > RANDOM_PREFIX:
+                f.truncate(size)
+        total += size
+    return total
+
+def tree_size(root):
+    files = total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return files, total
+
+# -----------------------------
+# Sync Tools Against graph_stub
+# -----------------------------
+ENGINES = ('threads', 'async', 'v1')  # onedrive_upload_v2's two engines, and onedrive_upload
+
+def peak_rss():
+    """Peak resident set size of this process in bytes; None where it can't be read (Windows)."""
+    try:
+        # ru_maxrss can carry over the parent's peak across fork+exec on Linux; VmHWM starts afresh
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # In bytes on macOS
+
+def run_engine(engine, root, graph_url):
+    """
+    One sync of root with the given engine; run in a fresh process (and working
+    directory, for its own database) per engine. Prints elapsed seconds and peak
+    RSS as JSON.
+    """
+    os.environ['GRAPH_URL'] = graph_url
+    auth.result = {'access_token': 'benchmark', 'expires_at': time.time() + 3600}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if engine == 'v1':
+            import onedrive_upload as v1
+            v1.folders_to_monitor = [root]
+            start = time.perf_counter()
+            v1.initial_sync()
+            elapsed = time.perf_counter() - start
+        else:
+            import onedrive_upload_v2 as v2
+            v2.LOCAL_ROOT_FOLDER = root
+            v2.ENGINE = engine
+            sync_db.start_writer(v2.DATABASE_FILE)
+            v2.start_graph_batcher()
+            start = time.perf_counter()
+            v2.sync_once()
+            elapsed = time.perf_counter() - start
+    print(json.dumps({'elapsed': elapsed, 'peak_rss': peak_rss()}))
+
+def run_sync_benchmark(scenario, scale, files, engines, root=None, resync=False):
+    server, graph_url = graph_stub.start()
+    faults = f", {graph_stub.THROTTLE_RATE:.0%} throttled, {graph_stub.ERROR_RATE:.0%} errors" \
+        if graph_stub.THROTTLE_RATE or graph_stub.ERROR_RATE else ''
+    with tempfile.TemporaryDirectory() as tmp:
+        if root is None:
+            root = os.path.join(tmp, 'tree')
+            print(f"Generating the {scenario} tree...")
+            make_tree(root, scenario, scale, files)
+        count, total = tree_size(root)
+        print(f"Syncing {count} files ({total / 1024 ** 2:.1f} MB), {graph_stub.LATENCY * 1000:.0f} ms per request"
+              f"{faults}:")
+        for engine in engines:
+            work_dir = os.path.join(tmp, engine)
+            os.makedirs(work_dir)
+            graph_stub.reset()
+            graph_stub.dispatch('POST', '/v1.0/me/drive/root/children', b'{"name": "backup"}', None)  # v1's root
+            passes = ['', ' (resync)'] if resync else ['']
+            for label in passes:
+                with graph_stub.state_lock:
+                    graph_stub.request_counts.clear()
+                    graph_stub.bytes_received = 0
+                command = [sys.executable, os.path.abspath(__file__), 'run-engine', engine, root, graph_url]
+                out = subprocess.run(command, cwd=work_dir, capture_output=True, text=True, check=True)
+                result = json.loads(out.stdout.splitlines()[-1])
+                report(engine + label, count, result, sum(graph_stub.request_counts.values()),
+                       graph_stub.bytes_received)
+    server.shutdown()
+
+def report(label, files, result, requests, uploaded):
+    elapsed = result['elapsed']
+    rss = f"{result['peak_rss'] / 1024 ** 2:6.0f} MB" if result['peak_rss'] else '   n/a'
+    print(f"  {label + ':':20}{files / elapsed:9.1f} files/s {uploaded / 1024 ** 2 / elapsed:8.1f} MB/s "
+          f"{requests:8} requests  peak RSS {rss}  ({elapsed:.2f}s)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline benchmarks for onedrive_upload and onedrive_upload_v2.')
+    sub = parser.add_subparsers(dest='scenario', required=True)
+    db = sub.add_parser('db', help='SQLite write throughput of the files table')
+    db.add_argument('--rows', type=int, default=5000)
+    db.add_argument('--workers', type=int, default=5)
+    tree = sub.add_parser('tree', help='generate a synthetic tree to reuse with engines --root')
+    tree.add_argument('root')
+    engines = sub.add_parser('engines', help='files/sec, MB/sec, requests and peak RSS of each sync tool')
+    for p in (tree, engines):
+        p.add_argument('--tree', choices=SCENARIOS, default='small',
+                       help='small: 2000 x 4 KiB, tiny: 1M files up to 1 KiB, huge: 100 x 5 GiB, mixed: 20k files')
+        p.add_argument('--scale', type=float, default=1.0, help='multiply the number of files')
+        p.add_argument('--files', type=int, help='number of files, instead of the scenario\'s')
+    engines.add_argument('--root', help='sync this existing tree instead of generating one')
+    engines.add_argument('--engines', default='threads,async', help=f'comma-separated, from {", ".join(ENGINES)}')
+    engines.add_argument('--latency', type=float, default=0.05, help='seconds the stub adds to every request')
+    engines.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests the stub answers 429')
+    engines.add_argument('--error-rate', type=float, default=0.0, help='share of requests the stub answers 503')
+    engines.add_argument('--no-hash', action='store_true', help="don't hash uploads in the stub")
+    engines.add_argument('--resync', action='store_true', help='sync each engine a second time, with nothing changed')
+    run = sub.add_parser('run-engine', help='(used by engines) one sync in this process')
+    run.add_argument('engine')
+    run.add_argument('root')
+    run.add_argument('graph_url')
+    args = parser.parse_args()
+
+    if args.scenario == 'db':
+        run_db_benchmark(args.rows, args.workers)
+    elif args.scenario == 'tree':
+        total = make_tree(args.root, args.tree, args.scale, args.files)
+        print(f"Wrote {total / 1024 ** 2:.1f} MB to {args.root}")
+    elif args.scenario == 'engines':
+        graph_stub.LATENCY = args.latency
+        graph_stub.THROTTLE_RATE = args.throttle_rate
+        graph_stub.ERROR_RATE = args.error_rate
+        graph_stub.HASH_CONTENT = not args.no_hash
+        run_sync_benchmark(args.tree, args.scale, args.files, args.engines.split(','), args.root, args.resync)
+    elif args.scenario == 'run-engine':
+        run_engine(args.engine, args.root, args.graph_url)
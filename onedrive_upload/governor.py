@@ -0,0 +1,174 @@
+import asyncio
+import random
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from threading import Condition, Timer
+
+# -----------------------------
+# Configuration & Constants
+# -----------------------------
+# An AIMD controller shared by every thread that talks to OneDrive: the number
+# of requests allowed in flight grows by about one per round of successful
+# requests, and is cut by DECREASE_FACTOR on throttling, errors or a sudden
+# jump in latency. A Retry-After pauses everyone, not just the thread that got it.
+# Coroutines of the asyncio engine wait for slots through acquire_async(), under
+# the same limit, without blocking their event loop.
+MIN_LIMIT = 1
+MAX_LIMIT = 32            # The asyncio engine raises it to its own ASYNC_MAX_IN_FLIGHT
+INITIAL_LIMIT = 4
+DECREASE_FACTOR = 0.5
+SLOW_FACTOR = 3.0         # A request this many times slower than usual counts as congestion
+SLOW_MIN_SECONDS = 0.5    # ...but only if it took at least this long; shorter blips are noise
+LATENCY_SMOOTHING = 0.1   # Weight of each new sample in the per-kind latency average
+LATENCY_WARMUP = 10       # Samples needed before latency is used as a signal
+PAUSE_JITTER = 1.0        # Spread wake-ups after a pause over this many seconds
+
+# Global variables
+_cond = Condition()
+_limit = float(INITIAL_LIMIT)
+_in_flight = 0
+_paused_until = 0.0
+_last_decrease = 0.0
+_latency = {}  # kind -> (average seconds, samples)
+_waiting_threads = 0
+_async_waiters = deque()  # (loop, future) of coroutines waiting for a slot, oldest first
+_wake_timer = None        # Grants slots to coroutines once a pause is over
+
+# -----------------------------
+# Request Slots
+# -----------------------------
+def acquire():
+    """
+    Blocks until a request may be sent: no pause is in effect and fewer than the
+    current limit are in flight. Returns the start time to pass to release().
+    """
+    global _in_flight, _waiting_threads
+    with _cond:
+        _waiting_threads += 1
+        try:
+            while True:
+                wait = _paused_until - time.monotonic()
+                if wait > 0:
+                    # Wake at slightly different times so the pool doesn't resume in lockstep
+                    _cond.wait(wait + random.uniform(0, PAUSE_JITTER))
+                    continue
+                if _in_flight < int(_limit):
+                    _in_flight += 1
+                    return time.monotonic()
+                _cond.wait()
+        finally:
+            _waiting_threads -= 1
+
+def acquire_async():
+    """
+    acquire() for coroutines: returns a future to await for the start time.
+    Slots free while threads are waiting go to the threads first, so a burst
+    of small uploads on the event loop can't starve the chunked uploads.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    with _cond:
+        _async_waiters.append((loop, future))
+        _grant_async()
+    return future
+
+def _grant_async():
+    """Hands free slots to waiting coroutines; called with _cond held."""
+    global _in_flight, _wake_timer
+    wait = _paused_until - time.monotonic()
+    if wait > 0:
+        if _async_waiters and _wake_timer is None:
+            _wake_timer = Timer(wait + random.uniform(0, PAUSE_JITTER), _wake_async)
+            _wake_timer.daemon = True
+            _wake_timer.start()
+        return
+    while _async_waiters and _in_flight + _waiting_threads < int(_limit):
+        loop, future = _async_waiters.popleft()
+        _in_flight += 1
+        loop.call_soon_threadsafe(_resolve, future, time.monotonic())
+
+def _wake_async():
+    global _wake_timer
+    with _cond:
+        _wake_timer = None
+        _grant_async()
+
+def _resolve(future, started):
+    global _in_flight
+    if not future.cancelled():
+        future.set_result(started)
+        return
+    # Nobody is waiting for this slot any more
+    with _cond:
+        _in_flight -= 1
+        _grant_async()
+        _cond.notify_all()
+
+def release(started, kind, status=None, retry_after=None):
+    """
+    Returns a slot and feeds the outcome back into the limit. status is the HTTP
+    status, or None if the request failed without a response.
+    """
+    global _in_flight, _limit
+    now = time.monotonic()
+    with _cond:
+        _in_flight -= 1
+        if status is None or status == 429 or status >= 500:
+            _decrease(started, retry_after, f"HTTP {status}" if status else "connection error")
+        elif _is_slow(kind, now - started):
+            _decrease(started, None, f"slow {kind} request ({now - started:.1f}s)")
+        elif status < 400:
+            _limit = min(MAX_LIMIT, _limit + 1 / _limit)
+        _grant_async()
+        _cond.notify_all()
+
+def throttle(retry_after=None):
+    """For throttling reported outside a request's own status, e.g. inside a $batch."""
+    with _cond:
+        _decrease(time.monotonic(), retry_after, "throttled batch request")
+        _cond.notify_all()
+
+def snapshot():
+    """Returns (limit, in_flight) for progress output."""
+    with _cond:
+        return int(_limit), _in_flight
+
+def _decrease(started, retry_after, reason):
+    global _limit, _paused_until, _last_decrease
+    now = time.monotonic()
+    if retry_after:
+        _paused_until = max(_paused_until, now + retry_after)
+        print(f"OneDrive asked us to back off: pausing all requests for {retry_after:.0f}s")
+    # Requests sent before the last cut were already in flight when it happened;
+    # their failures say nothing new, so only cut once per round
+    if started >= _last_decrease:
+        _limit = max(MIN_LIMIT, _limit * DECREASE_FACTOR)
+        _last_decrease = now
+        print(f"Concurrency limit lowered to {int(_limit)} ({reason})")
+
+def _is_slow(kind, seconds):
+    average, samples = _latency.get(kind, (seconds, 0))
+    # The average still moves towards slow samples, so a lasting slowdown becomes the new normal
+    _latency[kind] = (average + (seconds - average) * LATENCY_SMOOTHING, samples + 1)
+    return samples >= LATENCY_WARMUP and seconds > max(average * SLOW_FACTOR, SLOW_MIN_SECONDS)
+
+# -----------------------------
+# Backoff Helpers
+# -----------------------------
+def jittered(seconds):
+    """A delay between half and all of seconds, so retries don't synchronise."""
+    return random.uniform(seconds / 2, seconds)
+
+def parse_retry_after(value):
+    """Retry-After as seconds; it may be a number or an HTTP date. None if absent."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,454 @@
+import argparse
+import json
+import random
+import re
+import sys
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import quickxorhash
+
+# -----------------------------
+# Local Graph Stub
+# -----------------------------
+# Enough of the OneDrive API for onedrive_upload and onedrive_upload_v2 to run
+# against offline: folders, simple uploads, upload sessions (status, resume,
+# cancel), moves, copies, deletes, $batch and /delta. Content is hashed and
+# dropped rather than stored, unless STORE_CONTENT keeps it for downloads.
+# LATENCY adds a fixed delay to every request, standing in for the round trip
+# to Graph; THROTTLE_RATE and ERROR_RATE make that share of requests (and
+# $batch sub-requests) fail with 429 + Retry-After or 503.
+LATENCY = 0.0
+THROTTLE_RATE = 0.0
+ERROR_RATE = 0.0
+RETRY_AFTER = 1             # Seconds sent with injected 429s
+SESSION_STATUS = 202        # Status of a non-final chunk; old OneDrive endpoints answered 308
+HASH_CONTENT = True         # False skips quickXorHash of uploads, so the stub isn't the bottleneck
+SIMPLE_UPLOAD_LIMIT = 250 * 1024 * 1024  # Larger simple uploads are refused, as on OneDrive
+DELTA_PAGE_SIZE = 200
+STORE_CONTENT = False       # Keep uploaded bytes so GET .../content works (costs their size in memory)
+
+# Global variables
+items = {}     # id -> {'id', 'path', 'folder', 'size', 'quickxor', 'etag', 'changed'}
+paths = {}     # lower-cased path -> id; OneDrive paths are case-insensitive
+sessions = {}  # upload session id -> {'path', 'received', 'state', 'pending'}
+tombstones = {}     # id of a deleted item -> (change number, delta JSON)
+delta_pages = {}    # skip token -> (delta token for the last page, items still to send)
+copy_jobs = {}      # copy monitor id -> id of the new item (copies finish at once)
+request_counts = {}
+bytes_received = 0
+change_number = 0
+oldest_delta_token = 0  # Delta links from before this change answer 410, as expired ones do
+state_lock = Lock()
+
+def reset():
+    global bytes_received, change_number, oldest_delta_token
+    with state_lock:
+        items.clear()
+        paths.clear()
+        sessions.clear()
+        tombstones.clear()
+        delta_pages.clear()
+        copy_jobs.clear()
+        request_counts.clear()
+        bytes_received = 0
+        change_number = 0
+        oldest_delta_token = 0
+        _add_item('', folder=True, item_id='root')
+
+def expire_delta_links():
+    """Makes every delta link handed out so far answer 410 Gone, forcing a full resync."""
+    global change_number, oldest_delta_token
+    with state_lock:
+        change_number += 1
+        oldest_delta_token = change_number
+
+def _touch(item):
+    global change_number
+    change_number += 1
+    item['changed'] = change_number
+    item['etag'] = f'"{{{item["id"]}}},{change_number}"'
+
+def _add_item(path, folder=False, size=0, quickxor=None, item_id=None, content=None, file_system_info=None):
+    item_id = paths.get(path.lower()) or item_id or uuid.uuid4().hex
+    items[item_id] = {'id': item_id, 'path': path, 'folder': folder, 'size': size, 'quickxor': quickxor,
+                      'content': content if STORE_CONTENT else None, 'fileSystemInfo': file_system_info}
+    paths[path.lower()] = item_id
+    tombstones.pop(item_id, None)
+    _touch(items[item_id])
+    return _item_json(items[item_id])
+
+def _parent_path(path):
+    return path.rsplit('/', 1)[0] if '/' in path else ''
+
+def _item_json(item):
+    body = {'id': item['id'], 'name': item['path'].rsplit('/', 1)[-1], 'size': item['size'], 'eTag': item['etag']}
+    if item['id'] != 'root':
+        parent = _parent_path(item['path'])
+        body['parentReference'] = {'id': paths.get(parent.lower()), 'path': f'/drive/root:/{parent}'.rstrip('/')}
+    if item.get('fileSystemInfo'):
+        body['fileSystemInfo'] = item['fileSystemInfo']
+    if item['folder']:
+        body['folder'] = {}
+    else:
+        body['file'] = {'hashes': {'quickXorHash': item['quickxor']}}
+    return body
+
+def _add_parents(path):
+    parts = path.split('/')[:-1]
+    for i in range(1, len(parts) + 1):
+        if '/'.join(parts[:i]).lower() not in paths:
+            _add_item('/'.join(parts[:i]), folder=True)
+
+def _parent_exists(path):
+    return _parent_path(path).lower() in paths
+
+def _hash(state, data):
+    if not HASH_CONTENT:
+        return state
+    view = memoryview(data)
+    for start in range(0, len(view), quickxorhash.READ_SIZE):
+        state = quickxorhash.update(*state, view[start:start + quickxorhash.READ_SIZE])
+    return state
+
+def _fault():
+    """An injected failure for one request as (status, retry_after), or None."""
+    roll = random.random()
+    if roll < THROTTLE_RATE:
+        return 429, RETRY_AFTER
+    if roll < THROTTLE_RATE + ERROR_RATE:
+        return 503, None
+    return None
+
+def _fault_body(status):
+    code = 'activityLimitReached' if status == 429 else 'serviceNotAvailable'
+    return {'error': {'code': code, 'message': 'Injected by graph_stub'}}
+
+# -----------------------------
+# Request Handling
+# -----------------------------
+def dispatch(method, path, body, host):
+    """
+    Returns (status, json body or None), or (status, body, headers), for one
+    request; also used for $batch parts.
+    """
+    url = urlsplit(path)
+    path = unquote(url.path)
+    if path.startswith('/v1.0'):
+        path = path[len('/v1.0'):]
+    with state_lock:
+        request_counts[method] = request_counts.get(method, 0) + 1
+
+    if method == 'POST' and path == '/$batch':
+        responses = []
+        for sub in json.loads(body)['requests']:
+            fault = _fault()
+            if fault:
+                headers = {'Retry-After': str(fault[1])} if fault[1] else {}
+                responses.append({'id': sub['id'], 'status': fault[0], 'headers': headers,
+                                  'body': _fault_body(fault[0])})
+                continue
+            sub_body = json.dumps(sub['body']).encode() if sub.get('body') is not None else b''
+            status, sub_resp, *sub_headers = dispatch(sub['method'], sub['url'], sub_body, host)
+            responses.append({'id': sub['id'], 'status': status, 'headers': sub_headers[0] if sub_headers else {},
+                              'body': sub_resp})
+        return 200, {'responses': responses}
+
+    with state_lock:
+        if method == 'GET' and path == '/me/drive/root':
+            return 200, _item_json(items['root'])
+        m = re.fullmatch(r'/me/drive/(?:items/([^/]+)|root)/delta', path)
+        if method == 'GET' and m:
+            return _delta(m.group(1) or 'root', parse_qs(url.query), host)
+        m = re.fullmatch(r'/me/drive/root:/(.+?):?', path)
+        if method in ('GET', 'PATCH') and m:
+            item_id = paths.get(m.group(1).strip('/').lower())
+            if item_id is None:
+                return 404, {'error': {'code': 'itemNotFound'}}
+            return (200, _item_json(items[item_id])) if method == 'GET' else _patch_item(items[item_id], body)
+
+        m = re.fullmatch(r'/me/drive/root(?::/(.+):)?/children', path)
+        if method == 'POST' and m:
+            parent = (m.group(1) or '').strip('/')
+            if parent.lower() not in paths:
+                return 404, {'error': {'code': 'itemNotFound'}}
+            request = json.loads(body)
+            new_path = f"{parent}/{request['name']}" if parent else request['name']
+            if new_path.lower() in paths and request.get('@microsoft.graph.conflictBehavior') == 'fail':
+                return 409, {'error': {'code': 'nameAlreadyExists'}}
+            return 201, _add_item(new_path, folder=True)
+
+        m = re.fullmatch(r'/me/drive/root:/(.+):/content', path)
+        if method == 'PUT' and m:
+            _add_parents(m.group(1).strip('/'))  # Like OneDrive, uploads create missing folders
+            quickxor = quickxorhash.digest(*_hash((0, 0), body)) if HASH_CONTENT else None
+            return 201, _add_item(m.group(1).strip('/'), size=len(body), quickxor=quickxor, content=body)
+
+        m = re.fullmatch(r'/me/drive/root:/(.+):/createUploadSession', path)
+        if method == 'POST' and m:
+            session_id = uuid.uuid4().hex
+            file_system_info = json.loads(body or b'{}').get('item', {}).get('fileSystemInfo')
+            sessions[session_id] = {'path': m.group(1).strip('/'), 'received': 0, 'state': (0, 0), 'pending': {},
+                                    'fileSystemInfo': file_system_info}
+            return 200, {'uploadUrl': f'http://{host}/upload/{session_id}',
+                         'expirationDateTime': '2099-01-01T00:00:00Z', 'nextExpectedRanges': ['0-']}
+
+        m = re.fullmatch(r'/me/drive/items/([^/]+)/copy', path)
+        if method == 'POST' and m:
+            return _copy_item(m.group(1), json.loads(body or b'{}'), parse_qs(url.query), host)
+
+        m = re.fullmatch(r'/me/drive/items/([^/]+)', path)
+        if m and m.group(1) not in items:
+            return 404, {'error': {'code': 'itemNotFound'}}
+        if method == 'GET' and m:
+            return 200, _item_json(items[m.group(1)])
+        m_content = re.fullmatch(r'/me/drive/items/([^/]+)/content', path)
+        if method == 'GET' and m_content:
+            item = items.get(m_content.group(1))
+            if item is None or item['folder']:
+                return 404, {'error': {'code': 'itemNotFound'}}
+            if item['content'] is None:
+                return 400, {'error': {'code': 'invalidRequest', 'message': 'Content not kept (STORE_CONTENT)'}}
+            return 200, item['content']
+        if method == 'PATCH' and m:
+            return _patch_item(items[m.group(1)], body)
+        if method == 'DELETE' and m:
+            _delete_item(items[m.group(1)])
+            return 204, None
+
+    return 400, {'error': {'code': 'invalidRequest', 'message': f'{method} {path} is not supported by the stub'}}
+
+def _patch_item(item, body):
+    """A PATCH of an item addressed by id or by path: move/rename and/or new fileSystemInfo."""
+    request = json.loads(body or b'{}')
+    if 'parentReference' in request or 'name' in request:
+        parent = request.get('parentReference', {}).get('path', '').split('root:', 1)[-1].strip('/')
+        new_path = '/'.join(p for p in (parent, request.get('name', item['path'].rsplit('/', 1)[-1])) if p)
+        if not _parent_exists(new_path):
+            return 404, {'error': {'code': 'itemNotFound'}}
+        if new_path.lower() in paths and paths[new_path.lower()] != item['id']:
+            return 409, {'error': {'code': 'nameAlreadyExists'}}
+        _move_item(item, new_path)
+    if 'fileSystemInfo' in request:
+        item['fileSystemInfo'] = request['fileSystemInfo']
+    _touch(item)
+    return 200, _item_json(item)
+
+def _move_item(item, new_path):
+    # Like OneDrive's delta, only the moved item itself is reported as changed
+    old_prefix = item['path'].lower() + '/'
+    for other in items.values():
+        if other['path'].lower().startswith(old_prefix):
+            del paths[other['path'].lower()]
+            other['path'] = new_path + other['path'][len(old_prefix) - 1:]
+            paths[other['path'].lower()] = other['id']
+    del paths[item['path'].lower()]
+    item['path'] = new_path
+    paths[new_path.lower()] = item['id']
+
+def _copy_item(item_id, request, query, host):
+    """Copies a file; like OneDrive, answers 202 with a monitor URL to poll in Location."""
+    item = items.get(item_id)
+    if item is None or item['folder']:
+        return 404, {'error': {'code': 'itemNotFound'}}
+    parent = request.get('parentReference', {}).get('path', '').split('root:', 1)[-1].strip('/')
+    new_path = '/'.join(p for p in (parent, request.get('name', item['path'].rsplit('/', 1)[-1])) if p)
+    if not _parent_exists(new_path):
+        return 404, {'error': {'code': 'itemNotFound'}}
+    if new_path.lower() in paths and query.get('@microsoft.graph.conflictBehavior') != ['replace']:
+        return 409, {'error': {'code': 'nameAlreadyExists'}}
+    job_id = uuid.uuid4().hex
+    copy_jobs[job_id] = _add_item(new_path, size=item['size'], quickxor=item['quickxor'], content=item['content'])['id']
+    return 202, None, {'Location': f'http://{host}/monitor/{job_id}'}
+
+def monitor_request(job_id):
+    """A poll of a copy's monitor URL (these carry no Authorization header)."""
+    with state_lock:
+        request_counts['GET'] = request_counts.get('GET', 0) + 1
+        if job_id not in copy_jobs:
+            return 404, {'error': {'code': 'itemNotFound'}}
+        return 200, {'status': 'completed', 'percentageComplete': 100.0, 'resourceId': copy_jobs[job_id]}
+
+def _delete_item(item):
+    global change_number
+    prefix = item['path'].lower() + '/'
+    for other in [i for i in items.values() if i is item or i['path'].lower().startswith(prefix)]:
+        change_number += 1
+        body = _item_json(other)
+        body['deleted'] = {'state': 'deleted'}
+        tombstones[other['id']] = (change_number, body)
+        del items[other['id']]
+        paths.pop(other['path'].lower(), None)
+
+def _delta(item_id, query, host):
+    """
+    One page of /delta under item_id. Without a token every item is listed,
+    parents first; with one, whatever changed or was deleted since, in order.
+    """
+    base = f'http://{host}/v1.0/me/drive/items/{item_id}/delta'
+    if 'skiptoken' in query:
+        page = delta_pages.pop(query['skiptoken'][0], None)
+        if page is None:
+            return 410, {'error': {'code': 'resyncRequired'}}
+        token, pending = page
+    else:
+        token = change_number
+        if item_id not in items:
+            return 404, {'error': {'code': 'itemNotFound'}}
+        if 'token' in query:
+            since = int(query['token'][0])
+            if since < oldest_delta_token:
+                return 410, {'error': {'code': 'resyncChangesApplyDifferences'}}
+        else:
+            since = None
+        prefix = items[item_id]['path'].lower() + '/' if item_id != 'root' else ''
+        under = [i for i in items.values()
+                 if i['id'] == item_id or i['path'].lower().startswith(prefix)]
+        if since is None:
+            pending = [_item_json(i) for i in sorted(under, key=lambda i: i['path'].count('/'))]
+        else:
+            changed = [(i['changed'], _item_json(i)) for i in under if i['changed'] > since]
+            # Deleted items have no path any more; report every tombstone since the token
+            changed += [entry for entry in tombstones.values() if entry[0] > since]
+            pending = [body for _, body in sorted(changed, key=lambda entry: entry[0])]
+    page, pending = pending[:DELTA_PAGE_SIZE], pending[DELTA_PAGE_SIZE:]
+    if pending:
+        skip_token = uuid.uuid4().hex
+        delta_pages[skip_token] = (token, pending)
+        return 200, {'value': page, '@odata.nextLink': f'{base}?skiptoken={skip_token}'}
+    return 200, {'value': page, '@odata.deltaLink': f'{base}?token={token}'}
+
+def upload_session_request(method, session_id, headers, body):
+    """A request to an upload session URL (these carry no Authorization header)."""
+    with state_lock:
+        request_counts[method] = request_counts.get(method, 0) + 1
+        session = sessions.get(session_id)
+        if session is None:
+            return 404, {'error': {'code': 'itemNotFound'}}
+        if method == 'DELETE':
+            del sessions[session_id]
+            return 204, None
+        if method == 'GET':
+            return 200, _session_status(session)
+        start, end, total = map(int, re.fullmatch(r'bytes (\d+)-(\d+)/(\d+)', headers['Content-Range']).groups())
+        if end - start + 1 != len(body):
+            return 400, {'error': {'code': 'invalidRange'}}
+        if start < session['received'] or start in session['pending']:
+            return 416, {'error': {'code': 'invalidRange', 'message': 'Range already received'}}
+        # Chunks may arrive out of order; hash them once the bytes before them are in
+        session['pending'][start] = body
+        while session['received'] in session['pending']:
+            chunk = session['pending'].pop(session['received'])
+            session['state'] = _hash(session['state'], chunk)
+            session['received'] += len(chunk)
+            if STORE_CONTENT:
+                session.setdefault('content', []).append(chunk)
+        if session['received'] < total:
+            return SESSION_STATUS, _session_status(session)
+        del sessions[session_id]
+        _add_parents(session['path'])
+        quickxor = quickxorhash.digest(*session['state']) if HASH_CONTENT else None
+        return 201, _add_item(session['path'], size=total, quickxor=quickxor,
+                              content=b''.join(session.get('content', [])), file_system_info=session['fileSystemInfo'])
+
+def _session_status(session):
+    """nextExpectedRanges: the gaps between what has been received in order and chunks held back."""
+    ranges = []
+    position = session['received']
+    for start in sorted(session['pending']):
+        if start > position:
+            ranges.append(f'{position}-{start - 1}')
+        position = start + len(session['pending'][start])
+    ranges.append(f'{position}-')
+    return {'expirationDateTime': '2099-01-01T00:00:00Z', 'nextExpectedRanges': ranges}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'      # Keep-alive, like the real service
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_any(self):
+        global bytes_received
+        length = int(self.headers.get('Content-Length') or 0)
+        if self.command == 'PUT' and self.path.endswith(':/content') and length > SIMPLE_UPLOAD_LIMIT:
+            self.close_connection = True  # The body is never read
+            return self.reply(413, {'error': {'code': 'requestEntityTooLarge'}})
+        body = self.rfile.read(length) if length else b''
+        with state_lock:
+            bytes_received += length
+        if LATENCY:
+            time.sleep(LATENCY)
+        fault = _fault() if not self.path.endswith('/$batch') else None
+        if fault:
+            # Counted like any other request, so injected failures show up in request totals
+            with state_lock:
+                request_counts[self.command] = request_counts.get(self.command, 0) + 1
+            return self.reply(fault[0], _fault_body(fault[0]), retry_after=fault[1])
+        headers = {}
+        if self.path.startswith('/upload/'):
+            status, resp = upload_session_request(self.command, self.path.split('/')[2], self.headers, body)
+        elif self.path.startswith('/monitor/'):
+            status, resp = monitor_request(self.path.split('/')[2])
+        else:
+            status, resp, *extra = dispatch(self.command, self.path, body, self.headers['Host'])
+            headers = extra[0] if extra else {}
+        self.reply(status, resp, headers=headers)
+
+    def reply(self, status, resp, retry_after=None, headers=None):
+        if isinstance(resp, bytes):
+            data, content_type = resp, 'application/octet-stream'
+        else:
+            data, content_type = json.dumps(resp).encode() if resp is not None else b'', 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if retry_after:
+            self.send_header('Retry-After', str(retry_after))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_any
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # Hundreds of connections arrive at once from the async engine
+
+    def handle_error(self, request, client_address):
+        # A client exiting with keep-alive connections open resets them; that's not a stub error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+def start(port=0):
+    """Starts the stub on a background thread; returns (server, base URL for GRAPH_URL)."""
+    reset()
+    server = StubServer(('127.0.0.1', port), StubHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}/v1.0'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for the OneDrive Graph API.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered 429')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 503')
+    parser.add_argument('--session-status', type=int, choices=[202, 308], default=SESSION_STATUS,
+                        help='status of non-final upload session chunks')
+    args = parser.parse_args()
+    LATENCY = args.latency
+    THROTTLE_RATE = args.throttle_rate
+    ERROR_RATE = args.error_rate
+    SESSION_STATUS = args.session_status
+    server, url = start(args.port)
+    print(f"Graph stub listening; run onedrive_upload_v2 or onedrive_upload with GRAPH_URL={url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
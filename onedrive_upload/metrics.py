@@ -0,0 +1,211 @@
+import json
+import os
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# -----------------------------
+# Configuration & Constants
+# -----------------------------
+# In-process counters, gauges and histograms for the uploader. Series are a
+# name plus labels, e.g. observe('graph_request_seconds', 0.2, endpoint='batch').
+# They can be scraped as Prometheus text, written out as JSON snapshots, and
+# summed up at the end of a run.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # Upper bounds, in seconds
+
+# Global variables
+_lock = Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_gauges = {}      # (name, labels) -> function returning the current value
+_counter_reads = {}  # (name, labels) -> function returning a running total kept elsewhere
+_started = time.monotonic()
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+# -----------------------------
+# Recording
+# -----------------------------
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        hist[bisect_left(BUCKETS, seconds)] += 1
+        hist[-1] += seconds
+
+def register_gauge(name, read, **labels):
+    """read() is called whenever metrics are collected; registering the same series again replaces it."""
+    with _lock:
+        _gauges[_key(name, labels)] = read
+
+def register_counter(name, read, **labels):
+    """Like register_gauge(), for a total that only goes up and is kept elsewhere; it is exported as a counter."""
+    with _lock:
+        _counter_reads[_key(name, labels)] = read
+
+def reset():
+    global _started
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _started = time.monotonic()
+
+# -----------------------------
+# Collection
+# -----------------------------
+def _read(registry):
+    """Calls each read function of a registry (gauges or counters kept elsewhere)."""
+    with _lock:
+        reads = list(registry.items())
+    values = {}
+    for key, read in reads:
+        try:
+            values[key] = read()
+        except Exception:
+            continue  # The object behind it has gone away
+    return values
+
+def _labels_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}' if pairs else ''
+
+def prometheus_text():
+    """All series in the Prometheus text exposition format."""
+    gauges = _read(_gauges)
+    counters = _read(_counter_reads)
+    with _lock:
+        counters.update(_counters)
+        histograms = {key: list(hist) for key, hist in _histograms.items()}
+    lines = []
+    typed = set()
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+    for (name, labels), value in sorted(counters.items()):
+        type_line(name, 'counter')
+        lines.append(f'{name}{_labels_text(labels)} {value}')
+    for (name, labels), value in sorted(gauges.items()):
+        type_line(name, 'gauge')
+        lines.append(f'{name}{_labels_text(labels)} {value}')
+    for (name, labels), hist in sorted(histograms.items()):
+        type_line(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(list(BUCKETS) + ['+Inf'], hist[:-1]):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels_text(labels, [("le", bound)])} {cumulative}')
+        lines.append(f'{name}_sum{_labels_text(labels)} {hist[-1]}')
+        lines.append(f'{name}_count{_labels_text(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    """A JSON-serialisable view: counters and gauges by series, histograms as count/sum/p50/p95/p99."""
+    gauges = _read(_gauges)
+    counters = _read(_counter_reads)
+    with _lock:
+        counters.update(_counters)
+        histograms = {key: list(hist) for key, hist in _histograms.items()}
+        uptime = time.monotonic() - _started
+    def series(key):
+        name, labels = key
+        return name + _labels_text(labels)
+    return {
+        'time': time.time(),
+        'uptime_seconds': uptime,
+        'counters': {series(key): value for key, value in sorted(counters.items())},
+        'gauges': {series(key): value for key, value in sorted(gauges.items())},
+        'histograms': {series(key): {'count': sum(hist[:-1]), 'sum': hist[-1], 'p50': _quantile(hist, 0.5),
+                                     'p95': _quantile(hist, 0.95), 'p99': _quantile(hist, 0.99)}
+                       for key, hist in sorted(histograms.items())},
+    }
+
+def _quantile(hist, q):
+    """Upper bound of the bucket holding the q-th observation (None past the last bucket)."""
+    total = sum(hist[:-1])
+    if not total:
+        return None
+    cumulative = 0
+    for bound, count in zip(BUCKETS, hist):
+        cumulative += count
+        if cumulative >= q * total:
+            return bound
+    return None
+
+def counter_total(name, **match):
+    """Sum of a counter over every series whose labels include match."""
+    counters = _read(_counter_reads)
+    with _lock:
+        counters.update(_counters)
+    return sum(value for (n, labels), value in counters.items()
+               if n == name and all(pair in labels for pair in match.items()))
+
+# -----------------------------
+# Export
+# -----------------------------
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics.json':
+            body, content_type = json.dumps(snapshot()).encode(), 'application/json'
+        else:
+            body, content_type = prometheus_text().encode(), 'text/plain; version=0.0.4'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_http_server(port, host='127.0.0.1'):
+    """Serves /metrics (Prometheus text) and /metrics.json from a background thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics at http://{host}:{server.server_port}/metrics")
+    return server
+
+def start_json_writer(path, interval):
+    """Rewrites path with a fresh snapshot() every interval seconds."""
+    def write_loop():
+        while True:
+            time.sleep(interval)
+            write_json(path)
+    Thread(target=write_loop, daemon=True).start()
+
+def write_json(path):
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(snapshot(), f, indent=4)
+    os.replace(temp_file, path)
+
+def summary():
+    """End-of-run report: where the time went, as lines of text."""
+    snap = snapshot()
+    uptime = snap['uptime_seconds']
+    lines = [f"Run summary ({uptime:.1f}s):"]
+    scanned = counter_total('files_scanned_total')
+    scan_seconds = sum(hist['sum'] for series, hist in snap['histograms'].items() if series == 'scan_seconds')
+    lines.append(f"  Scanned {scanned} files ({scanned / scan_seconds if scan_seconds else 0:.0f}/s); "
+                 f"uploaded {counter_total('files_uploaded_total')}, copied {counter_total('files_copied_total')}, "
+                 f"moved {counter_total('files_moved_total')}, failed {counter_total('files_failed_total')}")
+    lines.append(f"  Requests: {counter_total('graph_requests_total')}, retries "
+                 f"{counter_total('graph_retries_total')}, throttled {counter_total('graph_throttled_total')}; "
+                 f"sent {counter_total('upload_bytes_sent_total') / 1024 / 1024:.1f} MB")
+    for series, hist in snap['histograms'].items():
+        if hist['count']:
+            p95 = f"{hist['p95']}s" if hist['p95'] is not None else f">{BUCKETS[-1]}s"
+            lines.append(f"  {series}: {hist['count']} x avg {hist['sum'] / hist['count']:.3f}s, p95 <= {p95}")
+    for series, value in snap['gauges'].items():
+        if value:  # Queues that have drained by now say nothing
+            lines.append(f"  {series}: {value:,.0f}")
+    return '\n'.join(lines)
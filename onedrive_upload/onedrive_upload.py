@@ -1,172 +1,387 @@
 import os
 import hashlib
 import json
+import sqlite3
+import time
 import requests
-import msal
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from collections import deque
+from threading import Condition, Lock, Thread
 from dotenv import load_dotenv
 
+import auth
+import bandwidth
+import quickxorhash
+
 # List of folder paths to monitor and sync
 folders_to_monitor = [
 	r'C:\GEO\projects\Python Projects\onedrive_upload\test1',
 	r'C:\GEO\projects\Python Projects\onedrive_upload\test2'
 ]
 
-metadata_file = 'file_metadata.json'
-
-	load_dotenv(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'creds.env'))
-	CLIENT_ID = os.getenv('CLIENT_ID')
-	AUTHORITY_URL = f'https://login.microsoftonline.com/consumers'
+metadata_file = 'file_metadata.json'  # Flat state of older versions, imported into database_file once
+database_file = 'sync_roots.db'  # Per-root state: one row per (root, relative path)
+folder_cache_file = 'onedrive_folders.json'
+token_cache_file = 'token_cache.bin'
+known_folders = set()
+state_db = None  # Connection to database_file while a sync runs
+db_lock = Lock()
+max_workers = 8  # Upload threads shared by all roots
+bandwidth_schedule = []  # Upload rate limits shared by all roots, see bandwidth.SCHEDULE
+dedupe_min_size = 1024 * 1024  # Files this big whose content is already on OneDrive are copied there, not uploaded
+copy_timeout = 60  # Seconds to wait for OneDrive to finish a copy before uploading instead
+uploaded_content = {}  # hash -> item ID of content uploaded this run, before it is saved to the database
+changed_items = set()  # Item IDs whose local file changed this run, so their stored hash is no longer a copy source
+
+load_dotenv(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'creds.env'))
+CLIENT_ID = os.getenv('CLIENT_ID')
+AUTHORITY_URL = 'https://login.microsoftonline.com/consumers'
+GRAPH_URL = os.getenv('GRAPH_URL', 'https://graph.microsoft.com/v1.0')  # Overridden to benchmark against graph_stub
 SCOPES = ['User.Read', 'Files.ReadWrite']
+HASH_READ_SIZE = 1024 * 1024
 
 # Helper to calculate a file's hash (e.g., SHA-256)
 def calculate_file_hash(file_path):
 	sha256_hash = hashlib.sha256()
 	with open(file_path, "rb") as f:
-		for byte_block in iter(lambda: f.read(4096), b""):
+		for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
 			sha256_hash.update(byte_block)
 	return sha256_hash.hexdigest()
 
-# Load metadata from previous sync
+# Load metadata written by older versions (a single dict keyed by relative path)
 def load_metadata():
 	if os.path.exists(metadata_file):
 		with open(metadata_file, 'r') as f:
 			return json.load(f)
 	return {}
 
-# Save metadata after sync
-def save_metadata(metadata):
-	with open(metadata_file, 'w') as f:
-		json.dump(metadata, f, indent=4)
-
-# Get file metadata (hash, last modified time)
-def get_file_metadata(file_path):
+# Load/save the OneDrive folders already known to exist
+def load_folder_cache():
+	if os.path.exists(folder_cache_file):
+		with open(folder_cache_file, 'r') as f:
+			known_folders.update(json.load(f))
+
+def save_folder_cache():
+	with open(folder_cache_file, 'w') as f:
+		json.dump(sorted(known_folders), f, indent=4)
+
+# Get file metadata (hash, last modified time); the previous hash is reused if the file wasn't modified
+def get_file_metadata(file_path, prev_data=None):
+	last_modified = os.path.getmtime(file_path)
+	if prev_data and prev_data.get('last_modified') == last_modified:
+		return {'hash': prev_data['hash'], 'last_modified': last_modified}
 	return {
 		'hash': calculate_file_hash(file_path),
-		'last_modified': os.path.getmtime(file_path)
+		'last_modified': last_modified
 	}
 
 
+# Tokens come from the MSAL cache in token_cache_file; a browser opens only when it has none
 def get_access_token():
-    app = msal.PublicClientApplication(CLIENT_ID, authority=AUTHORITY_URL)
-    
-    # Try to acquire token silently from cache
-    accounts = app.get_accounts()
-    if accounts:
-        token_response = app.acquire_token_silent(SCOPES, account=accounts[0])
-        if token_response:
-            return token_response['access_token']
-    
-    # If no token is found or silent acquisition fails, prompt interactive login
-    token_response = app.acquire_token_interactive(SCOPES)
-    if 'access_token' in token_response:
-        return token_response['access_token']
-    
-    raise Exception(f"Could not obtain access token: {token_response}")
-
-# Compare current state with previous metadata for all folders
-# Compare current state with previous metadata for all folders
-def initial_sync():
+    auth.configure(CLIENT_ID, AUTHORITY_URL, SCOPES, token_cache_file)
+    return auth.get_access_token()
+
+# Per-root sync state. Each root's rows are keyed by its absolute path, so the same
+# relative path under two roots no longer overwrites one record
+def open_state_db():
+    conn = sqlite3.connect(database_file, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS root_files (
+            root TEXT NOT NULL,
+            relative_path TEXT NOT NULL,
+            item_id TEXT,
+            hash TEXT NOT NULL,
+            last_modified REAL NOT NULL,
+            PRIMARY KEY (root, relative_path)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS root_files_hash ON root_files (hash)')
+    conn.commit()
+    return conn
+
+def root_key(folder):
+    return os.path.normcase(os.path.abspath(folder))
+
+def load_root_metadata(conn, folder):
+    with db_lock:
+        rows = conn.execute('SELECT relative_path, item_id, hash, last_modified FROM root_files WHERE root = ?',
+                            (root_key(folder),)).fetchall()
+    return {path: {'item_id': item_id, 'hash': file_hash, 'last_modified': last_modified}
+            for path, item_id, file_hash, last_modified in rows}
+
+def save_root_metadata(conn, folder, metadata):
+    root = root_key(folder)
+    with db_lock, conn:
+        conn.execute('DELETE FROM root_files WHERE root = ?', (root,))
+        conn.executemany('INSERT INTO root_files VALUES (?, ?, ?, ?, ?)',
+                         [(root, path, data['item_id'], data['hash'], data['last_modified'])
+                          for path, data in metadata.items()])
+
+# An item already holding this content, from any root, or None. Items whose file was
+# edited this run are skipped: their stored hash is the old content's, which is being replaced
+def find_copy_source(file_hash):
+    with db_lock:
+        item_id = uploaded_content.get(file_hash)
+        if item_id:
+            return item_id
+        rows = state_db.execute('SELECT item_id FROM root_files WHERE hash = ? AND item_id IS NOT NULL',
+                                (file_hash,)).fetchall()
+        return next((item_id for item_id, in rows if item_id not in changed_items), None)
+
+# Import file_metadata.json. Its keys carry no root, so an entry is only kept when
+# exactly one root has that path; ambiguous ones are re-uploaded on this run
+def migrate_metadata_file(conn):
+    if not os.path.exists(metadata_file):
+        return
+    migrated = {folder: {} for folder in folders_to_monitor}
+    for relative_path, data in load_metadata().items():
+        owners = [folder for folder in folders_to_monitor if os.path.exists(os.path.join(folder, relative_path))]
+        if len(owners) == 1:
+            migrated[owners[0]][relative_path] = data
+    for folder, metadata in migrated.items():
+        save_root_metadata(conn, folder, metadata)
+    os.replace(metadata_file, metadata_file + '.migrated')
+    print(f"Imported {sum(map(len, migrated.values()))} entries from {metadata_file}")
+
+# Work from all roots goes through one pool of max_workers threads. Each root has its
+# own queue and the workers take from the roots in turn, so a root with a million
+# pending files gets the same share of the pool as one with ten while both have work
+class RootScheduler:
+    def __init__(self):
+        self._cond = Condition()
+        self._queues = {}     # root -> deque of tasks
+        self._turns = deque() # Roots with queued tasks, in the order they are served
+        self._pending = {}    # root -> tasks queued or running
+        self._closed = False
+
+    def put(self, root, task):
+        with self._cond:
+            queue = self._queues.setdefault(root, deque())
+            if not queue:
+                self._turns.append(root)
+            queue.append(task)
+            self._pending[root] = self._pending.get(root, 0) + 1
+            self._cond.notify()
+
+    def get(self):
+        # Returns (root, task), or None once closed
+        with self._cond:
+            while not self._turns:
+                if self._closed:
+                    return None
+                self._cond.wait()
+            root = self._turns.popleft()
+            queue = self._queues[root]
+            task = queue.popleft()
+            if queue:
+                self._turns.append(root)
+            return root, task
+
+    def done(self, root):
+        with self._cond:
+            self._pending[root] -= 1
+            self._cond.notify_all()
+
+    def join(self, root):
+        # Waits until every task put for root has finished
+        with self._cond:
+            while self._pending.get(root):
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+def worker_loop(scheduler):
+    while True:
+        entry = scheduler.get()
+        if entry is None:
+            return
+        root, task = entry
+        try:
+            task()
+        except Exception as e:
+            print(f"Error syncing a file in {root}: {e}")
+        finally:
+            scheduler.done(root)
+
+# Compare one file with its previous state and upload, move or keep it.
+# state is shared by the root's tasks: the vanished-file index and the new metadata
+def sync_file(folder_name, relative_path, file_path, previous_metadata, state):
     access_token = get_access_token()
-    current_metadata = {}
-
-    # Load the last known state
-    previous_metadata = load_metadata()
-
-    # Iterate over all folders to monitor
-    for folder_to_monitor in folders_to_monitor:
-        folder_name = os.path.basename(folder_to_monitor)  # Get the folder name (e.g., 'test1', 'test2')
-
-        # Walk through the current directory
-        for root, dirs, files in os.walk(folder_to_monitor):
-            for file in files:
-                file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(file_path, folder_to_monitor).replace('\\', '/')
-
-                # Construct the OneDrive path with the folder name
-                onedrive_relative_path = f"{folder_name}/{relative_path}"
-
-                # Calculate current file hash and last modified time
-                current_file_data = get_file_metadata(file_path)
-
-                # Check if the file is in previous metadata (possible rename or new file)
-                found_match = False
-                for prev_path, prev_data in previous_metadata.items():
-                    if current_file_data['hash'] == prev_data['hash']:
-                        # File with same hash found but different path -> Renamed or moved
-                        if prev_path != relative_path:
-                            print(f"File moved or renamed from {prev_path} to {relative_path}")
-                            # Try renaming the file on OneDrive
-                            if not rename_file_on_onedrive(prev_data['item_id'], relative_path, access_token):
-                                # If renaming fails (invalid item ID), re-upload the file
-                                upload_path = f"{folder_name}/{relative_path}"
-                                upload_file_to_onedrive(file_path, upload_path, access_token)
-                            # Update the path in current metadata
-                            current_metadata[relative_path] = prev_data
-                        found_match = True
-                        break
-
-                if not found_match:
-                    # New file detected (no matching hash found)
-                    print(f"New file detected: {relative_path}")
-                    # Upload the new file to the corresponding folder on OneDrive
-                    upload_path = f"{folder_name}/{relative_path}"
-                    upload_file_to_onedrive(file_path, upload_path, access_token)
-                    current_metadata[relative_path] = {
-                        'item_id': 'new_onedrive_item_id',  # Replace with actual OneDrive item ID
-                        'hash': current_file_data['hash'],
-                        'last_modified': current_file_data['last_modified']
-                    }
+    # Construct the OneDrive path with the folder name
+    upload_path = f"{folder_name}/{relative_path}"
+    prev_data = previous_metadata.get(relative_path)
+    current_file_data = get_file_metadata(file_path, prev_data)
+    current_metadata = state['metadata']
+
+    if prev_data and prev_data['hash'] == current_file_data['hash']:
+        # Unchanged content
+        current_metadata[relative_path] = dict(prev_data, last_modified=current_file_data['last_modified'])
+        return
+
+    prev_path = None
+    if not prev_data:
+        with state['lock']:
+            candidates = state['vanished_by_hash'].get(current_file_data['hash'])
+            if candidates:
+                prev_path = candidates.pop()
+                state['moved_paths'].add(prev_path)
+    if prev_path:
+        # File with same hash found at a path that no longer exists -> Renamed or moved
+        old_item_id = previous_metadata[prev_path]['item_id']
+        print(f"File moved or renamed from {prev_path} to {relative_path}")
+        if rename_file_on_onedrive(old_item_id, upload_path, access_token):
+            item_id = old_item_id
+        else:
+            # If renaming fails (invalid item ID), re-upload the file and drop the old copy
+            item_id = upload_file_to_onedrive(file_path, upload_path, access_token, current_file_data['hash'])
+            if item_id:
+                delete_file_from_onedrive(old_item_id, prev_path, access_token)
+            else:
+                # Keep the old record so the move is retried next run
+                current_metadata[prev_path] = previous_metadata[prev_path]
+                return
+    else:
+        print(f"{'Modified' if prev_data else 'New'} file detected: {folder_name}/{relative_path}")
+        item_id = upload_file_to_onedrive(file_path, upload_path, access_token, current_file_data['hash'])
+        if not item_id:
+            if prev_data:
+                current_metadata[relative_path] = prev_data  # Retry next run
+            return
+
+    current_metadata[relative_path] = {
+        'item_id': item_id,
+        'hash': current_file_data['hash'],
+        'last_modified': current_file_data['last_modified']
+    }
+
+# Scan one root, queue its files, then its deletions once every move has been matched
+def sync_root(folder_to_monitor, scheduler, conn):
+    folder_name = os.path.basename(folder_to_monitor)  # Get the folder name (e.g., 'test1', 'test2')
+    previous_metadata = load_root_metadata(conn, folder_to_monitor)
+
+    # Walk the root first so we know which previous paths are gone, and which items
+    # may be overwritten with new content before another file could be copied from them
+    current_files = {}
+    changed = []
+    for root, dirs, files in os.walk(folder_to_monitor):
+        for file in files:
+            file_path = os.path.join(root, file)
+            relative_path = os.path.relpath(file_path, folder_to_monitor).replace('\\', '/')
+            current_files[relative_path] = file_path
+            prev_data = previous_metadata.get(relative_path)
+            if prev_data and os.path.getmtime(file_path) != prev_data['last_modified']:
+                changed.append(prev_data['item_id'])
+    with db_lock:
+        changed_items.update(changed)
+
+    # Index vanished files by hash so a new file with the same content is matched
+    # to its old location in O(1) instead of scanning all previous metadata
+    vanished_by_hash = {}
+    for prev_path, prev_data in previous_metadata.items():
+        if prev_path not in current_files:
+            vanished_by_hash.setdefault(prev_data['hash'], []).append(prev_path)
+    state = {'metadata': {}, 'vanished_by_hash': vanished_by_hash, 'moved_paths': set(), 'lock': Lock()}
+
+    for relative_path, file_path in current_files.items():
+        scheduler.put(folder_to_monitor, lambda relative_path=relative_path, file_path=file_path:
+                      sync_file(folder_name, relative_path, file_path, previous_metadata, state))
+    scheduler.join(folder_to_monitor)
 
     # Detect deleted files
     for prev_path, prev_data in previous_metadata.items():
-        if prev_path not in current_metadata:
-            print(f"File deleted: {prev_path}")
+        if prev_path not in current_files and prev_path not in state['moved_paths']:
+            print(f"File deleted: {folder_name}/{prev_path}")
             # Attempt to delete the file using the stored item ID, skip if invalid
-            delete_file_from_onedrive(prev_data['item_id'], prev_path, access_token)
+            scheduler.put(folder_to_monitor, lambda item_id=prev_data['item_id'], prev_path=prev_path:
+                          delete_file_from_onedrive(item_id, prev_path, get_access_token()))
+    scheduler.join(folder_to_monitor)
 
     # Save the updated metadata
-    save_metadata(current_metadata)
+    save_root_metadata(conn, folder_to_monitor, state['metadata'])
+    print(f"Synced {folder_to_monitor}: {len(current_files)} files")
+
+# Sync all monitored folders at once: one scanning thread per root, uploads shared
+# by the worker pool and the bandwidth budget
+def initial_sync():
+    names = [os.path.basename(folder) for folder in folders_to_monitor]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Monitored folders share a OneDrive folder name: {', '.join(duplicates)}")
+
+    global state_db
+    get_access_token()  # Sign in before the threads start
+    bandwidth.SCHEDULE = bandwidth_schedule
+    conn = state_db = open_state_db()
+    migrate_metadata_file(conn)
+    load_folder_cache()
+
+    scheduler = RootScheduler()
+    workers = [Thread(target=worker_loop, args=(scheduler,), daemon=True) for _ in range(max_workers)]
+    scanners = [Thread(target=sync_root, args=(folder, scheduler, conn)) for folder in folders_to_monitor]
+    for thread in workers + scanners:
+        thread.start()
+    for thread in scanners:
+        thread.join()
+    scheduler.close()
+    for thread in workers:
+        thread.join()
+
+    save_folder_cache()
+    uploaded_content.clear()
+    changed_items.clear()
+    state_db = None
+    conn.close()
 
-	
 # OneDrive helper functions to upload, delete, and rename files
 
-# Function to create folder structure on OneDrive for the specified relative path
+# Function to create folder structure on OneDrive for the specified relative path.
+# Folders known to exist are remembered in known_folders (persisted in folder_cache_file),
+# so each path segment is checked once rather than for every file
 def create_onedrive_folder_structure(relative_path, access_token):
     folder_names = relative_path.split('/')
     current_path = ""
     
     for folder in folder_names[:-1]:  # Skip the last element, which is the file name
+        parent_path = current_path
         current_path = f"{current_path}/{folder}" if current_path else folder
-        create_folder_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/backup/{current_path}:/children"
+        if current_path in known_folders:
+            continue
         
         headers = {
             'Authorization': f'Bearer {access_token}',
             'Content-Type': 'application/json'
         }
 
-        # Check if the folder exists using GET request
-        response = requests.get(f"https://graph.microsoft.com/v1.0/me/drive/root:/backup/{current_path}", headers=headers)
-
-        if response.status_code == 404:  # Folder does not exist
-            # Create the folder since it doesn't exist
-            folder_create_url = f"https://graph.microsoft.com/v1.0/me/drive/root:/backup/{current_path}:/children"
-            data = {
-                "name": folder,
-                "folder": {},
-                "@microsoft.graph.conflictBehavior": "replace"
-            }
-            create_response = requests.post(folder_create_url, headers=headers, json=data)
-            if create_response.status_code == 201:
-                print(f"Folder '{folder}' created successfully in OneDrive at path '{current_path}'.")
-            else:
-                print(f"Failed to create folder '{folder}' in OneDrive: {create_response.status_code} - {create_response.text}")
-        elif response.status_code != 200:
-            print(f"Error checking folder '{folder}' in OneDrive: {response.status_code} - {response.text}")
+        # Create the folder inside its parent; a 409 means it already exists
+        folder_create_url = f"{GRAPH_URL}/me/drive/root:/backup/{parent_path}:/children" if parent_path \
+            else f"{GRAPH_URL}/me/drive/root:/backup:/children"
+        data = {
+            "name": folder,
+            "folder": {},
+            "@microsoft.graph.conflictBehavior": "fail"
+        }
+        create_response = requests.post(folder_create_url, headers=headers, json=data)
+        if create_response.status_code == 201:
+            print(f"Folder '{folder}' created successfully in OneDrive at path '{current_path}'.")
+            known_folders.add(current_path)
+        elif create_response.status_code == 409:
+            known_folders.add(current_path)
+        else:
+            print(f"Failed to create folder '{folder}' in OneDrive: {create_response.status_code} - {create_response.text}")
+
+# Upload file with folder structure creation. Given the file's hash, content already on
+# OneDrive (from any root) is copied there instead, falling back to an upload if that fails
+def upload_file_to_onedrive(file_path, upload_path, access_token, file_hash=None):
+    dedupe = file_hash and os.path.getsize(file_path) >= dedupe_min_size
+    if dedupe:
+        source_id = find_copy_source(file_hash)
+        item_id = copy_file_on_onedrive(source_id, upload_path, access_token, file_path) if source_id else None
+        if item_id:
+            return item_id
 
-# Upload file with folder structure creation
-def upload_file_to_onedrive(file_path, upload_path, access_token):
     # Ensure the folder structure exists in OneDrive before uploading
     create_onedrive_folder_structure(upload_path, access_token)
 
@@ -176,13 +391,70 @@ def upload_file_to_onedrive(file_path, upload_path, access_token):
         'Content-Type': 'application/octet-stream'
     }
 
+    # Streamed through the shared bandwidth budget
     with open(file_path, 'rb') as file_data:
-        response = requests.put(f"https://graph.microsoft.com/v1.0/me/drive/root:/backup/{upload_path}:/content", headers=headers, data=file_data)
+        response = requests.put(f"{GRAPH_URL}/me/drive/root:/backup/{upload_path}:/content", headers=headers,
+                                data=bandwidth.PacedFile(file_data))
 
-    if response.status_code == 201:
+    if response.status_code in (200, 201):
         print(f"File '{file_path}' uploaded successfully to OneDrive.")
+        item_id = response.json()['id']
+        if dedupe:
+            with db_lock:
+                uploaded_content[file_hash] = item_id
+        return item_id
     else:
         print(f"Failed to upload file '{file_path}': {response.status_code} - {response.text}")
+        return None
+
+# Copy an uploaded item to upload_path; returns the new item's ID, or None. Graph copies
+# in the background, so the monitor URL it answers with is polled until the copy is done.
+# The copy's quickXorHash must match file_path, in case the source changed on OneDrive
+def copy_file_on_onedrive(item_id, upload_path, access_token, file_path):
+    create_onedrive_folder_structure(upload_path, access_token)
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    parent_path, _, new_name = f"backup/{upload_path}".rpartition('/')
+    data = {
+        "name": new_name,
+        "parentReference": {"path": f"/drive/root:/{parent_path}"}
+    }
+    copy_url = f"{GRAPH_URL}/me/drive/items/{item_id}/copy?@microsoft.graph.conflictBehavior=replace"
+    response = requests.post(copy_url, headers=headers, json=data)
+    if response.status_code != 202:
+        print(f"Failed to copy item {item_id} to '{upload_path}': {response.status_code} - {response.text}")
+        return None
+
+    monitor_url = response.headers['Location']  # Needs no token
+    deadline = time.monotonic() + copy_timeout
+    delay = 0.1
+    while time.monotonic() < deadline:
+        response = requests.get(monitor_url)
+        if response.status_code >= 400:
+            break
+        status = response.json()
+        if status.get('status') == 'completed':
+            if not copy_matches_file(status['resourceId'], file_path, access_token):
+                print(f"Copy of item {item_id} to '{upload_path}' has other content. Uploading instead.")
+                return None
+            print(f"Copied existing content on OneDrive to '{upload_path}' instead of uploading.")
+            return status['resourceId']
+        if status.get('status') == 'failed':
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    print(f"Copy of item {item_id} to '{upload_path}' did not complete. Uploading instead.")
+    return None
+
+def copy_matches_file(item_id, file_path, access_token):
+    response = requests.get(f"{GRAPH_URL}/me/drive/items/{item_id}?$select=id,file",
+                            headers={'Authorization': f'Bearer {access_token}'})
+    if response.status_code != 200:
+        return False
+    remote_hash = response.json().get('file', {}).get('hashes', {}).get('quickXorHash')
+    return remote_hash == quickxorhash.hash_file(file_path)
 
 def delete_file_from_onedrive(item_id, relative_path, access_token):
     # Check if the item ID is valid before attempting to delete
@@ -190,7 +462,7 @@ def delete_file_from_onedrive(item_id, relative_path, access_token):
         print(f"Invalid item ID for deleting: {item_id}. Skipping deletion for '{relative_path}'.")
         return False  # Skip deletion
     
-    delete_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}"
+    delete_url = f"{GRAPH_URL}/me/drive/items/{item_id}"
 
     headers = {
         'Authorization': f'Bearer {access_token}'
@@ -205,27 +477,31 @@ def delete_file_from_onedrive(item_id, relative_path, access_token):
         print(f"Failed to delete file '{relative_path}' from OneDrive: {response.status_code} - {response.text}")
         return False
 
-def rename_file_on_onedrive(item_id, new_name, access_token):
+def rename_file_on_onedrive(item_id, new_path, access_token):
     # Check if the item ID is valid
     if not item_id or item_id == 'new_onedrive_item_id':  # Handle invalid or placeholder item IDs
         print(f"Invalid item ID for renaming: {item_id}. Re-uploading file instead.")
         return False  # Signal that the rename failed, so you can upload instead
 
-    rename_url = f"https://graph.microsoft.com/v1.0/me/drive/items/{item_id}"
+    rename_url = f"{GRAPH_URL}/me/drive/items/{item_id}"
 
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
 
+    # Moves and renames are the same PATCH: new parent folder plus new name
+    create_onedrive_folder_structure(new_path, access_token)
+    parent_path, _, new_name = f"backup/{new_path}".rpartition('/')
     data = {
-        "name": new_name
+        "name": new_name,
+        "parentReference": {"path": f"/drive/root:/{parent_path}"}
     }
 
     response = requests.patch(rename_url, headers=headers, json=data)
 
     if response.status_code == 200:
-        print(f"File renamed to '{new_name}' successfully on OneDrive.")
+        print(f"File moved to '{new_path}' successfully on OneDrive.")
         return True
     else:
         print(f"Failed to rename file on OneDrive: {response.status_code} - {response.text}")
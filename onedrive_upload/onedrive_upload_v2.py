@@ -1,15 +1,31 @@
+import argparse
+import asyncio
 import os
+import signal
+import sys
 import json
+import aiohttp
 import requests
-import msal
-import sqlite3
-import math
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timezone
 from dotenv import load_dotenv
-from msal import PublicClientApplication
-from threading import Lock
+from itertools import count, islice
+from queue import Empty, PriorityQueue, Queue
+from threading import Event, Lock, Thread
+from urllib.parse import quote
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+import auth
+import bandwidth
+import governor
+import metrics
+import quickxorhash
+import sync_db
 
 # -----------------------------
 # Configuration & Constants
@@ -20,375 +36,2484 @@ AUTHORITY = 'https://login.microsoftonline.com/consumers'
 SCOPES = ['Files.ReadWrite.All']
 LOCAL_ROOT_FOLDER = 'C:\\GEO'  # Update this to your local folder path
 DATABASE_FILE = 'file_metadata.db'
+TOKEN_CACHE_FILE = 'token_cache.bin'  # MSAL tokens, so unattended runs don't need a login
 GEO_FOLDER = 'GEO'
 
-CHUNK_SIZE = 5 * 1024 * 1024  # 5 MB chunks for large file uploads
+CHUNK_SIZE = 5 * 1024 * 1024  # Initial chunk size for large file uploads (5 MB)
+CHUNK_ALIGNMENT = 320 * 1024  # Graph requires chunk sizes in multiples of 320 KiB
+MAX_CHUNK_SIZE = 60 * 1024 * 1024  # Graph's per-request limit for upload sessions
+CHUNK_TARGET_SECONDS = 3.0    # Grow/shrink chunks so each PUT takes about this long
+CHUNKS_IN_FLIGHT = 3          # Concurrent chunk PUTs per upload session (1 = sequential)
 SMALL_FILE_SIZE = 4 * 1024 * 1024  # Use simple upload if file < 4 MB
 SKIP_METADATA_THRESHOLD = 1 * 1024 * 1024  # Skip metadata patch for files < 1 MB
 
-MAX_RETRIES = 3         # Maximum number of retry attempts
-INITIAL_BACKOFF = 2.0   # Initial backoff seconds (exponential growth)
+# Dedupe: a file whose content was already uploaded is copied from that item on
+# OneDrive instead of being sent again. A copy costs a POST plus monitor polls,
+# so smaller files are cheaper to just upload.
+DEDUPE_COPIES = True
+DEDUPE_MIN_SIZE = 1 * 1024 * 1024
+COPY_TIMEOUT = 60             # Seconds to wait for OneDrive to finish a copy before uploading instead
+
+# Pack mode (--pack): files under PACK_MAX_FILE_SIZE go up inside compressed
+# archives, many to a request, instead of one upload each (see Pack Mode below).
+PACK_MODE = False
+PACK_MAX_FILE_SIZE = 64 * 1024
+PACK_ARCHIVE_SIZE = 3 * 1024 * 1024  # Compressed bytes per archive; below SMALL_FILE_SIZE, so one PUT each
+PACK_GROUP_DEPTH = 2          # Files share archives with everything in the same directory this many levels down
+PACK_REPACK_RATIO = 0.5       # An archive is rewritten once less than this share of it is still in use
+PACK_COMPRESSION_LEVEL = 6
+PACK_PENDING_LIMIT = 50000    # Files collected before packing starts without waiting for the end of the run
+PACK_FOLDER = 'GEO.packs'     # OneDrive folder holding the archives, beside GEO_FOLDER
+
+MAX_RETRIES = 5               # Attempts for transient errors (timeouts, 5xx without Retry-After)
+MAX_THROTTLED_RETRIES = 20    # Extra attempts for throttled requests that say when to come back
+INITIAL_BACKOFF = 2.0         # Initial backoff seconds (exponential growth, jittered)
+
+# Directory index: files in a directory whose mtime/inode are unchanged since the
+# last successful run are not stat-ed. In-place edits don't bump the directory
+# mtime, so an edited file can go unnoticed until the full stat scan forced every
+# FULL_RESCAN_INTERVAL seconds; that's why it is opt-in (--trust-directory-mtime).
+# Watch mode's reconciling syncs always use it, as the watcher sees in-place edits.
+TRUST_DIRECTORY_MTIME = False
+FULL_RESCAN_INTERVAL = 24 * 60 * 60
+
+# Watch mode (--watch): a batch of filesystem events is synced once no new event has
+# arrived for WATCH_DEBOUNCE seconds, or WATCH_MAX_DELAY after its first event.
+WATCH_DEBOUNCE = 2.0
+WATCH_MAX_DELAY = 30.0
+WATCH_POLL_INTERVAL = 0.5
+WATCH_RECONCILE_INTERVAL = 15 * 60  # Incremental scan to catch events the OS dropped
+
+MAX_WORKERS = 12             # Upload threads; requests actually in flight are paced by the governor
+ENGINE = 'threads'           # 'threads', or 'async' for one event loop with many uploads in flight (--engine)
+ASYNC_MAX_IN_FLIGHT = 256    # Files the async engine works on at once, and its ceiling on requests in flight
+ASYNC_BUFFER_MEMORY = 256 * 1024 * 1024  # Bytes of pooled upload buffers the async engine holds at once
+PIPELINE_QUEUE_SIZE = 1000   # Max items buffered between pipeline stages (backpressure)
+DETECT_BATCH_SIZE = 1000     # Scanned paths looked up in the files table per query
+
+# Upload lanes (thread engine): files needing an upload session get LARGE_LANE_WORKERS
+# of the MAX_WORKERS threads, largest first; the rest upload smaller files, most
+# recently modified first, so a big backfill doesn't hold up fresh edits.
+LARGE_LANE_WORKERS = 4
+LANE_QUEUE_SIZE = 10000      # Files waiting per lane; larger than PIPELINE_QUEUE_SIZE so priorities have room
+LANE_POLL_INTERVAL = 0.1     # How often an idle large-lane worker looks for small files to help with
+
+HASH_WORKERS = os.cpu_count() or 2   # Processes computing quickXorHash, so hashing isn't bound by the GIL
+HASH_WINDOW = HASH_WORKERS * 4       # Files being hashed at once
+
+HTTP_POOL_SIZE = MAX_WORKERS * CHUNKS_IN_FLIGHT + 2  # Keep-alive connections per host (chunk PUTs, folders, main)
+HTTP_POOL_HOSTS = 4               # Distinct hosts to keep pools for (Graph API + upload session hosts)
+HTTP_CONNECT_TIMEOUT = 10         # Seconds to establish a connection
+HTTP_READ_TIMEOUT = 120           # Seconds to wait for a response (chunk PUTs can be slow)
+
+GRAPH_URL = os.getenv('GRAPH_URL', 'https://graph.microsoft.com/v1.0')  # Overridden to benchmark against graph_stub
+GRAPH_BATCH_URL = f'{GRAPH_URL}/$batch'
+GRAPH_BATCH_LIMIT = 20        # Max sub-requests per JSON $batch call (Graph limit)
+BATCH_FLUSH_INTERVAL = 0.5    # Seconds a queued background request may wait for a full batch
+
+# Upload bandwidth by time of day, shared by every upload; see bandwidth.py for
+# the format. Empty means unlimited, e.g. 2 MB/s in working hours, full speed otherwise:
+#     [('mon-fri', '08:00', '18:00', 2 * 1024 * 1024)]
+BANDWIDTH_SCHEDULE = []
+THROUGHPUT_REPORT_INTERVAL = 30  # Seconds between throughput lines while uploading (0 = off)
+
+# Metrics (see metrics.py): a Prometheus endpoint on METRICS_PORT and/or a JSON
+# snapshot rewritten every METRICS_JSON_INTERVAL seconds; None turns either off.
+METRICS_PORT = None           # e.g. 9464 (--metrics-port)
+METRICS_JSON_FILE = None      # e.g. 'metrics.json' (--metrics-json)
+METRICS_JSON_INTERVAL = 60
 
 # Global variables
-result = None
 lock = Lock()
 
 # -----------------------------
-# MSAL Initialization
+# HTTP Session
 # -----------------------------
-app = PublicClientApplication(CLIENT_ID, authority=AUTHORITY)
-if not result:
-    result = app.acquire_token_interactive(SCOPES)
-    print("Access token acquired successfully.")
+def create_http_session():
+    """
+    One Session shared by every thread so TCP+TLS connections are reused across
+    requests. pool_block caps the open connections per host at HTTP_POOL_SIZE.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE,
+                                            pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
-# Test OneDrive connection
-headers = {
-    'Authorization': f'Bearer {result["access_token"]}',
-    'Content-Type': 'application/json'
-}
-response = requests.get('https://graph.microsoft.com/v1.0/me/drive/root', headers=headers)
-if response.status_code == 200:
-    print("Connected to OneDrive successfully.")
-    access_token = result['access_token']
-else:
-    print("Failed to connect to OneDrive:", response.status_code, response.text)
-    exit()
+http_session = create_http_session()
 
 # -----------------------------
 # Database Initialization
 # -----------------------------
-conn = sqlite3.connect(DATABASE_FILE)
+# Reads go through this connection; all writes go through the sync_db writer thread
+conn = sync_db.open_database(DATABASE_FILE)
 cursor = conn.cursor()
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS files (
-        relative_path TEXT PRIMARY KEY,
-        mtime REAL,
-        size INTEGER,
-        onedrive_id TEXT
-    )
-''')
-conn.commit()
-
-# -----------------------------
-# Token Management
-# -----------------------------
-def get_access_token():
-    global result
-    # Refresh token if near expiry
-    if result is None or 'expires_at' not in result or time.time() > result['expires_at'] - 300:
-        accounts = app.get_accounts()
-        result = app.acquire_token_silent(SCOPES, account=accounts[0] if accounts else None)
-        if not result:
-            result = app.acquire_token_interactive(SCOPES)
-            print("Access token acquired successfully.")
-    return result['access_token']
+# What the current run has scanned, in TEMP tables on a connection of their own
+scan_conn = None
+scan_scope = None  # Paths the run covers; None for the whole tree
+scan_lock = Lock()
 
 # -----------------------------
 # Generic Retry Wrapper
 # -----------------------------
+def endpoint_kind(method, url):
+    """The endpoint label requests are counted and timed under."""
+    if '/monitor/' in url:
+        return 'copy_monitor'
+    if not url.startswith(GRAPH_URL):
+        return 'upload_chunk'  # Upload session URLs live on their own host
+    path = url[len(GRAPH_URL):].split('?')[0]
+    if path == '/$batch':
+        return 'batch'
+    if path.endswith(':/content'):
+        return 'simple_upload'
+    if path.endswith('/content'):
+        return 'download'
+    if path.endswith(':/createUploadSession'):
+        return 'create_session'
+    if '/delta' in path:
+        return 'delta'
+    if path.endswith('/copy'):
+        return 'copy'
+    if path.endswith('/children'):
+        return 'create_folder'
+    return f'{method.lower()}_item'
+
+def governor_kind(kind, data):
+    """
+    What the governor compares a request's latency with: the same endpoint and,
+    for uploads, bodies of about the same size (within a factor of two), since
+    a 4 MB upload isn't congested for being slower than a 1 KB one.
+    """
+    size = len(data) if hasattr(data, '__len__') else 0
+    return f'{kind}:{size.bit_length()}' if size else kind
+
+def record_request(kind, seconds, status, retry_after):
+    """Metrics for one attempt of a request; status None means no response."""
+    metrics.observe('graph_request_seconds', seconds, endpoint=kind)
+    metrics.inc('graph_requests_total', endpoint=kind, status=status or 'error')
+    if retry_after is not None:
+        metrics.inc('graph_throttled_total', endpoint=kind)
+
 def make_request_with_retry(method, url, headers=None, data=None, json_data=None, stream=False):
     """
-    A generic requests wrapper that retries transient errors with exponential backoff.
+    A generic requests wrapper paced by the shared concurrency governor.
+    Throttled responses (429/503 with Retry-After) pause every worker until the
+    server's deadline and are retried up to MAX_THROTTLED_RETRIES times; other
+    transient errors get MAX_RETRIES attempts with jittered exponential backoff.
+    All calls go through the pooled http_session.
     method: 'GET', 'POST', 'PUT', 'PATCH', 'DELETE'...
     """
+    if method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+        raise ValueError(f"Unsupported HTTP method: {method}")
+    kind = endpoint_kind(method, url)
+    latency_kind = governor_kind(kind, data)
     attempt = 1
-    backoff = INITIAL_BACKOFF
-    while attempt <= MAX_RETRIES:
+    throttled = 0
+    while True:
+        started = governor.acquire()
+        status = None
+        retry_after = None
+        if hasattr(data, 'seek'):
+            data.seek(0)  # A paced body left part-read by the previous attempt
         try:
-            if method == 'GET':
-                resp = requests.get(url, headers=headers, stream=stream)
-            elif method == 'POST':
-                resp = requests.post(url, headers=headers, data=data, json=json_data)
-            elif method == 'PUT':
-                resp = requests.put(url, headers=headers, data=data)
-            elif method == 'PATCH':
-                resp = requests.patch(url, headers=headers, json=json_data)
-            elif method == 'DELETE':
-                resp = requests.delete(url, headers=headers)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
+            resp = http_session.request(method, url, headers=headers, data=data, json=json_data, stream=stream,
+                                        timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+            status = resp.status_code
 
             # Check if transient error or success
-            if resp.status_code < 500 and resp.status_code != 429:
+            if status < 500 and status != 429:
                 # For 2xx or 4xx (non-transient) errors, break out
                 return resp
-            else:
-                print(f"Transient HTTP error {resp.status_code} on attempt {attempt}. Retrying...")
+            retry_after = governor.parse_retry_after(resp.headers.get('Retry-After'))
+            print(f"Transient HTTP error {status} on attempt {attempt}. Retrying...")
+            resp.close()  # Hand the connection back to the pool
         except requests.ConnectionError as e:
             print(f"Connection error on attempt {attempt}: {e}")
         except requests.Timeout as e:
             print(f"Timeout on attempt {attempt}: {e}")
+        finally:
+            # Time a paced body spent waiting for bandwidth isn't latency the governor should react to
+            started += getattr(data, 'waited', 0.0)
+            governor.release(started, latency_kind, status, retry_after)
+            record_request(kind, time.monotonic() - started, status, retry_after)
 
-        # Exponential backoff before next attempt
-        time.sleep(backoff)
-        backoff *= 2
+        if retry_after is not None and throttled < MAX_THROTTLED_RETRIES:
+            # The governor holds every request back until Retry-After has passed
+            throttled += 1
+            metrics.inc('graph_retries_total', endpoint=kind)
+            continue
+        if attempt >= MAX_RETRIES:
+            break
+        time.sleep(governor.jittered(INITIAL_BACKOFF * 2 ** (attempt - 1)))
         attempt += 1
+        metrics.inc('graph_retries_total', endpoint=kind)
 
     print(f"All {MAX_RETRIES} retry attempts failed for {url}.")
     return None
 
+# -----------------------------
+# Graph $batch
+# -----------------------------
+def send_batch(batch_requests):
+    """
+    Sends sub-requests ({'method', 'url', 'body'}, url relative to /v1.0) as JSON
+    $batch calls of up to GRAPH_BATCH_LIMIT. Sub-requests that come back 429 or
+    5xx are retried with jittered backoff, and throttling pauses all requests
+    through the governor. Returns one {'status', 'headers', 'body'} per
+    request, in order; None means it gave up.
+    """
+    results = [None] * len(batch_requests)
+    pending = list(range(len(batch_requests)))
+    attempt = 1
+    backoff = INITIAL_BACKOFF
+    while pending:
+        retry = []
+        for start in range(0, len(pending), GRAPH_BATCH_LIMIT):
+            group = pending[start:start + GRAPH_BATCH_LIMIT]
+            payload = {'requests': []}
+            for i in group:
+                sub = {'id': str(i), 'method': batch_requests[i]['method'], 'url': batch_requests[i]['url']}
+                if batch_requests[i].get('body') is not None:
+                    sub['body'] = batch_requests[i]['body']
+                    sub['headers'] = {'Content-Type': 'application/json'}
+                payload['requests'].append(sub)
+
+            access_token = auth.get_access_token()
+            headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+            resp = make_request_with_retry('POST', GRAPH_BATCH_URL, headers=headers, json_data=payload)
+            if resp is None or resp.status_code >= 400:
+                print(f"Batch request failed: {resp.status_code if resp is not None else 'No Response'}")
+                continue
+
+            throttled_for = None
+            for sub_resp in resp.json().get('responses', []):
+                i = int(sub_resp['id'])
+                status = sub_resp.get('status', 500)
+                if status == 429 or status >= 500:
+                    retry.append(i)
+                    metrics.inc('graph_batch_failures_total', status=status)
+                    sub_headers = {k.lower(): v for k, v in (sub_resp.get('headers') or {}).items()}
+                    if status == 429 or 'retry-after' in sub_headers:
+                        retry_after = governor.parse_retry_after(sub_headers.get('retry-after')) or 0.0
+                        throttled_for = max(throttled_for or 0.0, retry_after)
+                else:
+                    results[i] = sub_resp
+            if throttled_for is not None:
+                governor.throttle(throttled_for)
+
+        if not retry or attempt >= MAX_RETRIES:
+            if retry:
+                print(f"All {MAX_RETRIES} retry attempts failed for {len(retry)} batched request(s).")
+            break
+        print(f"Retrying {len(retry)} throttled or failed batched request(s) (attempt {attempt})...")
+        metrics.inc('graph_retries_total', len(retry), endpoint='batch')
+        time.sleep(governor.jittered(backoff))
+        backoff *= 2
+        attempt += 1
+        pending = retry
+    return results
+
+# Small fire-and-forget requests (metadata PATCHes, deletes) are coalesced by a
+# background thread into $batch calls; on_done(sub_response) runs on that thread.
+_batch_queue = Queue()
+_batch_thread = None
+
+def queue_graph_request(method, url, body=None, on_done=None):
+    _batch_queue.put({'method': method, 'url': url, 'body': body, 'on_done': on_done})
+
+def flush_graph_requests():
+    """Blocks until every request queued so far has been sent."""
+    if _batch_thread is None:
+        return
+    done = Event()
+    _batch_queue.put(done)
+    done.wait()
+
+def start_graph_batcher():
+    global _batch_thread
+    if _batch_thread is None:
+        _batch_thread = Thread(target=graph_batcher_loop, daemon=True)
+        _batch_thread.start()
+
+def graph_batcher_loop():
+    while True:
+        items = []
+        flushes = []
+        item = _batch_queue.get()
+        deadline = time.monotonic() + BATCH_FLUSH_INTERVAL
+        while True:
+            if isinstance(item, Event):
+                flushes.append(item)
+                break
+            items.append(item)
+            if len(items) >= GRAPH_BATCH_LIMIT:
+                break
+            try:
+                item = _batch_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except Empty:
+                break
+
+        if items:
+            try:
+                responses = send_batch(items)
+            except Exception as e:
+                print(f"Error sending batched requests: {e}")
+                responses = [None] * len(items)
+            for item, sub_resp in zip(items, responses):
+                if item['on_done']:
+                    try:
+                        item['on_done'](sub_resp)
+                    except Exception as e:
+                        print(f"Error handling batched {item['method']} {item['url']}: {e}")
+        for done in flushes:
+            done.set()
+
+def batch_status(sub_resp):
+    return sub_resp['status'] if sub_resp else 'No Response'
+
+# -----------------------------
+# Remote Index
+# -----------------------------
+# A local copy of what is under GEO_FOLDER on OneDrive (remote_items), kept
+# current through /delta: each run, watch batch and plan apply first fetches
+# what changed since the stored delta link, so folder checks and remote
+# comparisons are local lookups. Our own uploads, moves and deletes are written
+# to it as they happen rather than waiting for the next refresh. Delta
+# responses don't carry paths, so each item's path is derived from its parent's.
+DELTA_SELECT = 'id,name,eTag,size,file,folder,deleted,parentReference'
+
+def refresh_remote_index():
+    """
+    Applies remote changes since the last refresh. Returns False if the index
+    couldn't be refreshed; it is then simply not consulted for new entries.
+    """
+    root_id = get_remote_root_id()
+    if root_id is None:
+        return False
+    url = get_sync_state('delta_link') or \
+        f'{GRAPH_URL}/me/drive/items/{root_id}/delta?$select={DELTA_SELECT}'
+    stale_root = None
+    paths = {root_id: GEO_FOLDER}  # id -> path for items applied in this refresh (None = deleted)
+    deferred = []
+    changes = 0
+    while True:
+        access_token = auth.get_access_token()
+        resp = make_request_with_retry('GET', url, headers={'Authorization': f'Bearer {access_token}'})
+        if resp is not None and resp.status_code == 410:
+            # The delta link expired: throw the index away and enumerate from scratch
+            print("Remote delta link expired, rebuilding the remote index.")
+            sync_db.write('DELETE FROM remote_items')
+            url = f'{GRAPH_URL}/me/drive/items/{root_id}/delta?$select={DELTA_SELECT}'
+            paths = {root_id: GEO_FOLDER}
+            deferred = []
+            continue
+        if resp is not None and resp.status_code == 404 and root_id != stale_root:
+            # GEO_FOLDER was deleted on OneDrive since its id was stored: start over from its path
+            print(f"{GEO_FOLDER} is gone from OneDrive, rebuilding the remote index.")
+            forget_remote_root()
+            stale_root = root_id
+            root_id = get_remote_root_id()
+            if root_id is None:
+                return False
+            url = f'{GRAPH_URL}/me/drive/items/{root_id}/delta?$select={DELTA_SELECT}'
+            paths = {root_id: GEO_FOLDER}
+            deferred = []
+            continue
+        if resp is None or resp.status_code >= 400:
+            print(f"Failed to refresh the remote index: {resp.status_code if resp is not None else 'No Response'}")
+            return False
+        page = resp.json()
+        for item in page.get('value', []):
+            changes += 1
+            if not apply_remote_item(item, paths, root_id):
+                deferred.append(item)
+        if '@odata.nextLink' in page:
+            url = page['@odata.nextLink']
+            continue
+        # Items listed before their parent folder get another go once it's known
+        while deferred:
+            remaining = [item for item in deferred if not apply_remote_item(item, paths, root_id)]
+            if len(remaining) == len(deferred):
+                break
+            deferred = remaining
+        set_sync_state('delta_link', page['@odata.deltaLink'])
+        sync_db.flush()
+        print(f"Remote index refreshed: {changes} change(s) since the last run.")
+        return True
+
+def get_remote_root_id():
+    root_id = get_sync_state('remote_root_id')
+    if root_id:
+        return root_id
+    access_token = auth.get_access_token()
+    resp = make_request_with_retry('GET', f'{GRAPH_URL}/me/drive/root:/{quote(GEO_FOLDER)}',
+                                   headers={'Authorization': f'Bearer {access_token}'})
+    if resp is not None and resp.status_code == 404:
+        forget_remote_root()  # Nothing uploaded yet, or all of it was deleted on OneDrive
+        return None
+    if resp is None or resp.status_code != 200:
+        return None
+    set_sync_state('remote_root_id', resp.json()['id'])
+    return resp.json()['id']
+
+def forget_remote_root():
+    """
+    Drops the remote index and the files rows of everything uploaded into
+    GEO_FOLDER, for when the folder itself is gone from OneDrive; the next scan
+    uploads the whole tree again. Packed files are kept, their archives live in
+    PACK_FOLDER beside it.
+    """
+    sync_db.write("DELETE FROM sync_state WHERE key IN ('remote_root_id', 'delta_link')")
+    sync_db.write('DELETE FROM remote_items')
+    sync_db.write('DELETE FROM files WHERE onedrive_id IS NOT NULL')
+    sync_db.flush()
+    existing_folders.clear()
+
+def remote_path(item_id, paths):
+    if item_id in paths:
+        return paths[item_id]
+    row = conn.execute('SELECT path FROM remote_items WHERE id = ?', (item_id,)).fetchone()
+    return row[0] if row else None
+
+def apply_remote_item(item, paths, root_id):
+    """Writes one delta item to remote_items. Returns False if its parent isn't known yet."""
+    item_id = item['id']
+    old_path = remote_path(item_id, paths)
+    if 'deleted' in item:
+        forget_deleted_files(item_id, old_path)
+        sync_db.write('DELETE FROM remote_items WHERE id = ?', (item_id,))
+        if old_path:
+            sync_db.write('DELETE FROM remote_items WHERE path >= ? AND path < ?', (old_path + '/', old_path + '0'))
+        paths[item_id] = None
+        return True
+    if item_id == root_id:
+        return True
+    parent_id = item.get('parentReference', {}).get('id')
+    parent_path = remote_path(parent_id, paths)
+    if parent_path is None:
+        return False
+    path = f"{parent_path}/{item['name']}"
+    is_folder = 'folder' in item
+    if is_folder and old_path and old_path != path:
+        # A renamed or moved folder is reported without its contents; move their paths along
+        sync_db.write('UPDATE remote_items SET path = ? || substr(path, ?) WHERE path >= ? AND path < ?',
+                      (path, len(old_path) + 1, old_path + '/', old_path + '0'))
+        for child_id, child_path in list(paths.items()):
+            if child_path and child_path.startswith(old_path + '/'):
+                paths[child_id] = path + child_path[len(old_path):]
+    quickxor = item.get('file', {}).get('hashes', {}).get('quickXorHash')
+    sync_db.write('''
+        INSERT OR REPLACE INTO remote_items (id, parent_id, path, etag, quickxor, size, is_folder)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (item_id, parent_id, path, item.get('eTag'), quickxor, item.get('size'), int(is_folder)))
+    paths[item_id] = path
+    return True
+
+def forget_deleted_files(item_id, old_path):
+    """
+    Drops the files rows backed by an item deleted on OneDrive (with everything
+    under it, for a folder), so the next scan uploads those files again instead
+    of taking them to be backed up. Packed files go with their archive. Queued
+    ahead of the remote_items deletes, so the subquery still finds the folder's
+    contents.
+    """
+    gone = '(SELECT ? UNION SELECT id FROM remote_items WHERE path >= ? AND path < ?)'
+    params = (item_id, old_path + '/', old_path + '0') if old_path else (item_id, None, None)
+    archives = f'(SELECT archive FROM packs WHERE onedrive_id IN {gone})'
+    sync_db.write(f'DELETE FROM files WHERE onedrive_id IN {gone}', params)
+    sync_db.write(f'''
+        DELETE FROM files WHERE relative_path IN (SELECT relative_path FROM packed_files WHERE archive IN {archives})
+    ''', params)
+    sync_db.write(f'DELETE FROM packed_files WHERE archive IN {archives}', params)
+    sync_db.write(f'DELETE FROM packs WHERE onedrive_id IN {gone}', params)
+
+def record_remote_file(onedrive_path, item):
+    """Puts a file we just uploaded, copied or moved into remote_items, ahead of the next refresh."""
+    quickxor = item.get('file', {}).get('hashes', {}).get('quickXorHash')
+    sync_db.write('DELETE FROM remote_items WHERE path = ? AND id != ?', (onedrive_path, item['id']))
+    sync_db.write('''
+        INSERT OR REPLACE INTO remote_items (id, parent_id, path, etag, quickxor, size, is_folder)
+        VALUES (?, ?, ?, ?, ?, ?, 0)
+    ''', (item['id'], item.get('parentReference', {}).get('id'), onedrive_path, item.get('eTag'), quickxor,
+          item.get('size')))
+
+def forget_remote_item(item_id):
+    sync_db.write('DELETE FROM remote_items WHERE id = ?', (item_id,))
+
+def find_remote_file(onedrive_path):
+    """Returns (id, quickxor, size) of the indexed remote file at onedrive_path, or None."""
+    return conn.execute('SELECT id, quickxor, size FROM remote_items WHERE path = ? AND is_folder = 0',
+                        (onedrive_path,)).fetchone()
+
+def confirm_remote_file(item_id, quickxor):
+    """Asks OneDrive whether an indexed item still exists with this content; the index may lag behind."""
+    access_token = auth.get_access_token()
+    resp = make_request_with_retry('GET', f'{GRAPH_URL}/me/drive/items/{item_id}?$select=id,file',
+                                   headers={'Authorization': f'Bearer {access_token}'})
+    if resp is None or resp.status_code >= 400:
+        if resp is not None and resp.status_code == 404:
+            forget_remote_item(item_id)
+        return False
+    return resp.json().get('file', {}).get('hashes', {}).get('quickXorHash') == quickxor
+
 # -----------------------------
 # OneDrive Folder Caching
 # -----------------------------
+existing_folders = set()  # Folders created or looked up this run, ahead of the remote index
+
+def folder_known(folder_path):
+    if folder_path in existing_folders:
+        return True
+    if conn.execute('SELECT 1 FROM remote_items WHERE path = ? AND is_folder = 1', (folder_path,)).fetchone():
+        existing_folders.add(folder_path)
+        return True
+    return False
+
 def build_onedrive_folder_cache(folder_paths):
     """
-    Pre-creates folder structure on OneDrive in a single pass.
+    Makes sure folder_paths (and their parents) exist on OneDrive, remembering
+    folders already seen so each one is created at most once per run. Missing
+    folders are created one depth level at a time through $batch; a 409 means
+    the folder already exists.
     """
-    print("Building folder structure cache in OneDrive...")
-    sorted_folders = sorted(folder_paths, key=lambda p: p.count('/'))
-    existing_folders = set()
+    missing = set()
+    for folder_path in folder_paths:
+        while folder_path and folder_path not in missing and not folder_known(folder_path):
+            missing.add(folder_path)
+            folder_path = os.path.dirname(folder_path)
+    if not missing:
+        return
 
-    for folder_path in sorted_folders:
-        if not folder_path or folder_path in existing_folders:
-            continue
-        access_token = get_access_token()
-        headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
-        url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{folder_path}'
-        resp = make_request_with_retry('GET', url, headers=headers)
-        if resp is None:
-            continue  # Gave up on retries
-        if resp.status_code == 200:
-            existing_folders.add(folder_path)
-        else:
-            parent = os.path.dirname(folder_path) or '/'
-            create_url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{parent}:/children'
-            data = {'name': os.path.basename(folder_path), 'folder': {}, '@microsoft.graph.conflictBehavior': 'replace'}
-            resp2 = make_request_with_retry('POST', create_url, headers=headers, json_data=data)
-            if resp2 and resp2.status_code < 400:
+    for depth in sorted({f.count('/') for f in missing}):
+        level = sorted(f for f in missing if f.count('/') == depth)
+        batch_requests = []
+        for folder_path in level:
+            parent = os.path.dirname(folder_path)
+            url = f'/me/drive/root:/{quote(parent)}:/children' if parent else '/me/drive/root/children'
+            body = {'name': os.path.basename(folder_path), 'folder': {}, '@microsoft.graph.conflictBehavior': 'fail'}
+            batch_requests.append({'method': 'POST', 'url': url, 'body': body})
+        for folder_path, sub_resp in zip(level, send_batch(batch_requests)):
+            if sub_resp and (sub_resp['status'] < 400 or sub_resp['status'] == 409):
                 existing_folders.add(folder_path)
             else:
-                print(f"Failed to create folder '{folder_path}': {resp2.status_code if resp2 else 'No Response'}")
+                print(f"Failed to create folder '{folder_path}': {batch_status(sub_resp)}")
 
-def gather_all_subfolders(file_map):
-    """
-    Gathers all unique parent folders from the list of file paths.
-    E.g., "GEO/subfolder/another" => we store 'GEO/subfolder/another'
-    """
-    folder_set = set()
-    for relative_path in file_map:
-        onedrive_path = os.path.join(GEO_FOLDER, relative_path).replace('\\', '/')
-        folder = os.path.dirname(onedrive_path).strip('/')
-        if folder:
-            folder_set.add(folder)
-    return folder_set
+def onedrive_parent_folder(relative_path):
+    onedrive_path = os.path.join(GEO_FOLDER, relative_path).replace('\\', '/')
+    return os.path.dirname(onedrive_path).strip('/')
 
 # -----------------------------
 # Local Folder & DB Utilities
 # -----------------------------
-def scan_local_folder(root_folder):
-    files = {}
-    for dirpath, _, filenames in os.walk(root_folder):
-        for filename in filenames:
-            local_path = os.path.join(dirpath, filename)
-            relative_path = os.path.relpath(local_path, root_folder).replace('\\', '/')
+def scan_local_folder(root_folder, known_dirs=None, dir_snapshots=None):
+    """
+    Walks root_folder with os.scandir and yields (relative_path, file_info) pairs.
+    Files in a directory whose (mtime_ns, inode) matches known_dirs are yielded as
+    {'local_path', 'unchanged': True} without being stat-ed. The current snapshot
+    of every directory listed is recorded in dir_snapshots.
+    """
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        dir_path = os.path.join(root_folder, relative_dir) if relative_dir else root_folder
+        try:
+            # Stat before listing so changes made while we scan bump the mtime
+            dir_stat = os.stat(dir_path)
+            snapshot = (dir_stat.st_mtime_ns, dir_stat.st_ino)
+            entries = list(os.scandir(dir_path))
+        except (PermissionError, FileNotFoundError, OSError) as e:
+            print(f"Error accessing folder {dir_path}: {e}")
+            continue
+
+        trusted = known_dirs is not None and known_dirs.get(relative_dir) == snapshot
+        if dir_snapshots is not None:
+            dir_snapshots[relative_dir] = snapshot
+
+        for entry in entries:
+            relative_path = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
             try:
-                stat = os.stat(local_path)
-                mtime, size = stat.st_mtime, stat.st_size
-                files[relative_path] = {
-                    'local_path': local_path,
-                    'mtime': mtime,
-                    'size': size
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append(relative_path)
+                    continue
+                if trusted:
+                    yield relative_path, {'local_path': entry.path, 'unchanged': True}
+                    continue
+                # DirEntry caches the stat result (free on Windows)
+                stat = entry.stat()
+                yield relative_path, {
+                    'local_path': entry.path,
+                    'mtime': stat.st_mtime,
+                    'size': stat.st_size,
+                    'inode': entry.inode()
                 }
             except (PermissionError, FileNotFoundError, OSError) as e:
-                print(f"Error accessing file {local_path}: {e}")
-    return files
+                print(f"Error accessing file {entry.path}: {e}")
 
-def delete_onedrive_item(item_id):
-    access_token = get_access_token()
-    headers = {'Authorization': f'Bearer {access_token}'}
-    url = f'https://graph.microsoft.com/v1.0/me/drive/items/{item_id}'
-    resp = make_request_with_retry('DELETE', url, headers=headers)
-    if resp is None or resp.status_code >= 400:
-        print(f"Failed to delete item: {resp.status_code if resp else 'No Response'}")
+STORED_COLUMNS = 'relative_path, mtime, size, onedrive_id, inode, quickxor'
+
+def stored_record(row):
+    return {'mtime': row[1], 'size': row[2], 'onedrive_id': row[3], 'inode': row[4], 'quickxor': row[5]}
+
+def begin_scan(paths=None):
+    """
+    Starts change detection for a run over all stored files, or only those at
+    or below the given paths. Rows are never loaded up front: each batch of
+    scanned paths is joined against files as it arrives (record_scanned), and
+    what the scan didn't see comes out of vanished_files() at the end.
+    """
+    global scan_conn, scan_scope
+    with scan_lock:
+        if scan_conn is None:
+            scan_conn = sync_db.open_scan_connection(DATABASE_FILE)
+        scan_conn.execute('DELETE FROM scanned')
+        scan_conn.execute('DELETE FROM claimed')
+    scan_scope = None if paths is None else set(paths)
+
+def in_scan_scope(relative_path):
+    if scan_scope is None:
+        return True
+    parts = relative_path.split('/')
+    return any('/'.join(parts[:i]) in scan_scope for i in range(1, len(parts) + 1))
+
+def record_scanned(paths):
+    """
+    Marks a batch of paths as seen by the scan and returns the stored records
+    of those that have one, keyed by path, from one join on the primary key.
+    """
+    with scan_lock:
+        scan_conn.execute('BEGIN')
+        try:
+            scan_conn.execute('DELETE FROM scan_batch')
+            scan_conn.executemany('INSERT OR IGNORE INTO scan_batch VALUES (?)', [(path,) for path in paths])
+            scan_conn.execute('INSERT OR IGNORE INTO scanned SELECT relative_path FROM scan_batch')
+            # CROSS JOIN keeps scan_batch outermost; the planner has no statistics for TEMP tables
+            rows = scan_conn.execute(f'SELECT {STORED_COLUMNS} FROM scan_batch CROSS JOIN files USING (relative_path)'
+                                     ).fetchall()
+            scan_conn.execute('COMMIT')
+        except Exception:
+            scan_conn.execute('ROLLBACK')
+            raise
+    return {row[0]: stored_record(row) for row in rows}
+
+def claim_vanished(relative_path):
+    """Claims a stored path the scan hasn't seen so it isn't deleted; False if it was seen or already claimed."""
+    with scan_lock:
+        return scan_conn.execute('''
+            INSERT OR IGNORE INTO claimed SELECT ? WHERE NOT EXISTS (SELECT 1 FROM scanned WHERE relative_path = ?)
+        ''', (relative_path, relative_path)).rowcount == 1
+
+def vanished_files():
+    """
+    Yields (relative_path, stored_info) for stored files in scope that the scan
+    didn't see and no move claimed, i.e. those deleted locally. Streamed from an
+    anti-join, so only call it once the pipeline has finished.
+    """
+    unseen = '''
+        NOT EXISTS (SELECT 1 FROM scanned s WHERE s.relative_path = f.relative_path)
+        AND NOT EXISTS (SELECT 1 FROM claimed c WHERE c.relative_path = f.relative_path)
+    '''
+    if scan_scope is None:
+        queries = [(f'SELECT {STORED_COLUMNS} FROM files f WHERE {unseen}', ())]
     else:
-        print(f"Deleted item with ID {item_id} from OneDrive.")
+        queries = []
+        last = None
+        # In tree order a path's descendants come right after it, so nested scope paths are skipped
+        for path in sorted(scan_scope, key=lambda p: p.split('/')):
+            if last is not None and path.startswith(last + '/'):
+                continue
+            last = path
+            # '0' sorts right after '/', so this range is everything under path/
+            queries.append((f'''
+                SELECT {STORED_COLUMNS} FROM files f
+                WHERE (relative_path = ? OR (relative_path >= ? AND relative_path < ?)) AND {unseen}
+            ''', (path, path + '/', path + '0')))
+    for sql, params in queries:
+        for row in scan_conn.execute(sql, params):
+            yield row[0], stored_record(row)
+
+def rename_stored_folder(old_dir, new_dir):
+    """Points the records of a moved directory at its new location."""
+    rows = conn.execute('SELECT relative_path FROM files WHERE relative_path >= ? AND relative_path < ?',
+                        (old_dir + '/', old_dir + '0')).fetchall()
+    for (old_path,) in rows:
+        sync_db.write('UPDATE OR REPLACE files SET relative_path = ? WHERE relative_path = ?',
+                      (new_dir + old_path[len(old_dir):], old_path))
+        sync_db.write('UPDATE OR REPLACE packed_files SET relative_path = ? WHERE relative_path = ?',
+                      (new_dir + old_path[len(old_dir):], old_path))
+
+def load_directory_index():
+    cursor.execute('SELECT relative_dir, mtime_ns, inode FROM dirs')
+    return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+def save_directory_index(dir_snapshots, failed_dirs):
+    """
+    Replaces the directory index with this run's snapshots. Directories with a
+    failed upload are left out so their files are stat-ed again next run.
+    """
+    sync_db.write('DELETE FROM dirs')
+    for relative_dir, snapshot in dir_snapshots.items():
+        if relative_dir not in failed_dirs:
+            sync_db.write('INSERT INTO dirs (relative_dir, mtime_ns, inode) VALUES (?, ?, ?)',
+                          (relative_dir, snapshot[0], snapshot[1]))
+
+def get_sync_state(key, default=None):
+    cursor.execute('SELECT value FROM sync_state WHERE key = ?', (key,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+def set_sync_state(key, value):
+    sync_db.write('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, str(value)))
+
+def delete_onedrive_item(item_id, relative_path):
+    """
+    Queues a batched DELETE; the files row is only dropped once OneDrive confirms
+    (404 counts, the item is already gone), so failures are retried next run.
+    Packed files (no item_id) are just dropped from their archive's manifest.
+    """
+    if item_id is None:
+        forget_packed_file(relative_path)
+        sync_db.write('DELETE FROM files WHERE relative_path = ?', (relative_path,))
+        print(f"Deleted packed file: {relative_path}")
+        return
+
+    def on_done(sub_resp):
+        if sub_resp and (sub_resp['status'] < 400 or sub_resp['status'] == 404):
+            sync_db.write('DELETE FROM files WHERE relative_path = ?', (relative_path,))
+            forget_remote_item(item_id)
+            print(f"Deleted file from OneDrive: {relative_path}")
+        else:
+            print(f"Failed to delete item {item_id} ({relative_path}): {batch_status(sub_resp)}")
+
+    queue_graph_request('DELETE', f'/me/drive/items/{item_id}', on_done=on_done)
+
+# -----------------------------
+# Upload Buffers
+# -----------------------------
+# File bytes are read with readinto() into reusable bytearrays and handed to
+# requests as memoryview slices, which urllib3 passes straight to sendall().
+# The pool holds at most one buffer per concurrent upload, so RSS stays flat no
+# matter how large the files are. (mmap would save one more copy but raises
+# SIGBUS if a file is truncated while we upload it.)
+BUFFER_GRANULARITY = SMALL_FILE_SIZE  # Round buffer sizes up so they can be reused
+MIN_BUFFER_SIZE = 64 * 1024
+_free_buffers = []
+_buffer_lock = Lock()
+
+def buffer_size(size):
+    """Sizes are rounded up to a power of two below BUFFER_GRANULARITY, and to multiples of it above."""
+    if size <= BUFFER_GRANULARITY:
+        return max(MIN_BUFFER_SIZE, 1 << (size - 1).bit_length())
+    return -(-size // BUFFER_GRANULARITY) * BUFFER_GRANULARITY
+
+def acquire_buffer(size):
+    size = buffer_size(size)
+    with _buffer_lock:
+        for i, buf in enumerate(_free_buffers):
+            if len(buf) >= size:
+                return _free_buffers.pop(i)
+        if _free_buffers:
+            _free_buffers.pop(0)  # Replace the smallest rather than growing the pool
+    return bytearray(size)
+
+def release_buffer(buf):
+    with _buffer_lock:
+        _free_buffers.append(buf)
+        _free_buffers.sort(key=len)
+
+def read_chunk(f, start, length):
+    """
+    Reads a byte range into a pooled buffer. Returns (buffer, view); pass the
+    view to the request and release_buffer(buffer) once it has been sent.
+    """
+    buf = acquire_buffer(length)
+    f.seek(start)
+    read = f.readinto(memoryview(buf)[:length])
+    return buf, memoryview(buf)[:read]
+
+def move_onedrive_item(item_id, onedrive_path):
+    """
+    Moves and/or renames an item in one PATCH. Returns the updated item, or None
+    if OneDrive refused (e.g. the item is gone or the target name is taken).
+    """
+    access_token = auth.get_access_token()
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+    url = f'{GRAPH_URL}/me/drive/items/{item_id}'
+    data = {
+        'parentReference': {'path': f'/drive/root:/{os.path.dirname(onedrive_path)}'},
+        'name': os.path.basename(onedrive_path)
+    }
+    resp = make_request_with_retry('PATCH', url, headers=headers, json_data=data)
+    if resp is None or resp.status_code >= 400:
+        status = resp.status_code if resp is not None else 'No Response'
+        print(f"Failed to move item {item_id} to {onedrive_path}: {status}")
+        return None
+    return resp.json()
+
+def move_onedrive_folder(old_relative_dir, new_relative_dir):
+    """
+    Moves a whole folder with one PATCH addressed by its path, however many
+    files it holds. Returns False if OneDrive refused (e.g. the folder was
+    never uploaded).
+    """
+    old_path = os.path.join(GEO_FOLDER, old_relative_dir).replace('\\', '/')
+    new_path = os.path.join(GEO_FOLDER, new_relative_dir).replace('\\', '/')
+    build_onedrive_folder_cache([os.path.dirname(new_path)])
+    access_token = auth.get_access_token()
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+    url = f'{GRAPH_URL}/me/drive/root:/{quote(old_path)}'
+    data = {
+        'parentReference': {'path': f'/drive/root:/{os.path.dirname(new_path)}'},
+        'name': os.path.basename(new_path)
+    }
+    resp = make_request_with_retry('PATCH', url, headers=headers, json_data=data)
+    if resp is None or resp.status_code >= 400:
+        status = resp.status_code if resp is not None else 'No Response'
+        print(f"Failed to move folder {old_path} to {new_path}: {status}")
+        return False
+    for folder in [f for f in existing_folders if f == old_path or f.startswith(old_path + '/')]:
+        existing_folders.discard(folder)
+        existing_folders.add(new_path + folder[len(old_path):])
+    sync_db.write('UPDATE remote_items SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)',
+                  (new_path, len(old_path) + 1, old_path, old_path + '/', old_path + '0'))
+    return True
 
 # -----------------------------
 # Chunked Upload
 # -----------------------------
-def create_upload_session(onedrive_path):
-    access_token = get_access_token()
+def create_upload_session(onedrive_path, creation_time, modification_time):
+    """
+    The item properties go with the session, so the finished upload already has
+    the local timestamps and needs no metadata PATCH afterwards.
+    """
+    access_token = auth.get_access_token()
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
-    endpoint = f"https://graph.microsoft.com/v1.0/me/drive/root:/{onedrive_path}:/createUploadSession"
-    data = {"@microsoft.graph.conflictBehavior": "replace", "fileSystemInfo": {}}
+    endpoint = f"{GRAPH_URL}/me/drive/root:/{onedrive_path}:/createUploadSession"
+    data = {"item": {
+        "@microsoft.graph.conflictBehavior": "replace",
+        "fileSystemInfo": file_system_info(creation_time, modification_time)
+    }}
     resp = make_request_with_retry('POST', endpoint, headers=headers, json_data=data)
     if resp and resp.status_code < 400:
         return resp.json()
     print(f"Failed to create upload session for {onedrive_path}")
     return None
 
-def update_onedrive_metadata(item_id, creation_time, modification_time):
-    access_token = get_access_token()
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    metadata_url = f'https://graph.microsoft.com/v1.0/me/drive/items/{item_id}'
-    file_system_info = {
+def file_system_info(creation_time, modification_time):
+    return {
         "createdDateTime": datetime.fromtimestamp(creation_time, tz=timezone.utc).isoformat(),
         "lastModifiedDateTime": datetime.fromtimestamp(modification_time, tz=timezone.utc).isoformat()
     }
-    resp = make_request_with_retry('PATCH', metadata_url, headers=headers, json_data={"fileSystemInfo": file_system_info})
+
+def has_file_times(file_info, modification_time):
+    """True if the item OneDrive returned already carries modification_time (to the second)."""
+    server_time = parse_graph_time(file_info.get('fileSystemInfo', {}).get('lastModifiedDateTime'))
+    return abs(server_time - modification_time) < 1
+
+def update_onedrive_metadata(item_id, creation_time, modification_time):
+    """
+    Sets the timestamps of an uploaded item. Simple uploads can't carry them, so
+    this is queued for the $batch thread, 20 items to a request.
+    """
+    def on_done(sub_resp):
+        if sub_resp is None or sub_resp['status'] >= 400:
+            body = sub_resp.get('body', '') if sub_resp else ''
+            print(f"Failed to update file metadata: {batch_status(sub_resp)}, {body}")
+
+    body = {"fileSystemInfo": file_system_info(creation_time, modification_time)}
+    queue_graph_request('PATCH', f'/me/drive/items/{item_id}', body=body, on_done=on_done)
+
+def parse_expected_ranges(ranges):
+    """
+    Turns nextExpectedRanges (["0-", "26-49"]) into [(start, end_or_None), ...].
+    """
+    parsed = []
+    for r in ranges or []:
+        start, _, end = r.partition('-')
+        parsed.append((int(start), int(end) if end else None))
+    return parsed
+
+def get_upload_session_ranges(upload_url):
+    resp = make_request_with_retry('GET', upload_url)
     if resp is None or resp.status_code >= 400:
-        code = resp.status_code if resp else 'No Resp'
-        print(f"Failed to update file metadata: {code}, {resp.text if resp else ''}")
+        return None
+    return parse_expected_ranges(resp.json().get('nextExpectedRanges'))
 
-def upload_file_in_chunks(local_file_path, onedrive_path, creation_time, modification_time):
-    session_info = create_upload_session(onedrive_path)
+def next_chunk_size(chunk_size, sent_bytes, seconds):
+    """
+    Sizes the next chunk so a PUT takes about CHUNK_TARGET_SECONDS at the measured
+    throughput, changing at most 2x per step, in multiples of CHUNK_ALIGNMENT.
+    """
+    if seconds <= 0:
+        return chunk_size
+    target = sent_bytes / seconds * CHUNK_TARGET_SECONDS
+    target = min(max(target, chunk_size / 2), chunk_size * 2)
+    target = int(target) // CHUNK_ALIGNMENT * CHUNK_ALIGNMENT
+    return min(max(target, CHUNK_ALIGNMENT), MAX_CHUNK_SIZE)
+
+# -----------------------------
+# Resumable Upload Sessions
+# -----------------------------
+# Every open upload session is kept in upload_sessions with the local file's
+# mtime/size, so a run killed halfway through a large file resumes from the
+# server's nextExpectedRanges instead of byte 0.
+SESSION_EXPIRY_MARGIN = 300  # Don't resume sessions this close to expiring
+
+def parse_graph_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() if value else 0.0
+
+def prune_upload_sessions():
+    sync_db.write('DELETE FROM upload_sessions WHERE expires_at < ?', (time.time(),))
+
+def remember_upload_session(onedrive_path, session_info, mtime, size):
+    sync_db.write('''
+        INSERT OR REPLACE INTO upload_sessions
+            (onedrive_path, upload_url, expires_at, mtime, size, next_expected_ranges)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (onedrive_path, session_info['uploadUrl'], parse_graph_time(session_info.get('expirationDateTime')),
+          mtime, size, json.dumps(session_info.get('nextExpectedRanges', ['0-']))))
+
+def record_upload_progress(upload_url, resp_json):
+    sync_db.write('''
+        UPDATE upload_sessions SET next_expected_ranges = ?, expires_at = COALESCE(?, expires_at)
+        WHERE upload_url = ?
+    ''', (json.dumps(resp_json.get('nextExpectedRanges', [])),
+          parse_graph_time(resp_json.get('expirationDateTime')) or None, upload_url))
+
+def forget_upload_session(onedrive_path):
+    sync_db.write('DELETE FROM upload_sessions WHERE onedrive_path = ?', (onedrive_path,))
+
+def open_upload_session(onedrive_path, mtime, size, creation_time=None):
+    """
+    Returns (upload_url, ranges still to send). A stored session is resumed if the
+    local file is unchanged and the server still knows it; otherwise it is
+    cancelled and a new one is created.
+    """
+    row = conn.execute('SELECT upload_url, expires_at, mtime, size FROM upload_sessions WHERE onedrive_path = ?',
+                       (onedrive_path,)).fetchone()
+    if row:
+        upload_url, expires_at, stored_mtime, stored_size = row
+        if stored_mtime == mtime and stored_size == size and expires_at > time.time() + SESSION_EXPIRY_MARGIN:
+            ranges = get_upload_session_ranges(upload_url)
+            if ranges:
+                print(f"Resuming upload of '{onedrive_path}' from byte {ranges[0][0]}.")
+                return upload_url, ranges
+        if expires_at > time.time():
+            make_request_with_retry('DELETE', upload_url)  # Best effort; an abandoned session just expires
+        forget_upload_session(onedrive_path)
+
+    session_info = create_upload_session(onedrive_path, creation_time or mtime, mtime)
     if not session_info or "uploadUrl" not in session_info:
-        return None
-    upload_url = session_info["uploadUrl"]
+        return None, None
+    remember_upload_session(onedrive_path, session_info, mtime, size)
+    return session_info["uploadUrl"], [(0, None)]
+
+def put_chunk(upload_url, buf, data, start, file_size):
+    """
+    PUTs one byte range to an upload session and returns its buffer to the pool.
+    The uploadUrl is pre-authenticated; Graph rejects requests to it that carry
+    an Authorization header.
+    """
+    end = start + len(data) - 1
+    headers = {
+        'Content-Length': str(len(data)),
+        'Content-Range': f'bytes {start}-{end}/{file_size}'
+    }
+    began = time.monotonic()
+    try:
+        resp = make_request_with_retry('PUT', upload_url, headers=headers, data=bandwidth.PacedReader(data))
+    finally:
+        release_buffer(buf)
+    return resp, time.monotonic() - began
+
+# Cleared the first time Graph rejects an out-of-order chunk; later files then
+# go straight to sequential uploads for the rest of the run.
+parallel_chunks_allowed = CHUNKS_IN_FLIGHT > 1
+
+def upload_chunks_parallel(f, upload_url, file_size, chunk_size):
+    """
+    Keeps up to CHUNKS_IN_FLIGHT consecutive ranges in flight. Returns
+    (file_info, chunk_size); file_info is None if the upload isn't complete,
+    in which case the caller carries on sequentially from the server's ranges.
+    """
+    global parallel_chunks_allowed
+    offset = 0
+    in_flight = {}
+    file_info = None
+    rejected = False
+    with ThreadPoolExecutor(max_workers=CHUNKS_IN_FLIGHT) as pool:
+        while in_flight or (offset < file_size and not rejected and file_info is None):
+            while len(in_flight) < CHUNKS_IN_FLIGHT and offset < file_size and not rejected and file_info is None:
+                length = min(chunk_size, file_size - offset)
+                buf, data = read_chunk(f, offset, length)
+                in_flight[pool.submit(put_chunk, upload_url, buf, data, offset, file_size)] = length
+                offset += length
 
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                length = in_flight.pop(future)
+                resp, seconds = future.result()
+                if resp is None:
+                    rejected = True
+                elif resp.status_code in (200, 201):
+                    file_info = resp.json()
+                elif resp.status_code in (202, 308):
+                    record_upload_progress(upload_url, resp.json())
+                    chunk_size = next_chunk_size(chunk_size, length, seconds)
+                else:
+                    # Most likely an out-of-order fragment; stop dispatching and let
+                    # the sequential path pick up from nextExpectedRanges
+                    if parallel_chunks_allowed:
+                        print(f"Parallel chunk rejected ({resp.status_code}); using sequential chunk uploads.")
+                    parallel_chunks_allowed = False
+                    rejected = True
+    return file_info, chunk_size
+
+def upload_chunks_sequential(f, upload_url, file_size, chunk_size, ranges):
+    """
+    Uploads the missing ranges one PUT at a time, always starting where the
+    server's nextExpectedRanges says and never crossing the end of a range.
+    """
+    while ranges:
+        start, end = ranges[0]
+        range_end = file_size - 1 if end is None else end
+        length = min(chunk_size, range_end - start + 1)
+        buf, data = read_chunk(f, start, length)
+        resp, seconds = put_chunk(upload_url, buf, data, start, file_size)
+        if resp is None:
+            return None
+        if resp.status_code in (200, 201):
+            return resp.json()
+        if resp.status_code not in (202, 308):
+            print(f"Error uploading chunk. Status: {resp.status_code}, Response: {resp.text}")
+            return None
+        record_upload_progress(upload_url, resp.json())
+        chunk_size = next_chunk_size(chunk_size, length, seconds)
+        ranges = parse_expected_ranges(resp.json().get('nextExpectedRanges'))
+        if not ranges:
+            ranges = [(start + length, None)] if start + length < file_size else []
+    return None
+
+def upload_file_in_chunks(local_file_path, onedrive_path, creation_time, modification_time):
     file_size = os.path.getsize(local_file_path)
-    chunk_count = math.ceil(file_size / CHUNK_SIZE)
-    print(f"Uploading '{local_file_path}' in {chunk_count} chunk(s)...")
+    upload_url, ranges = open_upload_session(onedrive_path, modification_time, file_size, creation_time)
+    if upload_url is None:
+        return None
+    print(f"Uploading '{local_file_path}' ({file_size} bytes) in chunks...")
 
-    start = 0
-    chunk_index = 1
+    file_info = None
+    chunk_size = CHUNK_SIZE
     with open(local_file_path, 'rb') as f:
-        while start < file_size:
-            end = min(start + CHUNK_SIZE - 1, file_size - 1)
-            chunk_size = end - start + 1
-            chunk_data = f.read(chunk_size)
-
-            access_token = get_access_token()
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Length': str(chunk_size),
-                'Content-Range': f'bytes {start}-{end}/{file_size}'
-            }
-            resp = make_request_with_retry('PUT', upload_url, headers=headers, data=chunk_data)
-            if resp is None:
-                return None
-
-            if resp.status_code in (200, 201):
-                file_info = resp.json()
-                print(f"File upload finished for '{local_file_path}'.")
-                update_onedrive_metadata(file_info['id'], creation_time, modification_time)
-                return file_info
-            elif resp.status_code == 308:
-                print(f"Uploaded chunk {chunk_index}/{chunk_count} for '{local_file_path}'. Continuing...")
-                start = end + 1
-                chunk_index += 1
-            else:
-                print(f"Error uploading chunk. Status: {resp.status_code}, Response: {resp.text}")
-                return None
+        if parallel_chunks_allowed and ranges == [(0, None)]:
+            file_info, chunk_size = upload_chunks_parallel(f, upload_url, file_size, chunk_size)
+            ranges = None if file_info else get_upload_session_ranges(upload_url)
+        if file_info is None and ranges:
+            file_info = upload_chunks_sequential(f, upload_url, file_size, chunk_size, ranges)
+
+    if file_info is None:
+        # The session stays in upload_sessions so the next run can resume it
+        print(f"Chunked upload failed for '{local_file_path}'.")
+        return None
+    forget_upload_session(onedrive_path)
+    print(f"File upload finished for '{local_file_path}'.")
+    if not has_file_times(file_info, modification_time):
+        # e.g. a session resumed from a version that created them without timestamps
+        update_onedrive_metadata(file_info['id'], creation_time, modification_time)
+    return file_info
+
+# -----------------------------
+# Server-side Copies
+# -----------------------------
+# Content already on OneDrive is not uploaded twice: a file whose quickXorHash
+# and size match an uploaded file is copied from that item by OneDrive itself.
+# Sources come from the files table (files_quickxor index) and from this run's
+# uploads, which the DB writer may not have committed yet. If the copy fails
+# (source deleted or changed on OneDrive, monitor timeout) the file is uploaded.
+uploaded_content = {}  # (quickxor, size) -> onedrive_id, for files uploaded this run
+
+def remember_uploaded_content(quickxor, size, onedrive_id):
+    if size >= DEDUPE_MIN_SIZE:
+        with lock:
+            uploaded_content[(quickxor, size)] = onedrive_id
+
+def find_copy_source(quickxor, size):
+    """The OneDrive id of an uploaded file with this content, or None."""
+    with lock:
+        onedrive_id = uploaded_content.get((quickxor, size))
+    if onedrive_id:
+        return onedrive_id
+    row = conn.execute('SELECT onedrive_id FROM files WHERE quickxor = ? AND size = ? AND onedrive_id IS NOT NULL',
+                       (quickxor, size)).fetchone()
+    return row[0] if row else None
+
+def copy_onedrive_item(item_id, onedrive_path):
+    """
+    Copies an item to onedrive_path, replacing whatever is there. Graph copies
+    in the background, so the monitor URL it returns is polled until the copy
+    is done. Returns the new item, or None.
+    """
+    access_token = auth.get_access_token()
+    headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
+    url = f'{GRAPH_URL}/me/drive/items/{item_id}/copy?@microsoft.graph.conflictBehavior=replace'
+    data = {
+        'parentReference': {'path': f'/drive/root:/{os.path.dirname(onedrive_path)}'},
+        'name': os.path.basename(onedrive_path)
+    }
+    resp = make_request_with_retry('POST', url, headers=headers, json_data=data)
+    if resp is None or resp.status_code != 202 or 'Location' not in resp.headers:
+        status = resp.status_code if resp is not None else 'No Response'
+        print(f"Failed to copy item {item_id} to {onedrive_path}: {status}")
+        return None
+    monitor_url = resp.headers['Location']
+    deadline = time.monotonic() + COPY_TIMEOUT
+    delay = 0.1
+    while time.monotonic() < deadline:
+        resp = make_request_with_retry('GET', monitor_url)  # Monitor URLs take no token
+        if resp is None or resp.status_code >= 400:
+            break
+        job = resp.json()
+        if job.get('status') == 'completed':
+            resp = make_request_with_retry('GET', f"{GRAPH_URL}/me/drive/items/{job['resourceId']}", headers=headers)
+            return resp.json() if resp is not None and resp.status_code < 400 else None
+        if job.get('status') == 'failed':
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 2.0)
+    print(f"Copy of item {item_id} to {onedrive_path} did not complete")
     return None
 
+def copy_existing_content(quickxor, size, onedrive_path, mtime):
+    """Puts a file on OneDrive by copying an uploaded one with the same content; None if there is none."""
+    if not DEDUPE_COPIES or size < DEDUPE_MIN_SIZE:
+        return None
+    source_id = find_copy_source(quickxor, size)
+    if source_id is None:
+        return None
+    file_info = copy_onedrive_item(source_id, onedrive_path)
+    if file_info is None:
+        return None
+    if file_info.get('file', {}).get('hashes', {}).get('quickXorHash') not in (None, quickxor):
+        print(f"Copy source {source_id} has changed on OneDrive; uploading {onedrive_path} instead")
+        return None
+    # The copy has the source's timestamps
+    update_onedrive_metadata(file_info['id'], mtime, mtime)
+    metrics.inc('files_copied_total')
+    metrics.inc('copy_bytes_saved_total', size)
+    print(f"Copied existing content on OneDrive instead of uploading: {onedrive_path}")
+    file_info['copied'] = True  # Not counted as an upload by finish_upload
+    return file_info
+
 # -----------------------------
 # Simple Upload Logic
 # -----------------------------
 def simple_upload_file(local_file_path, onedrive_path, mtime):
-    access_token = get_access_token()
+    access_token = auth.get_access_token()
     headers = {'Authorization': f'Bearer {access_token}'}
     try:
         with open(local_file_path, 'rb') as f:
-            file_content = f.read()
+            file_size = os.fstat(f.fileno()).st_size
+            buf, file_content = read_chunk(f, 0, file_size)
     except (PermissionError, FileNotFoundError, OSError) as e:
         print(f"Error reading file {local_file_path}: {e}")
         return None
 
-    upload_url = f'https://graph.microsoft.com/v1.0/me/drive/root:/{onedrive_path}:/content'
-    resp = make_request_with_retry('PUT', upload_url, headers=headers, data=file_content)
+    upload_url = f'{GRAPH_URL}/me/drive/root:/{onedrive_path}:/content'
+    try:
+        # An empty body would be sent chunked; empty files go up as b''
+        body = bandwidth.PacedReader(file_content) if file_size else b''
+        resp = make_request_with_retry('PUT', upload_url, headers=headers, data=body)
+    finally:
+        release_buffer(buf)
     if resp is None or resp.status_code >= 400:
-        code = resp.status_code if resp else 'No Resp'
-        print(f"Failed to upload file: {local_file_path} => {code}, {resp.text if resp else ''}")
+        code = resp.status_code if resp is not None else 'No Resp'
+        print(f"Failed to upload file: {local_file_path} => {code}, {resp.text if resp is not None else ''}")
         return None
 
     file_info = resp.json()
     item_id = file_info['id']
     # Skip metadata patch for tiny files
-    if os.path.getsize(local_file_path) > SKIP_METADATA_THRESHOLD:
+    if file_size > SKIP_METADATA_THRESHOLD:
         update_onedrive_metadata(item_id, mtime, mtime)
     return file_info
 
-def upload_file_to_onedrive(local_file_path, onedrive_path, mtime):
+def upload_file_to_onedrive(local_file_path, onedrive_path, mtime, quickxor=None):
+    """With the file's quickxor, content already on OneDrive is copied there rather than uploaded."""
     file_size = os.path.getsize(local_file_path)
+    if quickxor:
+        copied = copy_existing_content(quickxor, file_size, onedrive_path, mtime)
+        if copied:
+            return copied
     if file_size < SMALL_FILE_SIZE:
         return simple_upload_file(local_file_path, onedrive_path, mtime)
     else:
         return upload_file_in_chunks(local_file_path, onedrive_path, mtime, mtime)
 
 # -----------------------------
-# Parallel Upload Worker
+# Streaming Upload Pipeline
 # -----------------------------
-stored_files = {}  # We'll fill this in main()
+# scan -> change detection -> folder creation -> upload workers, connected by
+# bounded queues so each stage blocks when the next one falls behind.
+STOP = object()
+failed_dirs = set()  # Directories with a failed upload this run
+hash_pool = None
+
+def mark_failed(relative_path):
+    metrics.inc('files_failed_total')
+    with lock:
+        failed_dirs.add(os.path.dirname(relative_path))
+
+def run_stage(handler, in_queue, out_queue=None):
+    """
+    Feeds (relative_path, file_info) items from in_queue to handler until STOP,
+    forwarding any non-None result to out_queue.
+    """
+    while True:
+        item = in_queue.get()
+        if item is STOP:
+            break
+        try:
+            out = handler(*item)
+        except Exception as e:
+            print(f"Error in pipeline stage {handler.__name__} for {item[0]}: {e}")
+            mark_failed(item[0])
+            continue
+        if out is not None and out_queue is not None:
+            out_queue.put(out)
+
+def scan_stage(out_queue, items):
+    began = time.monotonic()
+    try:
+        for item in items:
+            metrics.inc('files_scanned_total')
+            out_queue.put(item)
+    finally:
+        metrics.observe('scan_seconds', time.monotonic() - began)
+        out_queue.put(STOP)
+
+def detect_stage(in_queue, out_queue):
+    """
+    Change detection, a batch of up to DETECT_BATCH_SIZE scanned files at a
+    time: the batch is recorded in the scan table and its stored records come
+    back from one query. Files still waiting when the scan is slow don't wait
+    for a full batch.
+    """
+    done = False
+    while not done:
+        batch = []
+        while len(batch) < DETECT_BATCH_SIZE:
+            try:
+                item = in_queue.get(block=not batch)
+            except Empty:
+                break
+            if item is STOP:
+                done = True
+                break
+            batch.append(item)
+        if not batch:
+            continue
+        try:
+            stored = record_scanned([relative_path for relative_path, _ in batch])
+        except Exception as e:
+            print(f"Error recording {len(batch)} scanned file(s): {e}")
+            for relative_path, _ in batch:
+                mark_failed(relative_path)
+            continue
+        for relative_path, file_info in batch:
+            try:
+                out = detect_change(relative_path, file_info, stored.get(relative_path))
+            except Exception as e:
+                print(f"Error in pipeline stage detect_change for {relative_path}: {e}")
+                mark_failed(relative_path)
+                continue
+            if out is not None:
+                out_queue.put(out)
+
+def detect_change(relative_path, file_info, stored_info):
+    """
+    Drops files that match their stored record. Files whose mtime, size or inode
+    changed go on to be hashed.
+    """
+    if file_info.get('unchanged'):
+        if stored_info:
+            return None
+        # Directory is unchanged but we have no record of the file: stat it now
+        stat = os.stat(file_info['local_path'])
+        file_info = {'local_path': file_info['local_path'], 'mtime': stat.st_mtime, 'size': stat.st_size,
+                     'inode': stat.st_ino}
+
+    if stored_info and matches_stored(file_info, stored_info):
+        return None
+    file_info['is_update'] = stored_info is not None
+    file_info['stored_info'] = stored_info
+    return relative_path, file_info
+
+def matches_stored(file_info, stored_info):
+    """Same mtime, size and inode as recorded: the file is taken to be unchanged without hashing."""
+    return file_info['mtime'] == stored_info['mtime'] and file_info['size'] == stored_info['size'] \
+        and stored_info['inode'] in (None, file_info['inode'])
+
+def find_moved_from(relative_path, file_info):
+    """
+    Looks in the files_quickxor index for a stored file with the same content
+    whose path no longer exists locally and is part of this run. The match is
+    claimed so it isn't deleted at the end of the run. Returns (old_path, onedrive_id).
+    """
+    rows = conn.execute('''
+        SELECT relative_path, onedrive_id FROM files WHERE quickxor = ? AND size = ? AND onedrive_id IS NOT NULL
+    ''', (file_info['quickxor'], file_info['size'])).fetchall()
+    for old_path, onedrive_id in rows:
+        if old_path == relative_path or not in_scan_scope(old_path) \
+                or os.path.exists(os.path.join(LOCAL_ROOT_FOLDER, old_path)):
+            continue
+        if claim_vanished(old_path):
+            return old_path, onedrive_id
+    return None
+
+def check_content_hash(relative_path, file_info):
+    """
+    Runs once the file's quickXorHash is known. A file whose content matches the
+    stored hash was only touched: its row gets the new mtime/size/inode and
+    OneDrive gets the new timestamp, but the bytes are not uploaded again. A new
+    file matching a vanished one is marked as a move.
+    """
+    stored_info = file_info.pop('stored_info')
+    if not stored_info:
+        file_info['moved_from'] = find_moved_from(relative_path, file_info)
+        remote = find_remote_file(os.path.join(GEO_FOLDER, relative_path).replace('\\', '/'))
+        if not file_info['moved_from'] and remote and remote[1:] == (file_info['quickxor'], file_info['size']) \
+                and confirm_remote_file(remote[0], file_info['quickxor']):
+            # Already on OneDrive (e.g. the local database was lost); just record it
+            sync_db.write('''
+                INSERT OR REPLACE INTO files (relative_path, mtime, size, onedrive_id, inode, quickxor)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (relative_path, file_info['mtime'], file_info['size'], remote[0], file_info['inode'],
+                  file_info['quickxor']))
+            print(f"Already on OneDrive, not uploading: {relative_path}")
+            return None
+    if stored_info and stored_info['quickxor'] == file_info['quickxor']:
+        sync_db.write('''
+            UPDATE files SET mtime = ?, size = ?, inode = ? WHERE relative_path = ?
+        ''', (file_info['mtime'], file_info['size'], file_info['inode'], relative_path))
+        if stored_info['onedrive_id']:  # Packed files have no item of their own
+            update_onedrive_metadata(stored_info['onedrive_id'], file_info['mtime'], file_info['mtime'])
+        print(f"Content unchanged, updated timestamp only: {relative_path}")
+        return None
+    return relative_path, file_info
+
+def hash_stage(in_queue, out_queue):
+    """
+    Hashes files in a process pool, keeping up to HASH_WINDOW in flight and
+    passing them on in scan order.
+    """
+    window = deque()
+    pool = get_hash_pool()
+    while True:
+        try:
+            item = in_queue.get(timeout=0.05 if window else None)
+        except Empty:
+            item = None
+        if item is STOP:
+            break
+        if item is not None:
+            window.append((item, pool.submit(quickxorhash.hash_file, item[1]['local_path'])))
+        # Wait on the oldest hash when the window is full or the input is idle
+        if window and (len(window) >= HASH_WINDOW or item is None):
+            finish_hash(out_queue, *window.popleft())
+        while window and window[0][1].done():
+            finish_hash(out_queue, *window.popleft())
+    while window:
+        finish_hash(out_queue, *window.popleft())
+
+def get_hash_pool():
+    """The hashing processes are started once and reused by every pipeline run."""
+    global hash_pool
+    if hash_pool is None:
+        hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+    return hash_pool
+
+def finish_hash(out_queue, item, future):
+    relative_path, file_info = item
+    try:
+        file_info['quickxor'] = future.result()
+        out = check_content_hash(relative_path, file_info)
+    except Exception as e:
+        print(f"Error hashing {relative_path}: {e}")
+        mark_failed(relative_path)
+        return
+    if out is not None:
+        out_queue.put(out)
+
+def folder_stage(in_queue, out_queue):
+    """
+    Forwards files whose OneDrive folder is already known straight away. Files
+    needing a new folder are held back until GRAPH_BATCH_LIMIT distinct folders
+    are pending or the input goes quiet, then created together via $batch.
+    """
+    waiting = []
+    missing = set()
+    while True:
+        try:
+            item = in_queue.get(timeout=BATCH_FLUSH_INTERVAL if waiting else None)
+        except Empty:
+            item = None
+
+        if item is not None and item is not STOP:
+            folder = onedrive_parent_folder(item[0])
+            if not folder or folder_known(folder):
+                out_queue.put(item)
+                continue
+            waiting.append(item)
+            missing.add(folder)
+            if len(missing) < GRAPH_BATCH_LIMIT:
+                continue
+
+        if waiting:
+            try:
+                build_onedrive_folder_cache(missing)
+            except Exception as e:
+                print(f"Error creating folders on OneDrive: {e}")
+            for waiting_item in waiting:
+                out_queue.put(waiting_item)
+            waiting = []
+            missing = set()
+        if item is STOP:
+            break
 
 def upload_worker(relative_path, file_info):
     onedrive_path = os.path.join(GEO_FOLDER, relative_path).replace('\\', '/')
-    with lock:
-        stored_info = stored_files.get(relative_path)
-
-    if stored_info:
-        # Check if file changed
-        if file_info['mtime'] != stored_info['mtime'] or file_info['size'] != stored_info['size']:
-            file_resp = upload_file_to_onedrive(file_info['local_path'], onedrive_path, file_info['mtime'])
-            if file_resp:
-                with lock:
-                    cursor.execute('''
-                        UPDATE files SET mtime = ?, size = ? WHERE relative_path = ?
-                    ''', (file_info['mtime'], file_info['size'], relative_path))
-                    conn.commit()
-                    print(f"Updated file on OneDrive: {onedrive_path}")
-        with lock:
-            if relative_path in stored_files:
-                del stored_files[relative_path]
+    moved = None
+    uploaded = None
+    if file_info.get('moved_from'):
+        moved = move_onedrive_item(file_info['moved_from'][1], onedrive_path)
+    if not moved:
+        uploaded = upload_file_to_onedrive(file_info['local_path'], onedrive_path, file_info['mtime'],
+                                           file_info['quickxor'])
+    finish_upload(relative_path, file_info, moved, uploaded)
+
+def finish_upload(relative_path, file_info, moved, uploaded):
+    """
+    Records the item returned by a successful move or upload (None if it failed).
+    Shared by the thread and asyncio engines.
+    """
+    onedrive_path = os.path.join(GEO_FOLDER, relative_path).replace('\\', '/')
+    moved_from = file_info.get('moved_from')
+    file_resp = moved or uploaded
+    if not file_resp:
+        mark_failed(relative_path)
+        return
+    if moved:
+        metrics.inc('files_moved_total')
+        print(f"Moved on OneDrive: {moved_from[0]} -> {relative_path}")
+    elif moved_from:
+        # The move failed but the upload worked; drop the copy at the old path
+        delete_onedrive_item(moved_from[1], moved_from[0])
+        moved_from = None
+    server_hash = file_resp.get('file', {}).get('hashes', {}).get('quickXorHash')
+    if server_hash and server_hash != file_info['quickxor']:
+        # Usually the file changed while we uploaded it; try again next run
+        print(f"Hash mismatch after upload for {onedrive_path}: local {file_info['quickxor']}, OneDrive {server_hash}")
+        mark_failed(relative_path)
+        return
+    sync_db.write('''
+        INSERT OR REPLACE INTO files (relative_path, mtime, size, onedrive_id, inode, quickxor)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (relative_path, file_info['mtime'], file_info['size'], file_resp['id'], file_info['inode'],
+          file_info['quickxor']))
+    record_remote_file(onedrive_path, file_resp)
+    remember_uploaded_content(file_info['quickxor'], file_info['size'], file_resp['id'])
+    if moved_from:
+        sync_db.write('DELETE FROM files WHERE relative_path = ?', (moved_from[0],))
+        return
+    if not file_resp.get('copied'):
+        metrics.inc('files_uploaded_total')
+        metrics.inc('upload_file_bytes_total', file_info['size'])
+    if file_info['is_update']:
+        forget_packed_file(relative_path)  # In case it was packed until now
+        print(f"Updated file on OneDrive: {onedrive_path}")
     else:
-        # New file
-        file_resp = upload_file_to_onedrive(file_info['local_path'], onedrive_path, file_info['mtime'])
-        if file_resp:
-            with lock:
-                cursor.execute('''
-                    INSERT INTO files (relative_path, mtime, size, onedrive_id)
-                    VALUES (?, ?, ?, ?)
-                ''', (relative_path, file_info['mtime'], file_info['size'], file_resp['id']))
-                conn.commit()
-                print(f"Uploaded new file to OneDrive: {onedrive_path}")
+        print(f"Uploaded new file to OneDrive: {onedrive_path}")
+
+def schedule_stage(in_queue, small_lane, large_lane):
+    """
+    Sorts files into the two upload lanes. Lane entries are (priority, seq, item):
+    newest mtime first in the small lane, largest first in the large lane. Moves
+    are a single PATCH, so they always take the small lane.
+    """
+    seq = count()
+    while True:
+        item = in_queue.get()
+        if item is STOP:
+            break
+        file_info = item[1]
+        if file_info['size'] >= SMALL_FILE_SIZE and not file_info.get('moved_from'):
+            large_lane.put((-file_info['size'], next(seq), item))
+        else:
+            small_lane.put((-file_info['mtime'], next(seq), item))
+    # STOP sorts after every file, so each worker finishes its lane first
+    for _ in range(MAX_WORKERS - LARGE_LANE_WORKERS):
+        small_lane.put((float('inf'), next(seq), STOP))
+    for _ in range(LARGE_LANE_WORKERS):
+        large_lane.put((float('inf'), next(seq), STOP))
+
+def lane_worker(lane, spare_lane=None):
+    """
+    Uploads files from lane in priority order. With a spare_lane, the worker
+    helps out there whenever its own lane is empty, so its budget never idles.
+    """
+    while True:
+        try:
+            item = lane.get_nowait()[2]
+        except Empty:
+            item = None
+            if spare_lane is not None:
+                try:
+                    entry = spare_lane.get_nowait()
+                    if entry[2] is STOP:
+                        spare_lane.put(entry)  # That STOP is for the other lane's own workers
+                        spare_lane = None
+                    else:
+                        item = entry[2]
+                except Empty:
+                    pass
+            if item is None:
+                try:
+                    item = lane.get(timeout=LANE_POLL_INTERVAL if spare_lane is not None else None)[2]
+                except Empty:
+                    continue
+        if item is STOP:
+            break
+        try:
+            upload_worker(*item)
+        except Exception as e:
+            print(f"Error in pipeline stage upload_worker for {item[0]}: {e}")
+            mark_failed(item[0])
+
+def run_pipeline(items):
+    """
+    Runs (relative_path, file_info) items from a scan or from watch events through
+    the stages. With ENGINE = 'async', one event loop replaces the folder stage
+    and the upload lanes.
+    """
+    scan_queue = Queue(PIPELINE_QUEUE_SIZE)
+    hash_queue = Queue(PIPELINE_QUEUE_SIZE)
+    folder_queue = Queue(PIPELINE_QUEUE_SIZE)
+    upload_queue = Queue(PIPELINE_QUEUE_SIZE)
+    # In pack mode small files leave the pipeline after hashing
+    pack_queue = Queue(PIPELINE_QUEUE_SIZE) if PACK_MODE else folder_queue
+
+    scanner = Thread(target=scan_stage, args=(scan_queue, items), daemon=True)
+    detector = Thread(target=detect_stage, args=(scan_queue, hash_queue), daemon=True)
+    hasher = Thread(target=hash_stage, args=(hash_queue, pack_queue), daemon=True)
+    packers = [Thread(target=run_stage, args=(pack_stage, pack_queue, folder_queue), daemon=True)] if PACK_MODE else []
+    if ENGINE == 'async':
+        folder_creator = Thread(target=async_upload_stage, args=(folder_queue,), daemon=True)
+        uploaders = []
+    else:
+        folder_creator = Thread(target=folder_stage, args=(folder_queue, upload_queue), daemon=True)
+        small_lane = PriorityQueue(LANE_QUEUE_SIZE)
+        large_lane = PriorityQueue(LANE_QUEUE_SIZE)
+        uploaders = [Thread(target=schedule_stage, args=(upload_queue, small_lane, large_lane), daemon=True)]
+        uploaders += [Thread(target=lane_worker, args=(small_lane,), daemon=True)
+                      for _ in range(MAX_WORKERS - LARGE_LANE_WORKERS)]
+        uploaders += [Thread(target=lane_worker, args=(large_lane, small_lane), daemon=True)
+                      for _ in range(LARGE_LANE_WORKERS)]
+    # Where items pile up shows which stage is the bottleneck
+    for stage, queue in [('detect', scan_queue), ('hash', hash_queue), ('folder', folder_queue),
+                         ('schedule', upload_queue)]:
+        metrics.register_gauge('pipeline_queue_depth', queue.qsize, stage=stage)
+    if ENGINE != 'async':
+        metrics.register_gauge('pipeline_queue_depth', small_lane.qsize, stage='small_lane')
+        metrics.register_gauge('pipeline_queue_depth', large_lane.qsize, stage='large_lane')
+    for t in [scanner, detector, hasher] + packers + [folder_creator] + uploaders:
+        t.start()
+
+    # Shut the stages down in order once each upstream stage has drained
+    scanner.join()
+    detector.join()
+    hash_queue.put(STOP)
+    hasher.join()
+    for t in packers:
+        pack_queue.put(STOP)
+        t.join()
+    folder_queue.put(STOP)
+    folder_creator.join()
+    upload_queue.put(STOP)
+    for t in uploaders:
+        t.join()
+
+# -----------------------------
+# Asyncio Upload Engine
+# -----------------------------
+# Scanning, change detection and hashing are shared with the thread engine;
+# folder creation, moves and small uploads then run as tasks on one event loop,
+# up to ASYNC_MAX_IN_FLIGHT at a time. Files big enough for an upload session
+# are bandwidth-bound rather than latency-bound, so they go to the existing
+# chunked uploader on MAX_WORKERS threads. Metadata PATCHes and deletes still
+# go through the $batch thread, which already sends them 20 to a request.
+# Requests take their slots from the same governor as the threads, with its
+# ceiling raised to ASYNC_MAX_IN_FLIGHT, and upload bodies are read into the
+# pooled buffers, up to ASYNC_BUFFER_MEMORY bytes of them at once.
+async_buffer_free = 0      # Bytes of ASYNC_BUFFER_MEMORY not held by an upload
+async_buffer_cond = None
+
+def async_upload_stage(in_queue):
+    governor.MAX_LIMIT = max(governor.MAX_LIMIT, ASYNC_MAX_IN_FLIGHT)
+    asyncio.run(async_upload_loop(in_queue))
+
+async def async_upload_loop(in_queue):
+    global async_buffer_free, async_buffer_cond
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+    async_buffer_free = ASYNC_BUFFER_MEMORY
+    async_buffer_cond = asyncio.Condition()
+    folders = {}  # OneDrive folder path -> task creating it, so each is created once
+    tasks = set()
+    connector = aiohttp.TCPConnector(limit=ASYNC_MAX_IN_FLIGHT)
+    timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as large_files:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            while True:
+                item = await loop.run_in_executor(None, in_queue.get)
+                if item is STOP:
+                    break
+                await slots.acquire()  # Backpressure: don't take more files than we can work on
+                task = asyncio.create_task(async_upload_item(session, folders, large_files, *item))
+                tasks.add(task)
+                task.add_done_callback(lambda t: (tasks.discard(t), slots.release()))
+            if tasks:
+                await asyncio.gather(*tasks)
+
+async def async_request(session, method, url, headers=None, data=None, json_data=None):
+    """
+    make_request_with_retry for the event loop. Returns (status, parsed JSON
+    body), or (None, None) once the retries are used up.
+    """
+    kind = endpoint_kind(method, url)
+    latency_kind = governor_kind(kind, data)
+    attempt = 1
+    throttled = 0
+    while True:
+        started = await governor.acquire_async()
+        status = None
+        retry_after = None
+        paced = data
+        if data:
+            # Upload bodies are paced; the iterator is rebuilt for each attempt
+            paced = bandwidth.PacedBlocks(data)
+            headers = {**headers, 'Content-Length': str(len(data))}
+        try:
+            async with session.request(method, url, headers=headers, data=paced, json=json_data) as resp:
+                status = resp.status
+                if status < 500 and status != 429:
+                    content = await resp.read()
+                    return status, json.loads(content) if content else None
+                retry_after = governor.parse_retry_after(resp.headers.get('Retry-After'))
+                print(f"Transient HTTP error {status} on attempt {attempt}. Retrying...")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Connection error on attempt {attempt}: {e}")
+        finally:
+            started += getattr(paced, 'waited', 0.0)
+            governor.release(started, latency_kind, status, retry_after)
+            record_request(kind, time.monotonic() - started, status, retry_after)
+
+        if retry_after is not None and throttled < MAX_THROTTLED_RETRIES:
+            # The governor holds every request back, on threads and the event loop, until Retry-After has passed
+            throttled += 1
+            metrics.inc('graph_retries_total', endpoint=kind)
+            continue
+        if attempt >= MAX_RETRIES:
+            break
+        await asyncio.sleep(governor.jittered(INITIAL_BACKOFF * 2 ** (attempt - 1)))
+        attempt += 1
+        metrics.inc('graph_retries_total', endpoint=kind)
+
+    print(f"All {MAX_RETRIES} retry attempts failed for {url}.")
+    return None, None
+
+async def async_ensure_folder(session, folders, folder_path):
+    """Creates folder_path and its parents on OneDrive; concurrent callers share one attempt."""
+    if not folder_path or folder_known(folder_path):
+        return True
+    if folder_path not in folders:
+        folders[folder_path] = asyncio.ensure_future(async_create_folder(session, folders, folder_path))
+    return await folders[folder_path]
+
+async def async_create_folder(session, folders, folder_path):
+    parent = os.path.dirname(folder_path)
+    if not await async_ensure_folder(session, folders, parent):
+        return False
+    url = f'{GRAPH_URL}/me/drive/root:/{quote(parent)}:/children' if parent else f'{GRAPH_URL}/me/drive/root/children'
+    body = {'name': os.path.basename(folder_path), 'folder': {}, '@microsoft.graph.conflictBehavior': 'fail'}
+    headers = {'Authorization': f'Bearer {auth.get_access_token()}', 'Content-Type': 'application/json'}
+    status, _ = await async_request(session, 'POST', url, headers=headers, json_data=body)
+    if status and (status < 400 or status == 409):
+        existing_folders.add(folder_path)
+        return True
+    print(f"Failed to create folder '{folder_path}': {status or 'No Response'}")
+    return False
+
+async def async_upload_item(session, folders, large_files, relative_path, file_info):
+    loop = asyncio.get_running_loop()
+    onedrive_path = os.path.join(GEO_FOLDER, relative_path).replace('\\', '/')
+    moved = None
+    uploaded = None
+    try:
+        if not await async_ensure_folder(session, folders, onedrive_parent_folder(relative_path)):
+            mark_failed(relative_path)
+            return
+        if file_info.get('moved_from'):
+            item_id = file_info['moved_from'][1]
+            headers = {'Authorization': f'Bearer {auth.get_access_token()}', 'Content-Type': 'application/json'}
+            data = {
+                'parentReference': {'path': f'/drive/root:/{os.path.dirname(onedrive_path)}'},
+                'name': os.path.basename(onedrive_path)
+            }
+            status, body = await async_request(session, 'PATCH', f'{GRAPH_URL}/me/drive/items/{item_id}',
+                                               headers=headers, json_data=data)
+            if status and status < 400:
+                moved = body
+            else:
+                print(f"Failed to move item {item_id} to {onedrive_path}: {status or 'No Response'}")
+        if not moved and file_info['size'] >= DEDUPE_MIN_SIZE:
+            # Copies poll their monitor URL, so they run with the large files
+            uploaded = await loop.run_in_executor(large_files, copy_existing_content, file_info['quickxor'],
+                                                  file_info['size'], onedrive_path, file_info['mtime'])
+        if not (moved or uploaded) and file_info['size'] < SMALL_FILE_SIZE:
+            uploaded = await async_simple_upload(session, file_info['local_path'], onedrive_path, file_info['mtime'],
+                                                 file_info['size'])
+        elif not (moved or uploaded):
+            uploaded = await loop.run_in_executor(large_files, upload_file_to_onedrive, file_info['local_path'],
+                                                  onedrive_path, file_info['mtime'])
+        finish_upload(relative_path, file_info, moved, uploaded)
+    except Exception as e:
+        print(f"Error uploading {relative_path}: {e}")
+        mark_failed(relative_path)
+
+async def async_simple_upload(session, local_file_path, onedrive_path, mtime, size):
+    """simple_upload_file for the event loop; the read into a pooled buffer runs off the loop."""
+    held = await hold_buffer_memory(size)
+    try:
+        try:
+            buf, content = await asyncio.get_running_loop().run_in_executor(None, read_pooled, local_file_path)
+        except (PermissionError, FileNotFoundError, OSError) as e:
+            print(f"Error reading file {local_file_path}: {e}")
+            return None
+        try:
+            headers = {'Authorization': f'Bearer {auth.get_access_token()}'}
+            # An empty body would be sent chunked; empty files go up as b''
+            status, file_info = await async_request(session, 'PUT',
+                                                    f'{GRAPH_URL}/me/drive/root:/{onedrive_path}:/content',
+                                                    headers=headers, data=content if len(content) else b'')
+        finally:
+            release_buffer(buf)
+    finally:
+        await free_buffer_memory(held)
+    if not status or status >= 400:
+        print(f"Failed to upload file: {local_file_path} => {status or 'No Resp'}")
+        return None
+    if len(content) > SKIP_METADATA_THRESHOLD:
+        update_onedrive_metadata(file_info['id'], mtime, mtime)
+    return file_info
+
+async def hold_buffer_memory(size):
+    """
+    Waits until a buffer for size bytes fits in what is left of ASYNC_BUFFER_MEMORY
+    and takes it; returns the bytes to give back with free_buffer_memory().
+    """
+    global async_buffer_free
+    held = min(buffer_size(size), ASYNC_BUFFER_MEMORY)
+    async with async_buffer_cond:
+        await async_buffer_cond.wait_for(lambda: async_buffer_free >= held)
+        async_buffer_free -= held
+    return held
+
+async def free_buffer_memory(held):
+    global async_buffer_free
+    async with async_buffer_cond:
+        async_buffer_free += held
+        async_buffer_cond.notify_all()
+
+def read_pooled(path):
+    """A whole file read into a pooled buffer, as (buffer, view) like read_chunk."""
+    with open(path, 'rb') as f:
+        return read_chunk(f, 0, os.fstat(f.fileno()).st_size)
+
+# -----------------------------
+# Pack Mode
+# -----------------------------
+# With PACK_MODE, files under PACK_MAX_FILE_SIZE are held back after hashing and
+# packed at the end of the run. Files are grouped by their directory
+# PACK_GROUP_DEPTH levels below the root, and each group's files are compressed
+# one by one into archives of up to PACK_ARCHIVE_SIZE under PACK_FOLDER/<group>/.
+# packed_files is the manifest (path -> archive, offset, length, quickXorHash).
+# A packed file keeps its files row, without an onedrive_id, so change
+# detection treats it like any other file.
+#
+# Archives are never rewritten in place. Changed files go into a new archive,
+# and an old archive is deleted once nothing points into it. It is repacked, its
+# live files carried over into the new archive, once less than PACK_REPACK_RATIO
+# of it is in use.
+pending_packs = {}           # group -> [(relative_path, file_info)] waiting to be packed
+pending_pack_count = 0
+touched_pack_groups = set()  # Groups whose archives lost files this run
+
+def pack_group(relative_path):
+    """The directory an archive for this file goes under ('' for the top)."""
+    return '/'.join(relative_path.replace('\\', '/').split('/')[:-1][:PACK_GROUP_DEPTH])
+
+def pack_stage(relative_path, file_info):
+    """
+    Takes small files out of the pipeline (a run_stage handler). Moves go on as
+    usual: a PATCH is cheaper than packing the file again.
+    """
+    global pending_pack_count
+    if file_info['size'] >= PACK_MAX_FILE_SIZE or file_info.get('moved_from'):
+        return relative_path, file_info
+    if file_info['is_update']:
+        # Uploaded on its own before pack mode; that item goes once the file is packed
+        row = conn.execute('SELECT onedrive_id FROM files WHERE relative_path = ?', (relative_path,)).fetchone()
+        file_info['replaces'] = row[0] if row else None
+    pending_packs.setdefault(pack_group(relative_path), []).append((relative_path, file_info))
+    pending_pack_count += 1
+    if pending_pack_count >= PACK_PENDING_LIMIT:
+        flush_packs()
+    return None
+
+def forget_packed_file(relative_path):
+    """Drops a file from the manifest; its archive's group is looked at again by flush_packs()."""
+    row = conn.execute('''
+        SELECT group_dir FROM packed_files JOIN packs ON packs.archive = packed_files.archive
+        WHERE relative_path = ?
+    ''', (relative_path,)).fetchone()
+    if row:
+        touched_pack_groups.add(row[0])
+        sync_db.write('DELETE FROM packed_files WHERE relative_path = ?', (relative_path,))
+
+def flush_packs():
+    """Packs the files collected so far, and repacks groups whose archives lost files."""
+    global pending_pack_count
+    work = [(group, pending_packs.pop(group, [])) for group in sorted(set(pending_packs) | touched_pack_groups)]
+    touched_pack_groups.clear()
+    pending_pack_count = 0
+    if not work:
+        return
+    sync_db.flush()  # The manifest queries must see this run's earlier writes
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {pool.submit(pack_files, group, members): (group, members) for group, members in work}
+        for future, (group, members) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error packing files under '{group}': {e}")
+                for relative_path, _ in members:
+                    mark_failed(relative_path)
+
+def pack_files(group, members):
+    """
+    Writes members (new or changed files) into new archives for group, along
+    with the live files of archives that have fallen below PACK_REPACK_RATIO,
+    then deletes the archives nothing points into any more.
+    """
+    member_paths = {relative_path for relative_path, _ in members}
+    leaving = {}  # archive -> compressed bytes of members moving out of it
+    for relative_path in member_paths:
+        row = conn.execute('SELECT archive, length FROM packed_files WHERE relative_path = ?',
+                           (relative_path,)).fetchone()
+        if row:
+            leaving[row[0]] = leaving.get(row[0], 0) + row[1]
+    archives = conn.execute('''
+        SELECT packs.archive, packs.onedrive_id, packs.size, COALESCE(SUM(packed_files.length), 0)
+        FROM packs LEFT JOIN packed_files ON packed_files.archive = packs.archive
+        WHERE packs.group_dir = ? GROUP BY packs.archive
+    ''', (group,)).fetchall()
+    retired = []
+    entries = list(members)
+    for archive, onedrive_id, size, live in archives:
+        live -= leaving.get(archive, 0)
+        if live < size * PACK_REPACK_RATIO:
+            retired.append((archive, onedrive_id))
+            rows = conn.execute('SELECT relative_path FROM packed_files WHERE archive = ?', (archive,)).fetchall()
+            entries += [(path, None) for (path,) in rows if path not in member_paths]
+    if not entries and not retired:
+        return
+
+    complete = True  # Old archives are only deleted once everything in them is in a new one
+    batch = []       # (relative_path, file_info or None if carried over, offset, length, quickxor)
+    blob = bytearray()
+    for relative_path, file_info in entries:
+        local_path = os.path.join(LOCAL_ROOT_FOLDER, relative_path)
+        try:
+            with open(local_path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Error reading file {local_path}: {e}")
+            if file_info:
+                mark_failed(relative_path)
+            else:
+                complete = False
+            continue
+        compressed = zlib.compress(data, PACK_COMPRESSION_LEVEL)
+        if blob and len(blob) + len(compressed) > PACK_ARCHIVE_SIZE:
+            complete = upload_pack_archive(group, blob, batch) and complete
+            blob, batch = bytearray(), []
+        batch.append((relative_path, file_info, len(blob), len(compressed), quickxorhash.hash_bytes(data)))
+        blob += compressed
+    if batch:
+        complete = upload_pack_archive(group, blob, batch) and complete
+
+    if complete and retired:
+        sync_db.flush()  # The new manifest must be committed before the archives it replaces go
+        for archive, onedrive_id in retired:
+            delete_pack_archive(archive, onedrive_id)
+
+def upload_pack_archive(group, blob, batch):
+    archive = '/'.join(part for part in (PACK_FOLDER, group, f'{uuid.uuid4().hex}.pack') if part)
+    headers = {'Authorization': f'Bearer {auth.get_access_token()}'}
+    resp = make_request_with_retry('PUT', f'{GRAPH_URL}/me/drive/root:/{archive}:/content', headers=headers,
+                                   data=bandwidth.PacedReader(blob))
+    if resp is None or resp.status_code >= 400:
+        print(f"Failed to upload archive {archive}: {resp.status_code if resp is not None else 'No Resp'}")
+        for relative_path, file_info, *_ in batch:
+            if file_info:
+                mark_failed(relative_path)
+        return False
+
+    sync_db.write('INSERT INTO packs (archive, group_dir, onedrive_id, size) VALUES (?, ?, ?, ?)',
+                  (archive, group, resp.json()['id'], len(blob)))
+    for relative_path, file_info, offset, length, quickxor in batch:
+        sync_db.write('''
+            INSERT OR REPLACE INTO packed_files (relative_path, archive, offset, length, quickxor)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (relative_path, archive, offset, length, quickxor))
+        if not file_info:
+            continue
+        sync_db.write('''
+            INSERT OR REPLACE INTO files (relative_path, mtime, size, onedrive_id, inode, quickxor)
+            VALUES (?, ?, ?, NULL, ?, ?)
+        ''', (relative_path, file_info['mtime'], file_info['size'], file_info['inode'], quickxor))
+        if file_info.get('replaces'):
+            delete_replaced_item(file_info['replaces'], relative_path)
+    packed = sum(1 for entry in batch if entry[1])
+    metrics.inc('files_packed_total', packed)
+    metrics.inc('pack_archives_uploaded_total')
+    print(f"Packed {packed} file(s) into {archive} ({len(batch) - packed} carried over, {len(blob)} bytes)")
+    return True
+
+def delete_pack_archive(archive, onedrive_id):
+    def on_done(sub_resp):
+        if sub_resp and (sub_resp['status'] < 400 or sub_resp['status'] == 404):
+            sync_db.write('DELETE FROM packs WHERE archive = ?', (archive,))
+            forget_remote_item(onedrive_id)
+        else:
+            print(f"Failed to delete archive {archive}: {batch_status(sub_resp)}")
+
+    queue_graph_request('DELETE', f'/me/drive/items/{onedrive_id}', on_done=on_done)
+
+def delete_replaced_item(item_id, relative_path):
+    """Deletes the separate upload of a file that is now packed; its files row is left alone."""
+    def on_done(sub_resp):
+        if not sub_resp or (sub_resp['status'] >= 400 and sub_resp['status'] != 404):
+            print(f"Failed to delete item {item_id} ({relative_path}): {batch_status(sub_resp)}")
+        else:
+            forget_remote_item(item_id)
+
+    queue_graph_request('DELETE', f'/me/drive/items/{item_id}', on_done=on_done)
+
+def restore_packed_files(dest_folder, prefix=''):
+    """
+    Restores the packed files at or below prefix into dest_folder, with one
+    download per archive. Files are checked against their quickXorHash and
+    given their recorded mtime. Returns how many were restored.
+    """
+    rows = conn.execute('''
+        SELECT packs.archive, packs.onedrive_id, packed_files.relative_path, packed_files.offset,
+               packed_files.length, packed_files.quickxor, files.mtime
+        FROM packed_files JOIN packs ON packs.archive = packed_files.archive
+        LEFT JOIN files ON files.relative_path = packed_files.relative_path
+        WHERE ? = '' OR packed_files.relative_path = ?
+            OR (packed_files.relative_path >= ? AND packed_files.relative_path < ?)
+        ORDER BY packs.archive, packed_files.offset
+    ''', (prefix, prefix, prefix + '/', prefix + '0')).fetchall()
+    by_archive = {}
+    for archive, onedrive_id, *member in rows:
+        by_archive.setdefault((archive, onedrive_id), []).append(member)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        restored = sum(pool.map(lambda entry: restore_archive(dest_folder, *entry[0], entry[1]), by_archive.items()))
+    print(f"Restored {restored} of {len(rows)} packed file(s) into {dest_folder}")
+    return restored
+
+def restore_archive(dest_folder, archive, onedrive_id, members):
+    headers = {'Authorization': f'Bearer {auth.get_access_token()}'}
+    resp = make_request_with_retry('GET', f'{GRAPH_URL}/me/drive/items/{onedrive_id}/content', headers=headers)
+    if resp is None or resp.status_code >= 400:
+        print(f"Failed to download archive {archive}: {resp.status_code if resp is not None else 'No Resp'}")
+        return 0
+    blob = resp.content
+    restored = 0
+    for relative_path, offset, length, quickxor, mtime in members:
+        try:
+            data = zlib.decompress(blob[offset:offset + length])
+        except zlib.error as e:
+            print(f"Packed copy of {relative_path} in {archive} is corrupt ({e}); skipped")
+            continue
+        if quickxorhash.hash_bytes(data) != quickxor:
+            print(f"Packed copy of {relative_path} in {archive} does not match its hash; skipped")
+            continue
+        local_path = os.path.join(dest_folder, relative_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(local_path, (mtime, mtime))
+        restored += 1
+    return restored
+
+# -----------------------------
+# Watch Mode
+# -----------------------------
+# Events are coalesced per path until the batch is due: a file written many
+# times is uploaded once, and a rename chain ends up as "old path deleted, new
+# path changed", which the hash index turns into a single move. Directory moves
+# are kept whole so they cost one Graph PATCH instead of one per file.
+watch_events = {}     # relative path -> 'file' (changed), 'dir' (new, scan it) or 'deleted'
+watch_dir_moves = []  # [old_dir, new_dir] pairs in the order they happened
+watch_first_event = None
+watch_last_event = None
+watch_lock = Lock()
+
+def watch_relative_path(path):
+    """Relative path of an event inside LOCAL_ROOT_FOLDER, or None to ignore it."""
+    path = os.path.abspath(path)
+    if path.startswith(os.path.abspath(DATABASE_FILE)):
+        return None  # Our own database, if it lives inside the synced folder
+    relative_path = os.path.relpath(path, LOCAL_ROOT_FOLDER)
+    if relative_path == '.' or relative_path.startswith('..'):
+        return None
+    return relative_path.replace('\\', '/')
+
+def touch_watch_batch():
+    global watch_first_event, watch_last_event
+    watch_last_event = time.monotonic()
+    if watch_first_event is None:
+        watch_first_event = watch_last_event
+
+def record_watch_event(path, kind):
+    relative_path = watch_relative_path(path)
+    if relative_path is None:
+        return
+    with watch_lock:
+        if not (kind == 'file' and watch_events.get(relative_path) == 'dir'):
+            watch_events[relative_path] = kind
+        touch_watch_batch()
+
+def record_watch_move(src_path, dest_path, is_directory):
+    old = watch_relative_path(src_path)
+    new = watch_relative_path(dest_path)
+    if old is None or new is None:
+        # Moved in from, or out to, somewhere we don't sync
+        if new is not None:
+            record_watch_event(dest_path, 'dir' if is_directory else 'file')
+        elif old is not None:
+            record_watch_event(src_path, 'deleted')
+        return
+    with watch_lock:
+        touch_watch_batch()
+        if not is_directory:
+            watch_events[old] = 'deleted'
+            watch_events[new] = 'file'
+            return
+        # Pending events inside the directory now live under its new path
+        for path in [p for p in watch_events if p == old or p.startswith(old + '/')]:
+            watch_events[new + path[len(old):]] = watch_events.pop(path)
+        if watch_events.get(new) == 'dir':
+            return  # Created in this batch, so there is nothing on OneDrive to move yet
+        for move in watch_dir_moves:
+            if move[1] == old:
+                move[1] = new  # a -> b -> c is a single move a -> c
+                if move[0] == new:
+                    watch_dir_moves.remove(move)
+                return
+        watch_dir_moves.append([old, new])
+
+class WatchHandler(FileSystemEventHandler):
+    def on_any_event(self, event):
+        if event.event_type == 'moved':
+            # Moves of a directory's contents are synthesised after the directory's
+            # own move event; the directory move already covers them
+            if not event.is_synthetic:
+                record_watch_move(event.src_path, event.dest_path, event.is_directory)
+        elif event.event_type == 'deleted':
+            record_watch_event(event.src_path, 'deleted')
+        elif event.is_directory:
+            if event.event_type == 'created':
+                record_watch_event(event.src_path, 'dir')
+        elif event.event_type in ('created', 'modified', 'closed'):
+            record_watch_event(event.src_path, 'file')
+
+def take_watch_batch():
+    """Returns (events, dir_moves) and starts a new batch once the current one is due."""
+    global watch_events, watch_dir_moves, watch_first_event, watch_last_event
+    with watch_lock:
+        if watch_first_event is None:
+            return None
+        now = time.monotonic()
+        if now - watch_last_event < WATCH_DEBOUNCE and now - watch_first_event < WATCH_MAX_DELAY:
+            return None
+        batch = (watch_events, watch_dir_moves)
+        watch_events, watch_dir_moves = {}, []
+        watch_first_event = watch_last_event = None
+    return batch
+
+def watch_items(events):
+    """Yields pipeline items for the changed files and new directories of a watch batch or plan."""
+    seen = set()
+    for relative_path, kind in events.items():
+        local_path = os.path.join(LOCAL_ROOT_FOLDER, relative_path)
+        if kind == 'dir':
+            items = ((f"{relative_path}/{p}", info) for p, info in scan_local_folder(local_path))
+        elif kind == 'file':
+            try:
+                stat = os.stat(local_path)
+            except OSError:
+                continue  # Gone again; its stored record is deleted with the rest
+            items = [(relative_path, {'local_path': local_path, 'mtime': stat.st_mtime, 'size': stat.st_size,
+                                      'inode': stat.st_ino})]
+        else:
+            continue
+        for item in items:
+            if item[0] not in seen:
+                seen.add(item[0])
+                yield item
+
+def process_watch_batch(events, dir_moves):
+    """
+    Syncs one batch: directory moves first, then the changed paths through the
+    upload pipeline, then deletes for whatever is gone.
+    """
+    refresh_remote_index()
+    for old_dir, new_dir in dir_moves:
+        if move_onedrive_folder(old_dir, new_dir):
+            rename_stored_folder(old_dir, new_dir)
+            sync_db.flush()  # Later moves and lookups must see the renamed rows
+            print(f"Moved folder on OneDrive: {old_dir} -> {new_dir}")
+        else:
+            # Upload the folder again; the hash index still turns its files into moves
+            events[old_dir] = 'deleted'
+            events[new_dir] = 'dir'
+
+    begin_scan(events)
+    failed_dirs.clear()
+    run_pipeline(watch_items(events))
+    for relative_path, stored_info in vanished_files():
+        delete_onedrive_item(stored_info['onedrive_id'], relative_path)
+    flush_packs()
+    # Make the next reconcile stat these directories again instead of trusting them
+    for relative_dir in failed_dirs:
+        sync_db.write('DELETE FROM dirs WHERE relative_dir = ?', (relative_dir,))
+    flush_graph_requests()
+    sync_db.flush()
+
+def run_watch_mode():
+    """
+    Syncs once to catch up, then keeps uploading changes as the filesystem
+    reports them, with a reconciling sync every WATCH_RECONCILE_INTERVAL.
+    """
+    observer = Observer()
+    observer.schedule(WatchHandler(), LOCAL_ROOT_FOLDER, recursive=True)
+    observer.start()  # Before the first sync, so nothing changed during it is missed
+    try:
+        sync_once()
+        last_reconcile = time.monotonic()
+        print(f"Watching {LOCAL_ROOT_FOLDER} for changes...")
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            batch = take_watch_batch()
+            try:
+                if batch:
+                    process_watch_batch(*batch)
+                if time.monotonic() - last_reconcile > WATCH_RECONCILE_INTERVAL:
+                    sync_once(trust_dirs=True)
+                    last_reconcile = time.monotonic()
+            except Exception as e:
+                print(f"Error while syncing changes: {e}")
+    finally:
+        observer.stop()
+        observer.join()
+
+# -----------------------------
+# Sync Plans
+# -----------------------------
+# A plan is what a sync would do, worked out from the scan, the files table and
+# the remote index alone, without hashing or uploading. It is written as JSON
+# lines: a header, then one compact action per line:
+#     ["mkdir", onedrive_folder]
+#     ["upload", relative_path, size, mtime, is_update]
+#     ["move", old_path, new_path, onedrive_id, size]   (same inode and size)
+#     ["delete", relative_path, onedrive_id]
+#     ["dir", relative_dir, mtime_ns, inode]            (directory index, saved after a complete apply)
+# Applying a plan re-checks every file, so a plan that has gone stale only costs
+# a few extra stats; moves are confirmed by hash before the PATCH. Actions can
+# be split into shards by path and applied by several processes at once.
+PLAN_VERSION = 1
+
+def shard_of(path, shards):
+    return zlib.crc32(path.encode('utf-8')) % shards
+
+def build_plan():
+    """
+    Returns (header, actions) for syncing LOCAL_ROOT_FOLDER as it is now. Nothing
+    is uploaded, but the remote index is refreshed first, so changes made on
+    OneDrive are stored just as a sync would store them.
+    """
+    begin_scan()
+    refresh_remote_index()
+    last_full_scan = float(get_sync_state('last_full_scan', 0))
+    full_scan = not TRUST_DIRECTORY_MTIME or time.time() - last_full_scan > FULL_RESCAN_INTERVAL
+    known_dirs = None if full_scan else load_directory_index()
+    dir_snapshots = {}
+    created = time.time()
+
+    uploads = []
+    scanned = scan_local_folder(LOCAL_ROOT_FOLDER, known_dirs, dir_snapshots)
+    for batch in iter(lambda: list(islice(scanned, DETECT_BATCH_SIZE)), []):
+        stored = record_scanned([relative_path for relative_path, _ in batch])
+        for relative_path, file_info in batch:
+            stored_info = stored.get(relative_path)
+            if file_info.get('unchanged'):
+                if stored_info:
+                    continue
+                try:
+                    stat = os.stat(file_info['local_path'])
+                except OSError:
+                    continue
+                file_info = {'mtime': stat.st_mtime, 'size': stat.st_size, 'inode': stat.st_ino}
+            if stored_info and matches_stored(file_info, stored_info):
+                continue
+            uploads.append((relative_path, file_info, stored_info is not None))
+
+    # Stored files the scan didn't see are gone locally; a new file with the inode and size of one was
+    # moved there (packed files have no item to move; they are packed again at the new path)
+    stored = dict(vanished_files())
+    vanished = {(info['inode'], info['size']): path for path, info in stored.items()
+                if info['inode'] and info['onedrive_id']}
+    actions = []
+    folders = set()
+    for relative_path, file_info, is_update in uploads:
+        old_path = None if is_update else vanished.pop((file_info['inode'], file_info['size']), None)
+        if old_path:
+            actions.append(['move', old_path, relative_path, stored.pop(old_path)['onedrive_id'], file_info['size']])
+        else:
+            actions.append(['upload', relative_path, file_info['size'], file_info['mtime'], is_update])
+            if PACK_MODE and file_info['size'] < PACK_MAX_FILE_SIZE:
+                continue  # Goes into an archive, not a folder of its own
+        folder = onedrive_parent_folder(relative_path)
+        while folder and folder not in folders and not folder_known(folder):
+            folders.add(folder)
+            folder = os.path.dirname(folder)
+    actions += [['delete', relative_path, info['onedrive_id']] for relative_path, info in stored.items()]
+    # Parents sort before their children
+    actions[:0] = [['mkdir', folder] for folder in sorted(folders, key=lambda f: (f.count('/'), f))]
+    actions += [['dir', relative_dir, *snapshot] for relative_dir, snapshot in dir_snapshots.items()]
+
+    counts = {}
+    for action in actions:
+        counts[action[0]] = counts.get(action[0], 0) + 1
+    header = {'version': PLAN_VERSION, 'root': LOCAL_ROOT_FOLDER, 'created': created, 'full_scan': full_scan,
+              'counts': counts, 'upload_bytes': sum(a[2] for a in actions if a[0] == 'upload')}
+    return header, actions
+
+def write_plan(plan_file, header, actions):
+    with open(plan_file, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        for action in actions:
+            f.write(json.dumps(action, separators=(',', ':')) + '\n')
+
+def read_plan(plan_file):
+    with open(plan_file, 'r', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != PLAN_VERSION:
+            raise ValueError(f"{plan_file} is not a version {PLAN_VERSION} sync plan")
+        return header, [json.loads(line) for line in f]
+
+def print_plan(header, actions, limit=20):
+    counts = header['counts']
+    print(f"Plan for {header['root']}: {counts.get('upload', 0)} upload(s) "
+          f"({header['upload_bytes'] / 1024 / 1024:.1f} MB), {counts.get('move', 0)} move(s), "
+          f"{counts.get('delete', 0)} delete(s), {counts.get('mkdir', 0)} new folder(s)")
+    shown = [action for action in actions if action[0] != 'dir'][:limit]
+    for action in shown:
+        print(f"  {action[0]:6} {' -> '.join(action[1:3]) if action[0] == 'move' else action[1]}")
+    if len(shown) < sum(n for kind, n in counts.items() if kind != 'dir'):
+        print("  ...")
+
+def apply_plan(header, actions, shard=None):
+    """
+    Carries out a plan, or with shard=(k, n) the k-th of n disjoint parts of it.
+    Folders are created first, then files go through the upload pipeline, then
+    deletes; the directory index is only saved once a whole plan is applied.
+    """
+    if header['root'] != LOCAL_ROOT_FOLDER:
+        raise ValueError(f"The plan is for {header['root']}, not {LOCAL_ROOT_FOLDER}")
+    if shard:
+        index, shards = shard
+        # A move is keyed on its new path, so its old path is handled in the same shard
+        actions = [action for action in actions
+                   if action[0] != 'dir' and shard_of(action[2] if action[0] == 'move' else action[1], shards) == index]
+
+    refresh_remote_index()
+    folders = [action[1] for action in actions if action[0] == 'mkdir']
+    if folders:
+        build_onedrive_folder_cache(folders)
+    files = {action[2] if action[0] == 'move' else action[1]: 'file' for action in actions
+             if action[0] in ('upload', 'move')}
+    deletes = [action[1] for action in actions if action[0] == 'delete']
+    move_sources = [action[1] for action in actions if action[0] == 'move']
+    begin_scan(list(files) + deletes + move_sources)
+    failed_dirs.clear()
+    run_pipeline(watch_items(files))
+    for relative_path, stored_info in vanished_files():
+        # Back since the plan was made: leave it for the next sync rather than delete it
+        if not os.path.exists(os.path.join(LOCAL_ROOT_FOLDER, relative_path)):
+            delete_onedrive_item(stored_info['onedrive_id'], relative_path)
+    flush_packs()
+
+    if not shard:
+        save_directory_index({action[1]: action[2:] for action in actions if action[0] == 'dir'}, failed_dirs)
+        if header['full_scan']:
+            set_sync_state('last_full_scan', header['created'])
+    flush_graph_requests()
+    sync_db.flush()
 
 # -----------------------------
 # Main Function
 # -----------------------------
-def main():
-    global result, stored_files
-    result = app.acquire_token_silent(SCOPES, account=None)
-    if not result:
-        result = app.acquire_token_interactive(SCOPES)
-        print("Access token acquired successfully.")
-
-    # 1. Scan local folder
-    current_files = scan_local_folder(LOCAL_ROOT_FOLDER)
-
-    # 2. Load stored records
-    cursor.execute('SELECT relative_path, mtime, size, onedrive_id FROM files')
-    for row in cursor.fetchall():
-        stored_files[row[0]] = {'mtime': row[1], 'size': row[2], 'onedrive_id': row[3]}
-
-    # 3. Pre-create folder structure
-    folder_paths = gather_all_subfolders(current_files)
-    build_onedrive_folder_cache(folder_paths)
-
-    # 4. Parallel upload files
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    file_info_list = [(rp, info) for rp, info in current_files.items()]
-    max_workers = 5  # Adjust for your bandwidth/CPU
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(upload_worker, rp, info) for rp, info in file_info_list]
-        for future in as_completed(futures):
-            exc = future.exception()
-            if exc:
-                print(f"Error in parallel upload thread: {exc}")
-
-    # 5. Handle locally deleted files
-    for relative_path, stored_info in stored_files.items():
-        onedrive_id = stored_info['onedrive_id']
-        delete_onedrive_item(onedrive_id)
-        cursor.execute('DELETE FROM files WHERE relative_path = ?', (relative_path,))
-        conn.commit()
-        print(f"Deleted file from OneDrive: {relative_path}")
+def sync_once(trust_dirs=False):
+    """
+    One full pass: scan, upload what changed, delete what is gone. trust_dirs
+    skips unchanged directories even without TRUST_DIRECTORY_MTIME, for callers
+    that learn of in-place edits some other way.
+    """
+    # 1. Start a fresh scan table and load the directory index
+    begin_scan()
+    failed_dirs.clear()
+    refresh_remote_index()
+
+    last_full_scan = float(get_sync_state('last_full_scan', 0))
+    full_scan = not (TRUST_DIRECTORY_MTIME or trust_dirs) or time.time() - last_full_scan > FULL_RESCAN_INTERVAL
+    known_dirs = None if full_scan else load_directory_index()
+    dir_snapshots = {}
+    scan_started = time.time()
+
+    # 2. Scan, detect changes, create folders and upload as overlapping stages
+    run_pipeline(scan_local_folder(LOCAL_ROOT_FOLDER, known_dirs, dir_snapshots))
+
+    # 3. Handle locally deleted files, found by an anti-join (batched; rows are dropped as deletes succeed)
+    for relative_path, stored_info in vanished_files():
+        delete_onedrive_item(stored_info['onedrive_id'], relative_path)
+
+    # 4. Pack the small files held back by the pipeline, and repack what the deletes left sparse
+    flush_packs()
+
+    # 5. Remember directory snapshots so unchanged folders are skipped next run; directories
+    #    with a failed upload or archive are left out
+    save_directory_index(dir_snapshots, failed_dirs)
+    if full_scan:
+        set_sync_state('last_full_scan', scan_started)
+
+    # 6. Wait for batched metadata PATCHes and deletes to go out, and their rows to be committed
+    flush_graph_requests()
+    sync_db.flush()
+
+def main(watch=False, dry_run=False, plan_file=None, apply_file=None, shard=None, restore_dest=None):
+    # Tokens come from the cache on first use; a browser opens only if there is none
+    auth.configure(CLIENT_ID, AUTHORITY, SCOPES, TOKEN_CACHE_FILE)
+    sync_db.start_writer(DATABASE_FILE)
+    start_graph_batcher()
+    prune_upload_sessions()
+    bandwidth.SCHEDULE = BANDWIDTH_SCHEDULE
+    if THROUGHPUT_REPORT_INTERVAL:
+        bandwidth.start_reporter(THROUGHPUT_REPORT_INTERVAL)
+    start_metrics()
+    # Turn SIGTERM into a normal exit so queued rows are committed on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    try:
+        if watch:
+            run_watch_mode()
+        elif dry_run or plan_file:
+            header, actions = build_plan()
+            print_plan(header, actions)
+            if plan_file:
+                write_plan(plan_file, header, actions)
+                print(f"Plan written to {plan_file}")
+        elif apply_file:
+            apply_plan(*read_plan(apply_file), shard=shard)
+        elif restore_dest:
+            restore_packed_files(restore_dest)
+        else:
+            sync_once()
+    finally:
+        print(metrics.summary())
+        if METRICS_JSON_FILE:
+            metrics.write_json(METRICS_JSON_FILE)
+
+def start_metrics():
+    metrics.register_counter('upload_bytes_sent_total', lambda: bandwidth.stats()['bytes_sent'])
+    metrics.register_gauge('upload_bytes_per_second', lambda: bandwidth.stats()['bytes_per_sec'])
+    metrics.register_gauge('governor_concurrency_limit', lambda: governor.snapshot()[0])
+    metrics.register_gauge('governor_in_flight', lambda: governor.snapshot()[1])
+    metrics.register_gauge('db_write_queue_depth', sync_db.queue_depth)
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT)
+    if METRICS_JSON_FILE:
+        metrics.start_json_writer(METRICS_JSON_FILE, METRICS_JSON_INTERVAL)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description='Back up LOCAL_ROOT_FOLDER to OneDrive.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--watch', action='store_true',
+                      help='keep running and upload changes as they happen')
+    mode.add_argument('--dry-run', action='store_true',
+                      help='only report what a sync would upload, move and delete '
+                           '(the local copy of the remote index is still brought up to date)')
+    mode.add_argument('--plan', metavar='FILE',
+                      help='work out what a sync would do and save it to FILE without doing it '
+                           '(as with --dry-run, the remote index is brought up to date)')
+    mode.add_argument('--apply', metavar='FILE',
+                      help='carry out a plan saved with --plan')
+    mode.add_argument('--restore-packed', metavar='DEST',
+                      help='download the files stored by --pack into DEST')
+    parser.add_argument('--shard', metavar='K/N',
+                        help='with --apply, carry out only part K of N (0-based), e.g. from N processes at once')
+    parser.add_argument('--pack', action='store_true', default=PACK_MODE,
+                        help='upload small files in compressed archives instead of one by one')
+    parser.add_argument('--trust-directory-mtime', action='store_true', default=TRUST_DIRECTORY_MTIME,
+                        help='skip directories whose mtime is unchanged (misses in-place edits until a full rescan)')
+    parser.add_argument('--engine', choices=['threads', 'async'], default=ENGINE,
+                        help='upload with a thread pool or a single asyncio event loop')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve Prometheus metrics on this local port')
+    parser.add_argument('--metrics-json', default=METRICS_JSON_FILE,
+                        help='write a JSON metrics snapshot to this file periodically and on exit')
+    args = parser.parse_args()
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(int(n) for n in args.shard.split('/'))
+        except ValueError:
+            shard = ()
+        if not args.apply or len(shard) != 2 or not 0 <= shard[0] < shard[1]:
+            parser.error('--shard K/N needs --apply and 0 <= K < N')
+    ENGINE = args.engine
+    PACK_MODE = args.pack
+    TRUST_DIRECTORY_MTIME = args.trust_directory_mtime
+    METRICS_PORT = args.metrics_port
+    METRICS_JSON_FILE = args.metrics_json
+    main(watch=args.watch, dry_run=args.dry_run, plan_file=args.plan, apply_file=args.apply, shard=shard,
+         restore_dest=args.restore_packed)
+    sync_db.stop_writer()
     conn.close()
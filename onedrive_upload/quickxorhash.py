@@ -0,0 +1,71 @@
+import base64
+
+# -----------------------------
+# QuickXorHash
+# -----------------------------
+# OneDrive's content hash (file.hashes.quickXorHash). Byte n of the stream is
+# XORed into a 160-bit circular register at bit (11 * n) % 160, and the stream
+# length is XORed into the last 8 bytes at the end.
+#
+# Bytes 160 apart land on the same bit, so each block is first XOR-folded into
+# 160 bytes with big-int XORs (which run in C), and only those 160 bytes are
+# rotated into place in Python.
+WIDTH_IN_BITS = 160
+SHIFT = 11
+STRIPE = WIDTH_IN_BITS  # Bytes per fold stripe; the bit pattern repeats after 160 bytes
+MASK = (1 << WIDTH_IN_BITS) - 1
+READ_SIZE = 1024 * 1024  # Large enough to amortise syscalls, small enough to stay in cache
+
+def _fold(value, stripes):
+    """XORs the 160-byte stripes of a little-endian int together."""
+    bits = STRIPE * 8
+    while stripes > 1:
+        half = stripes // 2
+        low = value & ((1 << (half * bits)) - 1)
+        high = value >> (half * bits)
+        if stripes % 2:
+            # Odd stripe out sits on top of high; fold it into the bottom stripe
+            top = high >> (half * bits)
+            high &= (1 << (half * bits)) - 1
+            low ^= top
+        value = low ^ high
+        stripes = half
+    return value
+
+def update(state, length, data):
+    """
+    Feeds data into the hash. state is the 160-bit register as an int, length the
+    number of bytes hashed so far; returns the new (state, length).
+    """
+    if not data:
+        return state, length
+    # Shift so stripe index j holds the bytes at stream positions == j (mod 160)
+    lead = length % STRIPE
+    stripes = -(-(lead + len(data)) // STRIPE)
+    value = int.from_bytes(data, 'little') << (lead * 8)
+    folded = _fold(value, stripes).to_bytes(STRIPE, 'little')
+    for j, byte in enumerate(folded):
+        if byte:
+            shift = (j * SHIFT) % WIDTH_IN_BITS
+            state ^= ((byte << shift) | (byte >> (WIDTH_IN_BITS - shift))) & MASK
+    return state, length + len(data)
+
+def digest(state, length):
+    rgb = bytearray(state.to_bytes(WIDTH_IN_BITS // 8, 'little'))
+    for i, b in enumerate(length.to_bytes(8, 'little')):
+        rgb[WIDTH_IN_BITS // 8 - 8 + i] ^= b
+    return base64.b64encode(bytes(rgb)).decode('ascii')
+
+def hash_bytes(data):
+    return digest(*update(0, 0, data))
+
+def hash_file(path):
+    """Base64 quickXorHash of a file, read in READ_SIZE blocks."""
+    state, length = 0, 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            state, length = update(state, length, block)
+    return digest(state, length)
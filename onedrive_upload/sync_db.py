@@ -0,0 +1,240 @@
+import atexit
+import sqlite3
+import time
+from queue import Queue, Empty
+from threading import Event, Thread
+
+import metrics
+
+# -----------------------------
+# Configuration & Constants
+# -----------------------------
+BATCH_SIZE = 500        # Commit after this many queued writes...
+FLUSH_INTERVAL = 1.0    # ...or after this many seconds, whichever comes first
+WRITE_QUEUE_SIZE = 10000
+
+# Global variables
+_write_queue = Queue(WRITE_QUEUE_SIZE)
+_writer_thread = None
+_STOP = object()
+
+# -----------------------------
+# Schema
+# -----------------------------
+def open_database(database_file):
+    """
+    Opens file_metadata.db in WAL mode so the writer thread can commit while
+    other threads keep reading, creating the tables on first use.
+    """
+    conn = sqlite3.connect(database_file, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS files (
+            relative_path TEXT PRIMARY KEY,
+            mtime REAL,
+            size INTEGER,
+            onedrive_id TEXT
+        )
+    ''')
+    # Columns added after the first release; older databases are upgraded in place
+    _add_column(conn, 'files', 'inode', 'INTEGER')
+    _add_column(conn, 'files', 'quickxor', 'TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS files_quickxor ON files (quickxor)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS dirs (
+            relative_dir TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            inode INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            onedrive_path TEXT PRIMARY KEY,
+            upload_url TEXT,
+            expires_at REAL,
+            mtime REAL,
+            size INTEGER,
+            next_expected_ranges TEXT
+        )
+    ''')
+    # What is on OneDrive under GEO_FOLDER, as of the last /delta refresh
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS remote_items (
+            id TEXT PRIMARY KEY,
+            parent_id TEXT,
+            path TEXT COLLATE NOCASE,
+            etag TEXT,
+            quickxor TEXT,
+            size INTEGER,
+            is_folder INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS remote_items_path ON remote_items (path)')
+    # Pack mode: archives of small files under PACK_FOLDER, and where each packed file is in them
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS packs (
+            archive TEXT PRIMARY KEY,
+            group_dir TEXT,
+            onedrive_id TEXT,
+            size INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS packs_group ON packs (group_dir)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS packed_files (
+            relative_path TEXT PRIMARY KEY,
+            archive TEXT,
+            offset INTEGER,
+            length INTEGER,
+            quickxor TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS packed_files_archive ON packed_files (archive)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    conn.commit()
+    return conn
+
+def _add_column(conn, table, column, column_type):
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+def open_scan_connection(database_file):
+    """
+    Opens a connection for change detection. The paths a run has seen go into
+    TEMP tables private to this connection and kept in a temp file rather than
+    in memory, so they can be joined against files on their primary keys. It is
+    in autocommit mode, so reading files never pins a snapshot older than the
+    writer's last commit.
+    """
+    conn = sqlite3.connect(database_file, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA temp_store=FILE')
+    conn.execute('CREATE TEMP TABLE scanned (relative_path TEXT PRIMARY KEY)')
+    conn.execute('CREATE TEMP TABLE scan_batch (relative_path TEXT PRIMARY KEY)')
+    # Stored paths a new file was found to have moved from, so they aren't deleted
+    conn.execute('CREATE TEMP TABLE claimed (relative_path TEXT PRIMARY KEY)')
+    return conn
+
+# -----------------------------
+# Batched Writer
+# -----------------------------
+def start_writer(database_file):
+    """
+    Starts the single thread that owns all writes to the database. Writes are
+    grouped into one transaction per BATCH_SIZE rows or FLUSH_INTERVAL seconds,
+    so a killed run loses at most the last unflushed batch, never a half-written
+    one. Pending writes are committed on interpreter exit.
+    """
+    global _writer_thread
+    if _writer_thread is not None:
+        return
+    conn = open_database(database_file)
+    _writer_thread = Thread(target=_writer_loop, args=(conn,), daemon=True)
+    _writer_thread.start()
+    atexit.register(stop_writer)
+
+def write(sql, params=()):
+    """Queues a single write; returns immediately unless the queue is full."""
+    _write_queue.put((sql, params))
+
+def flush():
+    """Blocks until every write queued so far has been committed."""
+    if _writer_thread is None:
+        return
+    done = Event()
+    _write_queue.put(done)
+    done.wait()
+
+def queue_depth():
+    """Writes queued but not yet committed, for metrics."""
+    return _write_queue.qsize()
+
+def stop_writer():
+    global _writer_thread
+    if _writer_thread is None:
+        return
+    _write_queue.put(_STOP)
+    _writer_thread.join()
+    _writer_thread = None
+
+def _commit(conn, pending):
+    """
+    Runs queued writes in one transaction. Consecutive writes with the same SQL
+    go through executemany, which reuses a single prepared statement.
+    """
+    if not pending:
+        return
+    began = time.monotonic()
+    try:
+        start = 0
+        while start < len(pending):
+            sql = pending[start][0]
+            end = start
+            while end < len(pending) and pending[end][0] == sql:
+                end += 1
+            conn.executemany(sql, [params for _, params in pending[start:end]])
+            start = end
+        conn.commit()
+        metrics.observe('db_commit_seconds', time.monotonic() - began)
+        metrics.inc('db_rows_committed_total', len(pending))
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Database write of {len(pending)} row(s) failed ({e}); retrying them one at a time")
+        _commit_one_by_one(conn, pending)
+    pending.clear()
+
+def _commit_one_by_one(conn, pending):
+    """
+    Runs a batch that failed as a whole statement by statement, so one bad row
+    doesn't cost the unrelated writes queued with it. A failing statement is
+    undone on its own; the rest are committed together.
+    """
+    failed = 0
+    for sql, params in pending:
+        try:
+            conn.execute(sql, params)
+        except sqlite3.Error as e:
+            failed += 1
+            print(f"Database write failed: {e}: {' '.join(sql.split())} {params}")
+    try:
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print(f"Database write of {len(pending)} row(s) failed: {e}")
+        metrics.inc('db_rows_failed_total', len(pending))
+        return
+    metrics.inc('db_rows_committed_total', len(pending) - failed)
+    metrics.inc('db_rows_failed_total', failed)
+
+def _writer_loop(conn):
+    pending = []
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = _write_queue.get(timeout=timeout)
+        except Empty:
+            item = None
+
+        if item is None or isinstance(item, Event) or item is _STOP:
+            _commit(conn, pending)
+            deadline = None
+            if isinstance(item, Event):
+                item.set()
+            elif item is _STOP:
+                break
+            continue
+
+        pending.append(item)
+        if deadline is None:
+            deadline = time.monotonic() + FLUSH_INTERVAL
+        if len(pending) >= BATCH_SIZE:
+            _commit(conn, pending)
+            deadline = None
+    conn.close()
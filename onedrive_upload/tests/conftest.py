@@ -0,0 +1,67 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import auth
+import graph_stub
+
+# -----------------------------
+# Graph Stub Fixtures
+# -----------------------------
+# Both uploaders read GRAPH_URL when they are imported, so the stub is started
+# once per session before either is, and emptied again for every test. No test
+# signs in: auth gets a token that stays valid for the whole session.
+TABLES = ['files', 'dirs', 'upload_sessions', 'remote_items', 'packs', 'packed_files', 'sync_state']
+
+@pytest.fixture(scope='session')
+def stub_url():
+    server, url = graph_stub.start()
+    os.environ['GRAPH_URL'] = url
+    auth.result = {'access_token': 'test', 'expires_at': time.time() + 24 * 60 * 60}
+    yield url
+    server.shutdown()
+
+@pytest.fixture
+def stub(stub_url):
+    graph_stub.reset()
+    return graph_stub
+
+@pytest.fixture(scope='session')
+def v2(stub_url, tmp_path_factory):
+    """onedrive_upload_v2, with its database (opened on import) in a directory of its own."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('v2'))
+    try:
+        import onedrive_upload_v2
+        onedrive_upload_v2.DATABASE_FILE = os.path.abspath(onedrive_upload_v2.DATABASE_FILE)
+    finally:
+        os.chdir(cwd)
+    onedrive_upload_v2.sync_db.start_writer(onedrive_upload_v2.DATABASE_FILE)
+    onedrive_upload_v2.start_graph_batcher()
+    return onedrive_upload_v2
+
+@pytest.fixture
+def v2_root(v2, stub, tmp_path, monkeypatch):
+    """An empty LOCAL_ROOT_FOLDER, with nothing on OneDrive and nothing in the database."""
+    for table in TABLES:
+        v2.sync_db.write(f'DELETE FROM {table}')
+    v2.sync_db.flush()
+    v2.existing_folders.clear()
+    v2.uploaded_content.clear()
+    root = tmp_path / 'root'
+    root.mkdir()
+    monkeypatch.setattr(v2, 'LOCAL_ROOT_FOLDER', str(root))
+    return root
+
+@pytest.fixture
+def remote_files(stub):
+    """Returns {path below folder: quickXorHash} of the files on OneDrive under folder."""
+    def remote_files(folder):
+        prefix = folder + '/'
+        return {item['path'][len(prefix):]: item['quickxor'] for item in list(stub.items.values())
+                if not item['folder'] and item['path'].startswith(prefix)}
+    return remote_files
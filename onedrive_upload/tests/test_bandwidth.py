@@ -0,0 +1,162 @@
+import asyncio
+import io
+from collections import deque
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+import bandwidth
+
+class FakeClock:
+    """Stands in for the time module: sleeping moves the clock instead of waiting."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    async def async_sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(bandwidth, 'time', clock)
+    monkeypatch.setattr(bandwidth, 'asyncio', SimpleNamespace(sleep=clock.async_sleep))
+    monkeypatch.setattr(bandwidth, '_next_send', 0.0)
+    monkeypatch.setattr(bandwidth, '_bytes_sent', 0)
+    monkeypatch.setattr(bandwidth, '_recent', deque())
+    monkeypatch.setattr(bandwidth, 'PACING_BLOCK', 1000)
+    return clock
+
+@pytest.fixture
+def rate(monkeypatch):
+    """Fixes the current rate at 1000 bytes/sec."""
+    monkeypatch.setattr(bandwidth, 'current_rate', lambda: 1000)
+    return 1000
+
+# -----------------------------
+# Token Bucket
+# -----------------------------
+def test_unlimited_never_waits(clock, monkeypatch):
+    monkeypatch.setattr(bandwidth, 'current_rate', lambda: None)
+    assert [bandwidth.reserve(10 ** 6) for _ in range(5)] == [0.0] * 5
+
+def test_blocks_are_spaced_at_the_rate_after_a_burst(clock, rate):
+    # 250 bytes of burst allowance, then each 100-byte block waits 0.1s more than the last
+    delays = [bandwidth.reserve(100) for _ in range(6)]
+    assert delays == pytest.approx([0.0, 0.0, 0.0, 0.05, 0.15, 0.25])
+
+def test_idle_time_saves_up_at_most_the_burst(clock, rate):
+    bandwidth.reserve(1000)
+    clock.now += 100
+    assert bandwidth.reserve(1000) == 0.0
+    assert bandwidth.reserve(1000) == pytest.approx(1.0 - bandwidth.BURST_SECONDS)
+
+def test_stats_counts_recent_bytes(clock, rate):
+    bandwidth.reserve(3000)
+    clock.now += 2
+    bandwidth.reserve(500)
+    assert bandwidth.stats() == {'bytes_sent': 3500, 'bytes_per_sec': pytest.approx(3500 / 2), 'limit': 1000}
+    clock.now += bandwidth.RATE_WINDOW + 1
+    assert bandwidth.stats()['bytes_per_sec'] == 0
+
+# -----------------------------
+# Paced Bodies
+# -----------------------------
+def test_paced_reader_waits_between_blocks(clock, rate):
+    reader = bandwidth.PacedReader(bytes(10_000))
+    began = clock.now
+    sent = b''.join(iter(lambda: bytes(reader.read(4096)), b''))
+    assert sent == bytes(10_000)
+    # Ten 1000-byte blocks: the first is free, the burst covers 0.25s of the second's wait
+    assert clock.now - began == pytest.approx(9 - bandwidth.BURST_SECONDS)
+    assert reader.waited == pytest.approx(clock.now - began)
+    reader.seek(0)
+    assert reader.waited == 0.0
+
+def test_paced_file_waits_between_blocks(clock, rate):
+    f = io.BytesIO(bytes(3000))
+    f.fileno = lambda: 0
+    paced = bandwidth.PacedFile.__new__(bandwidth.PacedFile)  # BytesIO has no real descriptor to fstat
+    paced._f, paced._size, paced.waited = f, 3000, 0.0
+    assert len(paced) == 3000
+    while paced.read():
+        pass
+    assert paced.waited == pytest.approx(2 - bandwidth.BURST_SECONDS)
+    paced.seek(0)
+    assert paced.waited == 0.0 and f.tell() == 0
+
+def test_paced_file_over_a_real_file(clock, rate, tmp_path):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(bytes(2500))
+    with open(path, 'rb') as f:
+        paced = bandwidth.PacedFile(f)
+        assert len(paced) == 2500
+        assert sum(len(block) for block in iter(paced.read, b'')) == 2500
+    assert paced.waited == pytest.approx(2 - bandwidth.BURST_SECONDS)
+
+def test_paced_blocks_yield_views_and_count_waits(clock, rate):
+    data = bytearray(b'x' * 2500)
+    paced = bandwidth.PacedBlocks(data)
+    async def collect():
+        return [block async for block in paced]
+    blocks = asyncio.run(collect())
+    assert [len(block) for block in blocks] == [1000, 1000, 500]
+    assert all(isinstance(block, memoryview) for block in blocks)
+    assert paced.waited == pytest.approx(2 - bandwidth.BURST_SECONDS)
+
+# -----------------------------
+# Schedule
+# -----------------------------
+MONDAY = datetime(2024, 1, 1)  # 1 January 2024 was a Monday
+
+def at(days, hour, minute=0):
+    return MONDAY.replace(day=1 + days, hour=hour, minute=minute)
+
+def test_schedule_days_and_hours(monkeypatch):
+    monkeypatch.setattr(bandwidth, 'SCHEDULE', [('mon-fri', '08:00', '18:00', 2000),
+                                                ('sat,sun', '00:00', '23:59', 500)])
+    assert bandwidth.rate_at(at(0, 9)) == 2000
+    assert bandwidth.rate_at(at(4, 17, 59)) == 2000
+    assert bandwidth.rate_at(at(4, 18)) is None  # The end is exclusive
+    assert bandwidth.rate_at(at(0, 7, 59)) is None
+    assert bandwidth.rate_at(at(5, 9)) == 500
+    assert bandwidth.rate_at(at(6, 12)) == 500
+
+def test_schedule_first_match_wins(monkeypatch):
+    monkeypatch.setattr(bandwidth, 'SCHEDULE', [('wed', '12:00', '13:00', None), ('*', '08:00', '18:00', 2000)])
+    assert bandwidth.rate_at(at(2, 12, 30)) is None
+    assert bandwidth.rate_at(at(2, 13)) == 2000
+    assert bandwidth.rate_at(at(3, 12, 30)) == 2000
+
+def test_schedule_window_across_midnight_belongs_to_its_first_day(monkeypatch):
+    monkeypatch.setattr(bandwidth, 'SCHEDULE', [('fri', '22:00', '06:00', 500)])
+    assert bandwidth.rate_at(at(4, 23)) == 500   # Friday night
+    assert bandwidth.rate_at(at(5, 5, 59)) == 500  # Saturday morning, still Friday's window
+    assert bandwidth.rate_at(at(5, 6)) is None
+    assert bandwidth.rate_at(at(4, 5)) is None   # Friday morning is Thursday's night
+    assert bandwidth.rate_at(at(5, 23)) is None
+
+def test_schedule_day_range_across_the_week_end(monkeypatch):
+    monkeypatch.setattr(bandwidth, 'SCHEDULE', [('fri-mon', '00:00', '23:59', 500)])
+    assert [bandwidth.rate_at(at(day, 12)) for day in range(7)] == [500, None, None, None, 500, 500, 500]
+    # Sunday night into Monday morning: the window started on a day in the range
+    monkeypatch.setattr(bandwidth, 'SCHEDULE', [('sun', '23:00', '01:00', 500)])
+    assert bandwidth.rate_at(MONDAY.replace(hour=0, minute=30)) == 500
+
+def test_current_rate_is_looked_up_at_most_once_a_second(clock, monkeypatch):
+    lookups = []
+    monkeypatch.setattr(bandwidth, 'rate_at', lambda moment: lookups.append(moment) or 1000)
+    monkeypatch.setattr(bandwidth, '_rate_checked', 0.0)
+    assert bandwidth.current_rate() == 1000
+    clock.now += 0.5
+    bandwidth.current_rate()
+    assert len(lookups) == 1
+    clock.now += 0.5
+    bandwidth.current_rate()
+    assert len(lookups) == 2
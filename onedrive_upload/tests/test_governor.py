@@ -0,0 +1,143 @@
+import asyncio
+import time
+from collections import deque
+from threading import Thread
+
+import pytest
+
+import governor
+
+@pytest.fixture(autouse=True)
+def fresh_governor(monkeypatch):
+    monkeypatch.setattr(governor, '_limit', float(governor.INITIAL_LIMIT))
+    monkeypatch.setattr(governor, '_in_flight', 0)
+    monkeypatch.setattr(governor, '_paused_until', 0.0)
+    monkeypatch.setattr(governor, '_last_decrease', 0.0)
+    monkeypatch.setattr(governor, '_latency', {})
+    monkeypatch.setattr(governor, '_waiting_threads', 0)
+    monkeypatch.setattr(governor, '_async_waiters', deque())
+    monkeypatch.setattr(governor, 'PAUSE_JITTER', 0.0)
+
+def finish(kind='GET', status=200, seconds=None, retry_after=None):
+    """Runs one request through a slot; seconds backdates its start to make it that slow."""
+    started = governor.acquire()
+    if seconds is not None:
+        started = time.monotonic() - seconds
+    governor.release(started, kind, status, retry_after)
+
+# -----------------------------
+# Limit
+# -----------------------------
+def test_limit_grows_by_about_one_per_round_of_successes():
+    assert governor.snapshot() == (4, 0)
+    for _ in range(4):
+        finish()
+    assert governor.snapshot()[0] == 4  # 4 + 1/4 + 1/4.25 + ... just short of 5
+    finish()
+    assert governor.snapshot()[0] == 5
+
+def test_limit_stops_at_max(monkeypatch):
+    monkeypatch.setattr(governor, '_limit', float(governor.MAX_LIMIT))
+    finish()
+    assert governor.snapshot()[0] == governor.MAX_LIMIT
+
+@pytest.mark.parametrize('status', [429, 503, None])
+def test_limit_is_halved_once_per_round_of_failures(status, monkeypatch):
+    monkeypatch.setattr(governor, '_limit', 8.0)
+    before_cut = governor.acquire()
+    finish(status=status)
+    assert governor.snapshot()[0] == 4
+    # Sent before the cut, so its failure is part of the same round
+    governor.release(before_cut, 'GET', status)
+    assert governor.snapshot()[0] == 4
+    finish(status=status)
+    assert governor.snapshot()[0] == 2
+
+def test_client_errors_leave_the_limit_alone():
+    finish(status=404)
+    assert governor.snapshot()[0] == 4
+
+# -----------------------------
+# Latency
+# -----------------------------
+def test_slow_request_halves_the_limit_only_against_its_own_kind():
+    for _ in range(governor.LATENCY_WARMUP):
+        finish('PUT:10', seconds=0.05)
+        finish('PUT:23', seconds=2.0)
+    limit = governor._limit
+    finish('PUT:23', seconds=2.5)  # Usual for 4 MB bodies
+    assert governor._limit > limit
+    limit = governor._limit
+    finish('PUT:10', seconds=0.3)  # Six times the usual, but under SLOW_MIN_SECONDS
+    assert governor._limit > limit
+    limit = governor._limit
+    finish('PUT:10', seconds=1.0)
+    assert governor._limit == pytest.approx(limit * governor.DECREASE_FACTOR)
+
+def test_no_latency_signal_before_warmup():
+    finish('GET', seconds=0.01)
+    finish('GET', seconds=5.0)
+    assert governor.snapshot()[0] == 4
+
+# -----------------------------
+# Retry-After
+# -----------------------------
+def test_retry_after_pauses_every_thread():
+    finish(status=429, retry_after=0.3)
+    began = time.monotonic()
+    waited = []
+    def request():
+        started = governor.acquire()
+        waited.append(started - began)
+        governor.release(started, 'GET', 200)
+    thread = Thread(target=request)
+    thread.start()
+    thread.join(5)
+    assert waited and 0.25 <= waited[0] < 2
+
+def test_retry_after_pauses_coroutines():
+    async def main():
+        finish(status=429, retry_after=0.3)
+        began = time.monotonic()
+        started = await asyncio.wait_for(governor.acquire_async(), 5)
+        governor.release(started, 'GET', 200)
+        return time.monotonic() - began
+    assert 0.25 <= asyncio.run(main()) < 2
+
+# -----------------------------
+# Async Waiters
+# -----------------------------
+def test_coroutines_share_the_limit_with_threads():
+    async def main():
+        held = governor.acquire()  # A thread's request
+        futures = [governor.acquire_async() for _ in range(5)]
+        await asyncio.sleep(0.05)
+        done = [future for future in futures if future.done()]
+        assert len(done) == 3  # INITIAL_LIMIT of 4, one taken by the thread
+        governor.release(held, 'GET', 200)
+        await asyncio.sleep(0.05)
+        assert sum(future.done() for future in futures) == 4
+        governor.release(done[0].result(), 'GET', 200)
+        await asyncio.sleep(0.05)
+        assert all(future.done() for future in futures)
+        assert governor.snapshot()[1] == 4
+
+    asyncio.run(main())
+
+def test_waiting_threads_go_before_coroutines(monkeypatch):
+    monkeypatch.setattr(governor, '_limit', 1.0)
+    async def main():
+        held = governor.acquire()
+        thread = Thread(target=lambda: governor.release(governor.acquire(), 'GET', 200))
+        thread.start()
+        while governor._waiting_threads == 0:
+            await asyncio.sleep(0.01)
+        future = governor.acquire_async()
+        governor.release(held, 'GET', 200)  # The free slot goes to the thread
+        await asyncio.sleep(0.05)
+        thread.join(5)
+        started = await asyncio.wait_for(future, 5)  # ...and to the coroutine once the thread is done
+        governor.release(started, 'GET', 200)
+
+    asyncio.run(main())
+    assert governor.snapshot()[1] == 0
@@ -0,0 +1,51 @@
+import os
+import time
+
+import pytest
+
+import quickxorhash
+
+@pytest.fixture
+def v1(stub, tmp_path, monkeypatch):
+    import onedrive_upload
+    monkeypatch.chdir(tmp_path)  # Its database and folder cache are relative paths
+    monkeypatch.setattr(onedrive_upload, 'known_folders', set())
+    monkeypatch.setattr(onedrive_upload, 'max_workers', 1)
+    stub.dispatch('POST', '/v1.0/me/drive/root/children', b'{"name": "backup"}', None)
+    root = tmp_path / 'r1'
+    root.mkdir()
+    monkeypatch.setattr(onedrive_upload, 'folders_to_monitor', [str(root)])
+    return onedrive_upload
+
+def test_copies_skip_edited_sources_and_are_verified(v1, stub, remote_files, tmp_path):
+    root = tmp_path / 'r1'
+    old, new, other = (os.urandom(v1.dedupe_min_size + 1000) for _ in range(3))
+    (root / 'a.bin').write_bytes(old)
+    (root / 'c.bin').write_bytes(other)
+    v1.initial_sync()
+
+    # a.bin is edited and b.bin takes its old content; with one worker, a.bin is uploaded first
+    time.sleep(0.01)
+    (root / 'a.bin').write_bytes(new)
+    (root / 'b.bin').write_bytes(old)
+    # c.bin changes on OneDrive behind our back, and d.bin has its old content
+    stub.items[stub.paths['backup/r1/c.bin']]['quickxor'] = 'changed elsewhere'
+    (root / 'd.bin').write_bytes(other)
+    v1.initial_sync()
+
+    remote = remote_files('backup/r1')
+    assert remote['a.bin'] == quickxorhash.hash_bytes(new)
+    assert remote['b.bin'] == quickxorhash.hash_bytes(old)
+    assert remote['d.bin'] == quickxorhash.hash_bytes(other)
+
+def test_unchanged_content_is_copied(v1, stub, remote_files, tmp_path):
+    root = tmp_path / 'r1'
+    blob = os.urandom(v1.dedupe_min_size + 1000)
+    (root / 'a.bin').write_bytes(blob)
+    v1.initial_sync()
+
+    (root / 'b.bin').write_bytes(blob)
+    stub.bytes_received = 0
+    v1.initial_sync()
+    assert stub.bytes_received < len(blob) // 10
+    assert remote_files('backup/r1')['b.bin'] == quickxorhash.hash_bytes(blob)
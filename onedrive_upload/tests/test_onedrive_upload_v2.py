@@ -0,0 +1,261 @@
+import asyncio
+import os
+import time
+
+import aiohttp
+import pytest
+
+import bandwidth
+import governor
+import metrics
+import quickxorhash
+
+def local_files(root):
+    return {os.path.relpath(os.path.join(dirpath, name), root).replace('\\', '/'): quickxorhash.hash_file(
+                os.path.join(dirpath, name))
+            for dirpath, _, names in os.walk(root) for name in names}
+
+def write_tree(root, files):
+    for relative_path, data in files.items():
+        path = root / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+# -----------------------------
+# Upload Sessions
+# -----------------------------
+def test_interrupted_upload_session_resumes(v2, v2_root, stub, remote_files, monkeypatch):
+    monkeypatch.setattr(v2, 'SMALL_FILE_SIZE', 1024 * 1024)
+    monkeypatch.setattr(v2, 'CHUNK_SIZE', v2.CHUNK_ALIGNMENT)
+    monkeypatch.setattr(v2, 'parallel_chunks_allowed', False)
+    write_tree(v2_root, {'big.bin': os.urandom(5 * v2.CHUNK_ALIGNMENT + 123)})
+
+    put_chunk = v2.put_chunk
+    starts = []
+    def interrupted(upload_url, buf, data, start, file_size):
+        if starts:
+            v2.release_buffer(buf)
+            return None, 0.0  # The connection dropped after the first chunk
+        starts.append(start)
+        return put_chunk(upload_url, buf, data, start, file_size)
+    monkeypatch.setattr(v2, 'put_chunk', interrupted)
+    v2.sync_once()
+    assert 'big.bin' not in remote_files(v2.GEO_FOLDER)
+    assert v2.conn.execute('SELECT COUNT(*) FROM upload_sessions').fetchone()[0] == 1
+
+    resumed = []
+    def recording(upload_url, buf, data, start, file_size):
+        resumed.append(start)
+        return put_chunk(upload_url, buf, data, start, file_size)
+    monkeypatch.setattr(v2, 'put_chunk', recording)
+    v2.sync_once()
+    assert resumed[0] == v2.CHUNK_ALIGNMENT
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+    assert v2.conn.execute('SELECT COUNT(*) FROM upload_sessions').fetchone()[0] == 0
+
+# -----------------------------
+# Sync Plans
+# -----------------------------
+def test_plan_round_trip(v2, v2_root, stub, remote_files, tmp_path):
+    write_tree(v2_root, {'a/one.txt': b'one', 'a/b/two.txt': b'two', 'three.txt': b'three'})
+    plan_file = str(tmp_path / 'plan.jsonl')
+    header, actions = v2.build_plan()
+    assert header['counts']['upload'] == 3
+    v2.write_plan(plan_file, header, actions)
+    assert v2.read_plan(plan_file) == (header, actions)
+    v2.apply_plan(*v2.read_plan(plan_file))
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+
+    # A rename is planned as a move of the same item; nothing is left to do after it
+    os.rename(v2_root / 'a' / 'one.txt', v2_root / 'a' / 'b' / 'one.txt')
+    header, actions = v2.build_plan()
+    assert [action[0] for action in actions if action[0] != 'dir'] == ['move']
+    stub.bytes_received = 0
+    v2.apply_plan(header, actions)
+    assert stub.bytes_received < len(b'one') * 100  # Metadata only
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+    header, actions = v2.build_plan()
+    assert [action for action in actions if action[0] != 'dir'] == []
+
+# -----------------------------
+# Watch Mode
+# -----------------------------
+def test_watch_events_coalesce(v2, v2_root, monkeypatch):
+    monkeypatch.setattr(v2, 'WATCH_DEBOUNCE', 0)
+    root = str(v2_root)
+    write_tree(v2_root, {'a.txt': b'a', 'new/b.txt': b'b'})
+    v2.record_watch_event(f'{root}/a.txt', 'file')
+    v2.record_watch_event(f'{root}/a.txt', 'file')
+    v2.record_watch_event(f'{root}/new', 'dir')
+    v2.record_watch_event(f'{root}/new/b.txt', 'file')
+    v2.record_watch_event(f'{root}/new', 'file')  # A directory created in the batch is still scanned
+    v2.record_watch_move(f'{root}/d1', f'{root}/d2', True)
+    v2.record_watch_move(f'{root}/d2', f'{root}/d3', True)
+    v2.record_watch_move(f'{root}/e1', f'{root}/e2', True)
+    v2.record_watch_move(f'{root}/e2', f'{root}/e1', True)
+    v2.record_watch_event(os.path.join(os.path.dirname(root), 'outside.txt'), 'file')
+
+    events, dir_moves = v2.take_watch_batch()
+    assert events == {'a.txt': 'file', 'new': 'dir', 'new/b.txt': 'file'}
+    assert dir_moves == [['d1', 'd3']]
+    assert sorted(path for path, _ in v2.watch_items(events)) == ['a.txt', 'new/b.txt']
+    assert v2.take_watch_batch() is None
+
+def test_watch_batch_moves_directory_once(v2, v2_root, stub, remote_files, monkeypatch):
+    monkeypatch.setattr(v2, 'WATCH_DEBOUNCE', 0)
+    write_tree(v2_root, {f'd1/f{i}': os.urandom(100) for i in range(10)})
+    v2.sync_once()
+    root = str(v2_root)
+    os.rename(f'{root}/d1', f'{root}/d2')
+    v2.record_watch_move(f'{root}/d1', f'{root}/d2', True)
+    for i in range(10):
+        v2.record_watch_move(f'{root}/d1/f{i}', f'{root}/d2/f{i}', False)
+
+    stub.request_counts.clear()
+    stub.bytes_received = 0
+    v2.process_watch_batch(*v2.take_watch_batch())
+    assert stub.request_counts.get('PATCH') == 1
+    assert stub.request_counts.get('PUT') is None
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+
+def test_deleted_then_restored_file_is_uploaded_again(v2, v2_root, stub, remote_files):
+    data = os.urandom(500)
+    write_tree(v2_root, {'d/f1': data, 'd/f2': b'two'})
+    v2.sync_once()
+    os.remove(v2_root / 'd' / 'f1')
+    v2.process_watch_batch({'d/f1': 'deleted'}, [])
+    assert 'd/f1' not in remote_files(v2.GEO_FOLDER)
+
+    write_tree(v2_root, {'d/f1': data})
+    v2.process_watch_batch({'d/f1': 'file'}, [])
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+
+    # Deleted on OneDrive by someone else: the next sync uploads it again
+    with stub.state_lock:
+        stub._delete_item(stub.items[stub.paths[f'{v2.GEO_FOLDER.lower()}/d']])
+    v2.sync_once()
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+
+@pytest.mark.parametrize('syncs', [1, 2])
+def test_tree_is_uploaded_again_when_root_is_deleted(v2, v2_root, stub, remote_files, syncs):
+    # After one sync the root's id isn't known yet; after two it is stored along with a delta link
+    write_tree(v2_root, {'d/f1': b'one', 'd/e/f2': b'two', 'f3': b'three'})
+    for _ in range(syncs):
+        v2.sync_once()
+    with stub.state_lock:
+        stub._delete_item(stub.items[stub.paths[v2.GEO_FOLDER.lower()]])
+    v2.sync_once()
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+
+# -----------------------------
+# Server-side Copies
+# -----------------------------
+def test_duplicate_content_is_copied(v2, v2_root, stub, remote_files):
+    blob = os.urandom(v2.DEDUPE_MIN_SIZE + 1000)
+    write_tree(v2_root, {'a/first.bin': blob})
+    v2.sync_once()
+
+    write_tree(v2_root, {'b/second.bin': blob})
+    uploaded = metrics.counter_total('files_uploaded_total')
+    copied = metrics.counter_total('files_copied_total')
+    stub.bytes_received = 0
+    v2.sync_once()
+    assert stub.bytes_received < len(blob) // 10
+    assert metrics.counter_total('files_copied_total') == copied + 1
+    assert metrics.counter_total('files_uploaded_total') == uploaded
+    assert remote_files(v2.GEO_FOLDER) == local_files(v2_root)
+
+def test_copy_source_changed_on_onedrive_is_uploaded_instead(v2, v2_root, stub, remote_files):
+    blob = os.urandom(v2.DEDUPE_MIN_SIZE + 1000)
+    write_tree(v2_root, {'a/first.bin': blob})
+    v2.sync_once()
+    stub.items[stub.paths[f'{v2.GEO_FOLDER.lower()}/a/first.bin']]['quickxor'] = 'changed elsewhere'
+
+    write_tree(v2_root, {'b/second.bin': blob})
+    stub.bytes_received = 0
+    v2.sync_once()
+    assert stub.bytes_received >= len(blob)
+    assert remote_files(v2.GEO_FOLDER)['b/second.bin'] == quickxorhash.hash_bytes(blob)
+
+# -----------------------------
+# Pack Mode
+# -----------------------------
+def test_file_of_a_failed_archive_is_packed_next_run(v2, v2_root, stub, monkeypatch):
+    monkeypatch.setattr(v2, 'PACK_MODE', True)
+    write_tree(v2_root, {f'a/f{i}': os.urandom(100) for i in range(5)})
+    v2.sync_once()
+
+    # Edited in place, so the directory's mtime doesn't change; the archive it goes into fails
+    write_tree(v2_root, {'a/f0': b'edited'})
+    make_request_with_retry = v2.make_request_with_retry
+    def archives_fail(method, url, *args, **kwargs):
+        if method == 'PUT' and f'/{v2.PACK_FOLDER}/' in url:
+            return None
+        return make_request_with_retry(method, url, *args, **kwargs)
+    monkeypatch.setattr(v2, 'make_request_with_retry', archives_fail)
+    v2.sync_once()
+
+    # The directory wasn't recorded as synced, so it is looked at even when directory mtimes are trusted
+    monkeypatch.setattr(v2, 'make_request_with_retry', make_request_with_retry)
+    v2.sync_once(trust_dirs=True)
+    packed = v2.conn.execute("SELECT quickxor FROM packed_files WHERE relative_path = 'a/f0'").fetchone()
+    assert packed[0] == quickxorhash.hash_bytes(b'edited')
+
+def test_pack_round_trip(v2, v2_root, stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(v2, 'PACK_MODE', True)
+    monkeypatch.setattr(stub, 'STORE_CONTENT', True)
+    write_tree(v2_root, {f'a/f{i}': os.urandom(100) for i in range(10)})
+    v2.sync_once()
+    archives = lambda: {archive for (archive,) in v2.conn.execute('SELECT archive FROM packs')}
+    first = archives()
+    assert len(first) == 1
+
+    # One edited file goes into a new archive; the first is still mostly in use and stays
+    write_tree(v2_root, {'a/f0': b'edited'})
+    v2.sync_once()
+    assert len(archives()) == 2 and first < archives()
+
+    # Once less than PACK_REPACK_RATIO of it is in use, its live files are carried over and it is deleted
+    write_tree(v2_root, {f'a/f{i}': b'edited %d' % i for i in range(1, 6)})
+    v2.sync_once()
+    assert not first & archives()
+    assert next(iter(first)).lower() not in stub.paths
+    assert all(archive.lower() in stub.paths for archive in archives())
+
+    restored = tmp_path / 'restored'
+    assert v2.restore_packed_files(str(restored)) == 10
+    assert local_files(restored) == local_files(v2_root)
+    assert os.path.getmtime(restored / 'a' / 'f7') == os.path.getmtime(v2_root / 'a' / 'f7')
+
+    # A file whose bytes don't match the manifest is skipped, as is everything in a corrupt archive
+    v2.sync_db.write("UPDATE packed_files SET quickxor = 'wrong' WHERE relative_path = 'a/f7'")
+    v2.sync_db.flush()
+    assert v2.restore_packed_files(str(tmp_path / 'checked')) == 9
+    assert not (tmp_path / 'checked' / 'a' / 'f7').exists()
+    archive, item_id = v2.conn.execute("SELECT archive, onedrive_id FROM packs "
+                                       "JOIN packed_files USING (archive) WHERE relative_path = 'a/f0'").fetchone()
+    stub.items[item_id]['content'] = os.urandom(len(stub.items[item_id]['content']))
+    assert v2.restore_packed_files(str(tmp_path / 'corrupt'), 'a/f0') == 0
+
+# -----------------------------
+# Async Engine
+# -----------------------------
+def test_async_request_does_not_count_pacing_as_latency(v2, v2_root, monkeypatch):
+    monkeypatch.setattr(bandwidth, 'reserve', lambda nbytes: 0.2)  # Every block waits 0.2s for bandwidth
+    latencies = []
+    release = governor.release
+    def recording(started, *args):
+        latencies.append(time.monotonic() - started)
+        return release(started, *args)
+    monkeypatch.setattr(governor, 'release', recording)
+
+    async def upload():
+        async with aiohttp.ClientSession() as session:
+            url = f'{v2.GRAPH_URL}/me/drive/root:/{v2.GEO_FOLDER}/paced.bin:/content'
+            return await v2.async_request(session, 'PUT', url, headers={'Authorization': 'Bearer test'},
+                                          data=b'x' * 1000)
+    began = time.monotonic()
+    status, _ = asyncio.run(upload())
+    assert status == 201
+    assert time.monotonic() - began >= 0.2
+    assert latencies[0] < 0.1
@@ -0,0 +1,30 @@
+import os
+
+import quickxorhash
+
+# Digests from a direct port of Microsoft's reference QuickXorHash (one bit
+# position at a time, no folding)
+VECTORS = [
+    (b'', 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='),
+    (b'Hello, World!', 'SCgDG9jwBhaA4ApvnQMbyBACAAA='),
+    (bytes(range(256)) * 4, 'h7xr2dbCayZCQYR9KKhlwDuT4UI='),
+]
+
+def test_known_vectors():
+    for data, expected in VECTORS:
+        assert quickxorhash.hash_bytes(data) == expected
+
+def test_blocks_of_any_size_give_the_same_digest():
+    data = os.urandom(3 * quickxorhash.STRIPE + 17)
+    for block_size in (1, 7, quickxorhash.STRIPE - 1, quickxorhash.STRIPE, 1000):
+        state, length = 0, 0
+        for start in range(0, len(data), block_size):
+            state, length = quickxorhash.update(state, length, data[start:start + block_size])
+        assert quickxorhash.digest(state, length) == quickxorhash.hash_bytes(data)
+
+def test_hash_file_matches_hash_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr(quickxorhash, 'READ_SIZE', 1000)  # Several reads, not a multiple of STRIPE
+    data = os.urandom(5000)
+    path = tmp_path / 'data.bin'
+    path.write_bytes(data)
+    assert quickxorhash.hash_file(str(path)) == quickxorhash.hash_bytes(data)